@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -105,6 +106,12 @@ DATABASES = {
     }
 }
 
+# Inference server (a single flask_api.py or router.py in front of several replicas)
+LLM_SERVER_URL = os.environ.get("LLM_SERVER_URL", "http://10.3.0.96:5000")
+# Generation for a chat message is abandoned after this many seconds
+LLM_REQUEST_DEADLINE_S = float(os.environ.get("LLM_REQUEST_DEADLINE_S", "600"))
+LLM_CANCEL_TIMEOUT_S = float(os.environ.get("LLM_CANCEL_TIMEOUT_S", "2"))
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -1,8 +1,11 @@
 # chat/consumers.py
 
+import asyncio
 import json
 import logging
+import time
 import urllib.parse
+import uuid
 import re
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
@@ -23,7 +26,7 @@ class LLMWebSocketConsumer(AsyncWebsocketConsumer):
 
     
     async def call_flask_llm_to_llm(self, prompt_1, prompt_2, iterations):
-        llm_to_llm_url = "http://10.3.0.96:5000/generate_llm_to_llm"
+        llm_to_llm_url = f"{settings.LLM_SERVER_URL}/generate_llm_to_llm"
         try:
             async with aiohttp.ClientSession() as session:
                 payload = {
@@ -120,7 +123,7 @@ class LLMWebSocketConsumer(AsyncWebsocketConsumer):
         await self.save_message(sender=self.user, persona=self.persona, content=message, is_from_user=True)
 
         # Send the message to the Flask LLM server
-        llm_url = "http://10.3.0.96:5000/generate"
+        llm_url = f"{settings.LLM_SERVER_URL}/generate"
         try:
             async with aiohttp.ClientSession() as session:
                 payload = {"prompt": message, "persona_name": self.persona_name}
@@ -185,6 +188,11 @@ class LLMWebSocketConsumer(AsyncWebsocketConsumer):
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        # Inference calls still running for this socket, cancelled on disconnect
+        self.upstream_tasks = set()
+        self.upstream_lock = asyncio.Lock()
+        self.pending_requests = set()
+
         # Parse query string for JWT token
         query_params = urllib.parse.parse_qs(self.scope['query_string'].decode())
         token_list = query_params.get('token', [])
@@ -234,32 +242,63 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
             logger.info(f"User {self.user.username} disconnected from {self.room_group_name}")
 
-    async def receive(self, text_data):
-        try:
-            logger.info(f"Received message: {text_data}")
-            data = json.loads(text_data)
-            action = data.get("action", "message")
+        # Nobody is left to read the answers: stop generating them
+        request_ids = list(getattr(self, 'pending_requests', ()))
+        for task in list(getattr(self, 'upstream_tasks', ())):
+            task.cancel()
+        if request_ids:
+            await self.cancel_requests(request_ids)
 
-            if action == "message":
-                await self.handle_message(data)
-            elif action == "llm_to_llm":
-                await self.handle_llm_to_llm(data)
-            elif action == "multi_llm":
-                await self.handle_multi_llm_action(data)
-            else:
-                await self.send(text_data=json.dumps({"error": "Invalid action type"}))
+    async def cancel_requests(self, request_ids):
+        timeout = aiohttp.ClientTimeout(total=settings.LLM_CANCEL_TIMEOUT_S)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                for request_id in request_ids:
+                    async with session.post(f"{settings.LLM_SERVER_URL}/cancel/{request_id}") as response:
+                        logger.info(f"Cancelled LLM request {request_id}: HTTP {response.status}")
+        except Exception as e:
+            logger.warning(f"Failed to cancel LLM requests {request_ids}: {e}")
 
-        except json.JSONDecodeError:
-            logger.error("JSON Decode Error: Invalid message format.")
-            await self.send(text_data=json.dumps({"error": "Invalid message format. Please send a valid JSON."}))
+    def track_request(self):
+        """request_id and deadline fields of an inference call, so disconnect() can cancel it."""
+        request_id = uuid.uuid4().hex
+        self.pending_requests.add(request_id)
+        return {"request_id": request_id, "deadline": time.time() + settings.LLM_REQUEST_DEADLINE_S}
 
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            await self.send(text_data=json.dumps({"error": str(e)}))
+    async def receive(self, text_data):
+        # Handled in a task, so a disconnect is processed while the LLM server is still
+        # working; the lock keeps the messages of one socket in order
+        task = asyncio.create_task(self.dispatch_action(text_data))
+        self.upstream_tasks.add(task)
+        task.add_done_callback(self.upstream_tasks.discard)
+
+    async def dispatch_action(self, text_data):
+        async with self.upstream_lock:
+            try:
+                logger.info(f"Received message: {text_data}")
+                data = json.loads(text_data)
+                action = data.get("action", "message")
+
+                if action == "message":
+                    await self.handle_message(data)
+                elif action == "llm_to_llm":
+                    await self.handle_llm_to_llm(data)
+                elif action == "multi_llm":
+                    await self.handle_multi_llm_action(data)
+                else:
+                    await self.send(text_data=json.dumps({"error": "Invalid action type"}))
+
+            except json.JSONDecodeError:
+                logger.error("JSON Decode Error: Invalid message format.")
+                await self.send(text_data=json.dumps({"error": "Invalid message format. Please send a valid JSON."}))
+
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}")
+                await self.send(text_data=json.dumps({"error": str(e)}))
 
 
     async def handle_multi_llm_action(self, data):
-        MULTI_LLM_URL = "http://10.3.0.96:5000/generate_multi_llm"
+        MULTI_LLM_URL = f"{settings.LLM_SERVER_URL}/generate_multi_llm"
         """
         Handles multi-LLM interaction by sending a POST request to the Flask endpoint.
         Expected JSON format:
@@ -286,12 +325,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # Make a POST request to the Flask API
+        tracking = self.track_request()
         try:
             async with aiohttp.ClientSession() as session:
                 payload = {
                     "selected_personas": selected_personas,
                     "claim": claim,
-                    "iterations": iterations
+                    "iterations": iterations,
+                    **tracking
                 }
                 logger.info(f"Sending Multi-LLM request to {MULTI_LLM_URL} with payload: {payload}")
                 async with session.post(MULTI_LLM_URL, json=payload) as response:
@@ -326,6 +367,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             error_message = f"Error during Multi-LLM interaction: {str(e)}"
             logger.error(error_message)
             await self.send(text_data=json.dumps({"error": error_message}))
+        finally:
+            self.pending_requests.discard(tracking["request_id"])
 
 
     async def handle_message(self, data):
@@ -353,26 +396,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # 2) Send the message to the Flask LLM server
-        llm_url = "http://10.3.0.96:5000/generate"
-        try:
-            async with aiohttp.ClientSession() as session:
-                payload = {"prompt": message, "persona_name": self.persona.name}
-                logger.info(f"Sending request to LLM server at {llm_url} with payload: {payload}")
-                async with session.post(llm_url, json=payload) as response:
-                    if response.status == 200:
-                        try:
-                            llm_data = await response.json()
-                            llm_response = llm_data.get("response", "No response from LLM")
-                            logger.info(f"Received response from LLM server: {llm_response}")
-                        except json.JSONDecodeError as e:
-                            llm_response = f"Error decoding LLM response JSON: {e}"
-                            logger.error(llm_response)
-                    else:
-                        llm_response = f"LLM server returned status {response.status}: {await response.text()}"
-                        logger.error(llm_response)
-        except Exception as e:
-            llm_response = f"Error communicating with LLM server: {e}"
-            logger.error(llm_response)
+        if data.get("stream"):
+            llm_response = await self.stream_llm_response(message)
+        else:
+            llm_response = await self.fetch_llm_response(message)
 
         # 3) Save the LLM's response to the database
         try:
@@ -392,10 +419,74 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # 4) Send the response back to the client
         try:
             logger.info(f"Sending response to client: {llm_response}")
-            await self.send(text_data=json.dumps({"response": llm_response}))
+            await self.send(text_data=json.dumps({"response": llm_response, "done": True}))
         except Exception as e:
             logger.error(f"Failed to send response to client: {e}")
 
+    async def fetch_llm_response(self, message):
+        llm_url = f"{settings.LLM_SERVER_URL}/generate"
+        tracking = self.track_request()
+        try:
+            async with aiohttp.ClientSession() as session:
+                payload = {"prompt": message, "persona_name": self.persona.name, **tracking}
+                logger.info(f"Sending request to LLM server at {llm_url} with payload: {payload}")
+                async with session.post(llm_url, json=payload) as response:
+                    if response.status == 200:
+                        try:
+                            llm_data = await response.json()
+                            llm_response = llm_data.get("response", "No response from LLM")
+                            logger.info(f"Received response from LLM server: {llm_response}")
+                        except json.JSONDecodeError as e:
+                            llm_response = f"Error decoding LLM response JSON: {e}"
+                            logger.error(llm_response)
+                    else:
+                        llm_response = f"LLM server returned status {response.status}: {await response.text()}"
+                        logger.error(llm_response)
+        except Exception as e:
+            llm_response = f"Error communicating with LLM server: {e}"
+            logger.error(llm_response)
+        finally:
+            self.pending_requests.discard(tracking["request_id"])
+        return llm_response
+
+    async def stream_llm_response(self, message):
+        """
+        Relays the server-sent events of /generate_stream to the client, one websocket
+        frame per chunk ({"token": "..."}), and returns the complete response.
+        """
+        llm_url = f"{settings.LLM_SERVER_URL}/generate_stream"
+        llm_response = ""
+        tracking = self.track_request()
+        try:
+            async with aiohttp.ClientSession() as session:
+                payload = {"prompt": message, "persona_name": self.persona.name, **tracking}
+                logger.info(f"Sending streaming request to LLM server at {llm_url} with payload: {payload}")
+                async with session.post(llm_url, json=payload) as response:
+                    if response.status != 200:
+                        llm_response = f"LLM server returned status {response.status}: {await response.text()}"
+                        logger.error(llm_response)
+                        return llm_response
+
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        event = json.loads(line[len("data:"):])
+                        if "token" in event:
+                            llm_response += event["token"]
+                            await self.send(text_data=json.dumps({"token": event["token"]}))
+                        elif "error" in event:
+                            llm_response = f"Error from LLM server: {event['error']}"
+                            logger.error(llm_response)
+                        else:
+                            llm_response = event.get("response", llm_response)
+        except Exception as e:
+            llm_response = f"Error communicating with LLM server: {e}"
+            logger.error(llm_response)
+        finally:
+            self.pending_requests.discard(tracking["request_id"])
+        return llm_response
+
     async def handle_llm_to_llm(self, data):
         prompt_1 = data.get("prompt_1", "").strip()
         prompt_2 = data.get("prompt_2", "").strip()
@@ -408,13 +499,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # Ensure persona_name is included in the payload
-        llm_to_llm_url = "http://10.3.0.96:5000/generate_llm_to_llm"
+        llm_to_llm_url = f"{settings.LLM_SERVER_URL}/generate_llm_to_llm"
+        tracking = self.track_request()
         try:
             payload = {
                 "prompt_1": prompt_1,
                 "prompt_2": prompt_2,
                 "iterations": iterations,
-                "persona_name": self.persona.name  # Include persona_name
+                "persona_name": self.persona.name,  # Include persona_name
+                **tracking
             }
             logger.info(f"Sending LLM-to-LLM request to {llm_to_llm_url} with payload: {payload}")
 
@@ -451,6 +544,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             error_message = f"Error during LLM-to-LLM interaction: {str(e)}"
             logger.error(error_message)
             await self.send(text_data=json.dumps({"error": error_message}))
+        finally:
+            self.pending_requests.discard(tracking["request_id"])
 
 
     @database_sync_to_async
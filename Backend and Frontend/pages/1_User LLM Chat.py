@@ -83,17 +83,24 @@ def fetch_available_llms(token=None):
         st.error(f"Error fetching personas: {e}")
     return []
 
-async def send_message_via_websocket(persona_name, message, token=None):
-    """Sends message via WebSocket and returns the response."""
+async def send_message_via_websocket(persona_name, message, token=None, placeholder=None):
+    """Sends message via WebSocket and returns the response, rendering tokens as they arrive."""
     websocket_uri = f"ws://127.0.0.1:8001/ws/llm/{persona_name}/"
     if token:
         websocket_uri += f"?token={token}"
 
     async with websockets.connect(websocket_uri) as websocket:
-        ws_message = {"persona": persona_name, "message": message}
+        ws_message = {"persona": persona_name, "message": message, "stream": True}
         await websocket.send(json.dumps(ws_message))
-        response = await websocket.recv()
-        return json.loads(response)
+        partial = ""
+        while True:
+            response = json.loads(await websocket.recv())
+            if "token" in response:
+                partial += response["token"]
+                if placeholder is not None:
+                    placeholder.write(f"**Response:** {partial}")
+                continue
+            return response
 
 def user_llm_chat():
     """User-to-LLM chat page."""
@@ -107,14 +114,19 @@ def user_llm_chat():
         if st.button("Send Message"):
             if selected_persona and user_message.strip():
                 try:
+                    placeholder = st.empty()
                     response = asyncio.run(
                         send_message_via_websocket(
                             persona_name=selected_persona,
                             message=user_message,
-                            token=st.session_state.token
+                            token=st.session_state.token,
+                            placeholder=placeholder
                         )
                     )
-                    st.write(f"**Response:** {response.get('response', 'No response')}")
+                    if "error" in response:
+                        st.error(response["error"])
+                    else:
+                        placeholder.write(f"**Response:** {response.get('response', 'No response')}")
                 except Exception as e:
                     st.error(f"Error during WebSocket communication: {e}")
             else:
@@ -1,11 +1,12 @@
 import streamlit as st
 import requests
 import json
+import os
 import asyncio
 import websockets
 
 # Sabitler
-FLASK_API_URL = "http://10.3.0.96:5000/generate_multi_llm"  # Flask API URL
+FLASK_API_URL = os.environ.get("LLM_SERVER_URL", "http://10.3.0.96:5000") + "/generate_multi_llm"  # Flask API URL
 BASE_API_URL = "http://127.0.0.1:8000"  # Base API URL for fetching personas
 
 if "logged_in" not in st.session_state:
@@ -110,7 +111,7 @@ async def send_message_via_websocket(action, selected_personas, claim, token=Non
         response = await websocket.recv()  # Receive response
         return json.loads(response)  # Parse JSON response
 
-def call_multi_llm_api(selected_personas, claim):
+def call_multi_llm_api(selected_personas, claim, iterations=1):
     """
     Sends a POST request to the Flask API to start a multi-LLM interaction.
 
@@ -125,6 +126,7 @@ def call_multi_llm_api(selected_personas, claim):
     payload = {
         "selected_personas": selected_personas,
         "claim": claim,
+        "iterations": iterations,
     }
 
     try:
@@ -159,6 +161,7 @@ def main():
     )
 
     initial_message = st.text_area("Enter the initial message to start the conversation")
+    iterations = st.slider("Number of debate rounds", min_value=1, max_value=5, value=2)
 
     if st.button("Start Interaction"):
         if len(selected_llms) < 2:
@@ -171,13 +174,17 @@ def main():
 
         # Call the Flask API
         with st.spinner("LLMs are interacting..."):
-            result = call_multi_llm_api(selected_llms, initial_message)
+            result = call_multi_llm_api(selected_llms, initial_message, iterations)
 
         if result and "conversation" in result:
             st.markdown("---")
             st.subheader("Conversation Flow")
             conversation = result["conversation"]
+            current_round = None
             for item in conversation:
+                if item.get("round") != current_round:
+                    current_round = item.get("round")
+                    st.markdown(f"#### Round {current_round}")
                 llm_name = item["persona"]  # Update key to match persona field in the response
                 llm_response = item["response"]
                 st.write(f"**{llm_name}**: {llm_response}")
@@ -1,5 +1,26 @@
+import os
 import subprocess
 import time
+import urllib.error
+import urllib.request
+
+# Readiness endpoint of the inference server (or router) that the other services depend on
+LLM_SERVER_URL = os.environ.get("LLM_SERVER_URL", "http://10.3.0.96:5000")
+READY_TIMEOUT_S = float(os.environ.get("READY_TIMEOUT_S", "900"))
+
+
+def wait_until_ready(url, timeout):
+    """Poll /readyz until the model is loaded and the preloaded personas are warm."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/readyz", timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(5)
+    return False
 
 # Commands to run
 commands = [
@@ -18,7 +39,12 @@ try:
         # Start each command as a subprocess
         process = subprocess.Popen(cmd)
         processes.append(process)
-        time.sleep(2)  # Small delay to avoid potential conflicts on startup
+        if cmd[-1] == "flask_api.py":
+            print(f"Waiting for {LLM_SERVER_URL}/readyz...")
+            if not wait_until_ready(LLM_SERVER_URL, READY_TIMEOUT_S):
+                print(f"Inference server not ready after {READY_TIMEOUT_S:.0f}s, starting the rest anyway")
+        else:
+            time.sleep(2)  # Small delay to avoid potential conflicts on startup
 
     # Wait for all processes to complete
     for process in processes:
@@ -0,0 +1,125 @@
+import threading
+
+import torch
+from peft.tuners.lora import LoraLayer
+
+
+class AdapterBank:
+    """
+    Stacked LoRA weights of every resident adapter, applied with gathered batched matmuls.
+
+    For each LoRA-wrapped projection the A and B matrices of all adapters are stacked into
+    contiguous [n_adapters, r, in] and [n_adapters, out, r] tensors (smaller ranks are
+    zero-padded). A mixed batch then computes its LoRA delta as
+
+        delta = bmm(bmm(x, A[ids]^T), B[ids]^T) * scaling[ids]
+
+    with ids holding one adapter index per row, so the cost no longer depends on how many
+    distinct personas the batch contains. PEFT's own per-adapter path stays in place for
+    forwards that do not go through the bank.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._installed_on = None
+        self._layers = {}  # module name -> LoraLayer
+        self._stacks = {}  # module name -> (A, B, scaling)
+        self._index = {}  # adapter name -> row in the stacks
+        self._row_ids = None
+        self._dirty = True
+        self._lock = threading.RLock()
+        self._counters = {"rebuilds": 0, "forwards": 0}
+        registry.add_listener(self.invalidate)
+
+    def invalidate(self, *args):
+        self._dirty = True
+
+    def _install(self, peft_model):
+        """Patch every LoraLayer not patched yet; adapters loaded later may wrap new modules."""
+        if self._installed_on is not peft_model:
+            self._layers = {}
+            self._installed_on = peft_model
+        for name, module in peft_model.named_modules():
+            if isinstance(module, LoraLayer) and self._layers.get(name) is not module:
+                module.forward = self._make_forward(name, module)
+                self._layers[name] = module
+
+    def _make_forward(self, name, module):
+        original_forward = type(module).forward
+
+        def forward(x, *args, **kwargs):
+            if self._row_ids is None:
+                return original_forward(module, x, *args, **kwargs)
+            return self._gathered_forward(name, module, x)
+
+        return forward
+
+    def _rebuild(self, peft_model):
+        self._install(peft_model)
+        adapter_names = self.registry.resident_adapters()
+        self._index = {adapter_name: i for i, adapter_name in enumerate(adapter_names)}
+        self._stacks = {}
+
+        for name, module in self._layers.items():
+            present = [a for a in adapter_names if a in module.lora_A]
+            if not present:
+                continue
+            reference_a = module.lora_A[present[0]].weight
+            reference_b = module.lora_B[present[0]].weight
+            max_rank = max(module.r[a] for a in present)
+
+            A = reference_a.new_zeros(len(adapter_names), max_rank, reference_a.shape[1])
+            B = reference_b.new_zeros(len(adapter_names), reference_b.shape[0], max_rank)
+            scaling = reference_a.new_zeros(len(adapter_names))
+            for adapter_name in present:
+                i, rank = self._index[adapter_name], module.r[adapter_name]
+                A[i, :rank] = module.lora_A[adapter_name].weight
+                B[i, :, :rank] = module.lora_B[adapter_name].weight
+                scaling[i] = module.scaling[adapter_name]
+            self._stacks[name] = (A, B, scaling)
+
+        self._dirty = False
+        self._counters["rebuilds"] += 1
+
+    def _gathered_forward(self, name, module, x):
+        result = module.base_layer(x)
+        if name not in self._stacks:
+            return result
+
+        A, B, scaling = self._stacks[name]
+        ids = self._row_ids.to(A.device)
+        xa = torch.bmm(x.to(A.dtype), A.index_select(0, ids).transpose(1, 2))
+        delta = torch.bmm(xa, B.index_select(0, ids).transpose(1, 2))
+        delta = delta * scaling.index_select(0, ids)[:, None, None]
+        return result + delta.to(result.dtype)
+
+    def forward(self, adapter_names, **inputs):
+        """Run the model with one adapter per batch row, taking the gathered LoRA path."""
+        peft_model = self.registry.peft_model
+        with self._lock:
+            if self._installed_on is not peft_model:
+                self._dirty = True
+            if self._dirty:
+                self._rebuild(peft_model)
+
+            self._row_ids = torch.tensor(
+                [self._index[adapter_name] for adapter_name in adapter_names],
+                dtype=torch.long,
+                device=next(iter(self._stacks.values()))[0].device,
+            )
+            try:
+                self._counters["forwards"] += 1
+                return peft_model(**inputs)
+            finally:
+                self._row_ids = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "adapters": list(self._index),
+                "layers": len(self._stacks),
+                "stacked_bytes": sum(
+                    t.numel() * t.element_size() for stack in self._stacks.values() for t in stack
+                ),
+            }
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from peft import PeftConfig, PeftModelForCausalLM, load_peft_weights, set_peft_model_state_dict
+
+from profiling import span
+
+
+class AdapterRegistry:
+    """
+    Process-wide registry of persona LoRA adapters attached to a single PeftModel.
+
+    Each adapter is read from disk once and stays resident until it is evicted.
+    Eviction is LRU and only touches adapters that are not pinned by an in-flight
+    request. The budget is expressed in megabytes of adapter parameters and/or a
+    maximum number of resident adapters.
+
+    Adapter files are read without holding the model lock, which only guards attaching
+    the loaded weights, so a cold persona does not stall the requests already decoding.
+    """
+
+    def __init__(self, base_model, path_template, memory_budget_mb=None, max_adapters=None):
+        self.base_model = base_model
+        self.path_template = path_template
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024) if memory_budget_mb else None
+        self.max_adapters = max_adapters
+        self.peft_model = None
+
+        # Guards attaching/evicting adapters and forward passes on the shared PeftModel
+        self.lock = threading.RLock()
+
+        self._resident = OrderedDict()  # adapter_name -> size in bytes, ordered by recency
+        self._listeners = []  # called as fn(event, adapter_name) on "loaded" / "evicted"
+        self.load_seconds = {}  # adapter_name -> duration of its most recent load
+        self._pins = {}
+        self._loading = {}  # adapter_name -> Event set once its load finished or failed
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "load_failures": 0,
+            "load_time_total": 0.0,
+            "load_time_max": 0.0,
+        }
+
+    def _adapter_size(self, adapter_name):
+        marker = f".{adapter_name}."
+        return sum(
+            p.numel() * p.element_size()
+            for n, p in self.peft_model.named_parameters()
+            if marker in n
+        )
+
+    def _load(self, adapter_name):
+        """Read the adapter from disk, then attach and pin it under the model lock."""
+        path = self.path_template.format(adapter_name)
+        start = time.time()
+        try:
+            # PEFT would take a missing directory for a hub repo id and retry downloads
+            if not os.path.isfile(os.path.join(path, "adapter_config.json")):
+                raise FileNotFoundError(f"no adapter_config.json in {path}")
+            with span("adapter_load", persona=adapter_name):
+                config = PeftConfig.from_pretrained(path)
+                config.inference_mode = True
+                weights = load_peft_weights(path, device="cpu")
+                with self.lock:
+                    if self.peft_model is None:
+                        self.peft_model = PeftModelForCausalLM(self.base_model, config, adapter_name=adapter_name)
+                    else:
+                        self.peft_model.add_adapter(adapter_name, config)
+                    set_peft_model_state_dict(self.peft_model, weights, adapter_name=adapter_name)
+                    self.peft_model.eval()
+        except Exception as e:
+            with self.lock:
+                self._counters["load_failures"] += 1
+            raise ValueError(f"Adapter '{adapter_name}' could not be loaded. Ensure it exists. Error: {str(e)}")
+
+        elapsed = time.time() - start
+        with self.lock:
+            self._counters["load_time_total"] += elapsed
+            self._counters["load_time_max"] = max(self._counters["load_time_max"], elapsed)
+            self.load_seconds[adapter_name] = elapsed
+            self._resident[adapter_name] = self._adapter_size(adapter_name)
+            self._pins[adapter_name] = self._pins.get(adapter_name, 0) + 1
+            self._notify("loaded", adapter_name)
+
+    def _pin(self, adapter_name):
+        while True:
+            with self.lock:
+                if adapter_name in self._resident:
+                    self._counters["hits"] += 1
+                    self._resident.move_to_end(adapter_name)
+                    self._pins[adapter_name] = self._pins.get(adapter_name, 0) + 1
+                    return
+                loading = self._loading.get(adapter_name)
+                if loading is None:
+                    self._counters["misses"] += 1
+                    loading = self._loading[adapter_name] = threading.Event()
+                    break
+            # Another request is loading it; check again once that load is done
+            loading.wait()
+
+        try:
+            self._load(adapter_name)
+        finally:
+            with self.lock:
+                del self._loading[adapter_name]
+            loading.set()
+
+    def _over_budget(self):
+        if self.max_adapters and len(self._resident) > self.max_adapters:
+            return True
+        if self.memory_budget_bytes and sum(self._resident.values()) > self.memory_budget_bytes:
+            return True
+        return False
+
+    def _evict(self):
+        # PEFT needs at least one adapter attached, so the last one always stays
+        for adapter_name in list(self._resident):
+            if not self._over_budget() or len(self._resident) <= 1:
+                break
+            if self._pins.get(adapter_name):
+                continue
+            self.peft_model.delete_adapter(adapter_name)
+            del self._resident[adapter_name]
+            self._counters["evictions"] += 1
+            self._notify("evicted", adapter_name)
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def _notify(self, event, adapter_name):
+        for fn in self._listeners:
+            fn(event, adapter_name)
+
+    def acquire(self, *adapter_names):
+        """Make sure the adapters are resident and pin them until release() is called."""
+        pinned = []
+        try:
+            for adapter_name in adapter_names:
+                self._pin(adapter_name)
+                pinned.append(adapter_name)
+        except Exception:
+            self.release(*pinned)
+            raise
+        with self.lock:
+            self._evict()
+            return self.peft_model
+
+    def release(self, *adapter_names):
+        with self.lock:
+            for adapter_name in adapter_names:
+                count = self._pins.get(adapter_name, 0) - 1
+                if count > 0:
+                    self._pins[adapter_name] = count
+                else:
+                    self._pins.pop(adapter_name, None)
+            self._evict()
+
+    @contextmanager
+    def use(self, *adapter_names):
+        """Pin the adapters and hold the model lock for the duration of the block."""
+        peft_model = self.acquire(*adapter_names)
+        try:
+            with self.lock:
+                yield peft_model
+        finally:
+            self.release(*adapter_names)
+
+    def resident_adapters(self):
+        with self.lock:
+            return list(self._resident)
+
+    def stats(self):
+        with self.lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            loads = self._counters["misses"] - self._counters["load_failures"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+                "load_time_avg": self._counters["load_time_total"] / loads if loads else 0.0,
+                "resident": list(self._resident),
+                "resident_bytes": sum(self._resident.values()),
+                "pinned": {k: v for k, v in self._pins.items() if v},
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "max_adapters": self.max_adapters,
+            }
@@ -0,0 +1,121 @@
+import threading
+
+import torch
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised by submit() for a request that could not fit even into an idle server."""
+
+
+def dtype_bytes(dtype):
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    return torch.empty(0, dtype=dtype).element_size()
+
+
+def available_memory(device):
+    """Bytes this process could still allocate on device: free CUDA memory, or MemAvailable."""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("Cannot determine available memory; set MEMORY_BUDGET_MB")
+
+
+class MemoryAdmission:
+    """
+    Admits generation requests against a memory budget shared by the schedulers using it.
+
+    A request's footprint is estimated from the model config: its KV cache holds
+    prompt + max_new_tokens positions in every layer (plus the padding the batch may add
+    around it), and is reserved from admission until the request finishes. Prefilling
+    also needs transient activations, dominated by the full-sequence logits and the
+    attention scores, which must fit next to the reservations while the admitted
+    requests prefill. Requests that do not fit are handed back to the scheduler, which
+    retries them at the next step boundary, so they are delayed instead of failing.
+    The estimates apply to CPU RAM just as well as to GPU memory.
+    """
+
+    def __init__(self, config, budget_bytes, kv_dtype, padding_overhead=0.25):
+        text_config = getattr(config, "text_config", config)
+        self.budget_bytes = int(budget_bytes)
+        self.padding_overhead = padding_overhead
+        self.dtype_bytes = dtype_bytes(kv_dtype)
+
+        layers = text_config.num_hidden_layers
+        self.num_heads = text_config.num_attention_heads
+        kv_heads = getattr(text_config, "num_key_value_heads", None) or self.num_heads
+        head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // self.num_heads
+        self.kv_bytes_per_token = 2 * layers * kv_heads * head_dim * self.dtype_bytes
+        # Hidden states and MLP intermediates of one layer, plus the logits over the
+        # vocabulary, which are computed (and upcast to fp32) for every prompt position
+        self.activation_bytes_per_token = (
+            (4 * text_config.hidden_size + 2 * text_config.intermediate_size) * self.dtype_bytes
+            + text_config.vocab_size * (self.dtype_bytes + 4)
+        )
+
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._counters = {"admitted": 0, "deferred": 0, "rejected": 0, "peak_reserved_bytes": 0}
+
+    def estimate(self, request):
+        """(KV cache bytes held until the request finishes, transient prefill bytes)."""
+        prompt = len(request.input_ids)
+        cached = request.prefix_cache[0][0].shape[2] if request.prefix_cache is not None else 0
+        kv = (prompt + request.max_new_tokens) * self.kv_bytes_per_token * (1 + self.padding_overhead)
+        prefill = prompt - cached
+        attention_scores = self.num_heads * prefill * prompt * self.dtype_bytes
+        return int(kv), prefill * self.activation_bytes_per_token + attention_scores
+
+    def check(self, request):
+        kv, activations = self.estimate(request)
+        if kv + activations > self.budget_bytes:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise MemoryBudgetExceeded(
+                f"Request needs about {(kv + activations) / 2**20:.0f} MB, more than the "
+                f"{self.budget_bytes / 2**20:.0f} MB memory budget; shorten the prompt or max_new_tokens"
+            )
+
+    def admit(self, requests):
+        """Split requests into (admitted, deferred), reserving memory for the admitted ones."""
+        admitted, deferred = [], []
+        with self._lock:
+            activations = 0
+            for r in requests:
+                kv, prefill = self.estimate(r)
+                fits = self._reserved + kv + activations + prefill <= self.budget_bytes
+                # An idle server always takes the first request; check() rejected any that cannot fit
+                if fits or (self._reserved == 0 and not admitted):
+                    self._reserved += kv
+                    r.reserved_bytes = kv
+                    activations += prefill
+                    admitted.append(r)
+                else:
+                    # Deferred requests are retried every step; count each one once
+                    if not r.deferred:
+                        r.deferred = True
+                        self._counters["deferred"] += 1
+                    deferred.append(r)
+            self._counters["admitted"] += len(admitted)
+            self._counters["peak_reserved_bytes"] = max(self._counters["peak_reserved_bytes"], self._reserved)
+        return admitted, deferred
+
+    def release(self, request):
+        with self._lock:
+            self._reserved -= request.reserved_bytes
+            request.reserved_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "budget_bytes": self.budget_bytes,
+                "reserved_bytes": self._reserved,
+                "reserved_ratio": self._reserved / self.budget_bytes if self.budget_bytes else 0.0,
+                "kv_bytes_per_token": self.kv_bytes_per_token,
+                "activation_bytes_per_token": self.activation_bytes_per_token,
+            }
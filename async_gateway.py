@@ -0,0 +1,215 @@
+"""
+asyncio front end for the inference server.
+
+Loads the same model, adapter registry and batch scheduler as flask_api.py, but serves
+them from an aiohttp event loop so thousands of waiting clients cost a coroutine each
+instead of a WSGI worker thread. The bounded scheduler queue is the only place requests
+wait: when it is full the gateway answers 429, and requests that outlive their timeout
+get 503, both with a Retry-After hint. A request past its client-set deadline gets 504,
+without one.
+
+/generate takes the same fields and goes through the same helpers as the Flask
+endpoint: cancel scopes (POST /cancel/<request_id>), metrics (GET /metrics), the
+persona prefix cache and the opt-in response cache. Only per-request profiling is
+Flask-only.
+
+Run with: python async_gateway.py
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from aiohttp import web
+
+import flask_api
+from admission import MemoryBudgetExceeded
+from batch_scheduler import GenerationRequest, QueueFullError, RequestCancelled
+
+GATEWAY_HOST = os.environ.get("GATEWAY_HOST", "0.0.0.0")
+GATEWAY_PORT = int(os.environ.get("GATEWAY_PORT", "5001"))
+
+scheduler = flask_api.batch_scheduler
+tokenizer = flask_api.tokenizer
+
+
+def busy_response(message, status, retry_after=None):
+    retry_after = retry_after or scheduler.retry_after()
+    return web.json_response(
+        {"error": message, "retry_after": retry_after},
+        status=status,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def timeout_response(message, deadline):
+    if deadline is not None and time.time() >= deadline:
+        return web.json_response({"error": message}, status=504)
+    return busy_response(message, 503)
+
+
+async def wait_for_request(gen_request, timeout):
+    """Await a scheduler request without tying up an executor thread."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(request):
+        if not future.done():
+            future.set_result(request)
+
+    gen_request.add_done_callback(lambda request: loop.call_soon_threadsafe(resolve, request))
+    return await asyncio.wait_for(future, timeout)
+
+
+async def home(request):
+    return web.Response(text="Async inference gateway is running!")
+
+
+async def healthz(request):
+    return web.json_response({"status": "alive"})
+
+
+async def readyz(request):
+    ready = flask_api.startup_status["state"] == "ready"
+    return web.json_response(
+        {
+            "ready": ready,
+            "state": flask_api.startup_status["state"],
+            "adapters": dict(flask_api.startup_status["adapters"]),
+            "queue_depth": scheduler.queue_depth(),
+        },
+        status=200 if ready else 503,
+    )
+
+
+async def queue_status(request):
+    return web.json_response({
+        "queue_depth": scheduler.queue_depth(),
+        "max_queue_size": scheduler.max_queue_size,
+        "active": scheduler.stats()["active"],
+        "retry_after": scheduler.retry_after(),
+    })
+
+
+def open_cancel_scope(data, deadline):
+    """Same bookkeeping as the Flask endpoint: cancellable by request_id, tracked in metrics."""
+    def on_submit(gen_request):
+        flask_api.metrics.track(gen_request, "generate")
+
+    def on_reject(gen_request, error):
+        flask_api.metrics.reject(gen_request, "generate", error)
+
+    return flask_api.cancel_scopes.open(
+        data.get("request_id") or uuid.uuid4().hex, deadline, on_submit=on_submit, on_reject=on_reject
+    )
+
+
+async def cancel(request):
+    request_id = request.match_info["request_id"]
+    cancelled = flask_api.cancel_scopes.cancel(request_id)
+    return web.json_response({"request_id": request_id, "cancelled": cancelled}, status=200 if cancelled else 404)
+
+
+async def prometheus_metrics(request):
+    return web.Response(text=flask_api.metrics.render(), content_type="text/plain")
+
+
+async def generate(request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({"error": "Invalid JSON format"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"error": "Invalid JSON format"}, status=400)
+
+    prompt = str(data.get("prompt") or "").strip()
+    persona_name = str(data.get("persona_name") or "").strip()
+    if not prompt:
+        return web.json_response({"error": "No prompt provided"}, status=400)
+    if not persona_name:
+        return web.json_response({"error": "No persona name provided"}, status=400)
+    try:
+        deadline, timeout = flask_api.request_limits(data)
+        params = flask_api.sampling_params(data)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    loop = asyncio.get_running_loop()
+    cache_key = flask_api.response_cache_key(data, persona_name, prompt, params)
+    if cache_key is not None:
+        # The shared tier is a Redis round trip
+        cached = await loop.run_in_executor(None, flask_api.response_cache.get, cache_key)
+        if cached is not None:
+            return web.json_response({"response": cached, "cached": True})
+
+    def submit():
+        input_ids = flask_api.build_persona_input(prompt)
+        return scope.submit(
+            GenerationRequest(
+                persona_name,
+                input_ids,
+                timeout=timeout,
+                prefix_cache=flask_api.cached_persona_prefix(persona_name, input_ids),
+                **params,
+            )
+        )
+
+    scope = open_cancel_scope(data, deadline)
+    try:
+        try:
+            # submit() may read the adapter from disk or prefill the persona prefix
+            gen_request = await loop.run_in_executor(None, submit)
+        except QueueFullError as e:
+            return busy_response(str(e), 429, e.retry_after)
+        except MemoryBudgetExceeded as e:
+            return web.json_response({"error": str(e)}, status=413)
+        except RequestCancelled as e:
+            return web.json_response({"error": str(e)}, status=499)
+        except ValueError as e:
+            return web.json_response({"error": f"Invalid persona: {persona_name}. {str(e)}"}, status=400)
+
+        try:
+            await wait_for_request(gen_request, timeout + 1.0)
+        except asyncio.TimeoutError:
+            return timeout_response(f"Generation request {gen_request.id} timed out", deadline)
+        # A client that disconnects cancels this task; closing the scope below frees its
+        # batch slot at the next step
+
+        if isinstance(gen_request.error, TimeoutError):
+            return timeout_response(str(gen_request.error), deadline)
+        if isinstance(gen_request.error, RequestCancelled):
+            return web.json_response({"error": str(gen_request.error)}, status=499)
+        if isinstance(gen_request.error, MemoryBudgetExceeded):
+            # Pooled requests are checked against the budget inside their worker
+            return web.json_response({"error": str(gen_request.error)}, status=413)
+        if gen_request.error is not None:
+            return web.json_response({"error": str(gen_request.error)}, status=500)
+
+        generated_text = tokenizer.decode(gen_request.output_ids, skip_special_tokens=True).strip()
+        if cache_key is not None:
+            await loop.run_in_executor(None, flask_api.response_cache.put, cache_key, generated_text)
+        return web.json_response({
+            "response": generated_text,
+            "finish_reason": gen_request.finish_reason,
+            "usage": gen_request.usage(),
+        })
+    finally:
+        flask_api.cancel_scopes.close(scope)
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/queue", queue_status)
+    app.router.add_post("/generate", generate)
+    app.router.add_post("/cancel/{request_id}", cancel)
+    app.router.add_get("/metrics", prometheus_metrics)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=GATEWAY_HOST, port=GATEWAY_PORT)
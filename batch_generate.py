@@ -0,0 +1,75 @@
+"""
+Run a JSONL file of prompts through the server's /generate_batch endpoint.
+
+    python batch_generate.py --input prompts.jsonl --output responses.jsonl --url http://127.0.0.1:5000
+
+Every input line is a record {"persona_name": ..., "prompt": ..., "id": ...} with optional
+max_new_tokens, do_sample, temperature, top_p and seed. The server schedules the whole
+file in full batches grouped by persona and prompt length, and results are written to
+--output as they complete (in completion order; "index" is the input line number).
+
+The job id defaults to a hash of the input file, so if the connection drops or the
+server restarts, running the same command again resumes the job: finished records are
+not generated again, failed ones are retried, and --output is rewritten with every
+result. A retried record appears once per attempt; its last line is the one that counts.
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+
+import requests
+
+
+def default_job_id(path):
+    with open(path, "rb") as f:
+        return "batch-" + hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="JSONL file of records")
+    parser.add_argument("--output", required=True, help="JSONL file the results are written to")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--job-id", help="Defaults to a hash of the input file")
+    args = parser.parse_args()
+
+    job_id = args.job_id or default_job_id(args.input)
+    with open(args.input, encoding="utf-8") as f:
+        body = f.read()
+
+    response = requests.post(
+        f"{args.url}/generate_batch",
+        params={"job_id": job_id},
+        data=body.encode("utf-8"),
+        headers={"Content-Type": "application/x-ndjson"},
+        stream=True,
+    )
+    if response.status_code != 200:
+        sys.exit(f"Server returned {response.status_code}: {response.text}")
+
+    print(f"Job {job_id}")
+    status = None
+    with open(args.output, "w", encoding="utf-8") as out:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            event = json.loads(line)
+            if "index" in event:
+                out.write(line + "\n")
+                out.flush()
+                marker = "error" if "error" in event else event.get("finish_reason")
+                print(f"  record {event['index']}: {marker}")
+            elif "status" in event:
+                status = event["status"]
+            else:
+                print(f"  {event['total']} records")
+
+    if status is None:
+        sys.exit(f"Connection closed before the job finished; run again to resume job {job_id}")
+    print(json.dumps(status, indent=2))
+
+
+if __name__ == "__main__":
+    main()
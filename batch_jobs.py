@@ -0,0 +1,249 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+from batch_scheduler import QueueFullError
+
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class BatchJob:
+    """
+    An offline generation job: a list of records, run through the shared scheduler.
+
+    Records are submitted ordered by persona and prompt length, so the rows decoded
+    together mostly share an adapter and need little padding, and never more than
+    max_in_flight at a time, so interactive requests still find room in the batch.
+    Every result is appended to <job_dir>/<job_id>.jsonl the moment it completes, which
+    is also what makes the job resumable: records with a successful result are not run
+    again, failed ones are retried.
+    """
+
+    def __init__(self, job_id, records, job_dir):
+        self.job_id = job_id
+        self.records = records
+        self.input_path = os.path.join(job_dir, f"{job_id}.input.jsonl")
+        self.output_path = os.path.join(job_dir, f"{job_id}.jsonl")
+        self.lines = []  # result lines in completion order, including earlier runs
+        self.started_at = time.time()
+        self.finished_at = None
+        self.cancelled = False
+        self._in_flight = {}
+        self._changed = threading.Condition()
+        # Progress by the latest result of every index, kept up to date as results arrive
+        self._outcomes = {}  # index -> (succeeded, generated tokens)
+        self._counts = {"completed": 0, "failed": 0, "generated_tokens": 0}
+
+        if os.path.isfile(self.output_path):
+            with open(self.output_path, encoding="utf-8") as f:
+                self.lines = [line.rstrip("\n") for line in f if line.strip()]
+            for line in self.lines:
+                self._count(json.loads(line))
+        else:
+            with open(self.input_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def remaining(self):
+        return [i for i in range(len(self.records)) if not self._outcomes.get(i, (False, 0))[0]]
+
+    def _count(self, result):
+        previous = self._outcomes.get(result["index"])
+        if previous is not None:
+            self._counts["completed" if previous[0] else "failed"] -= 1
+            self._counts["generated_tokens"] -= previous[1]
+        succeeded = "error" not in result
+        tokens = result.get("usage", {}).get("generated_tokens", 0)
+        self._outcomes[result["index"]] = (succeeded, tokens)
+        self._counts["completed" if succeeded else "failed"] += 1
+        self._counts["generated_tokens"] += tokens
+
+    def follow(self, start=0):
+        """Yield result lines from position start on, waiting for new ones until the job ends."""
+        position = start
+        while True:
+            with self._changed:
+                while position >= len(self.lines) and not self.finished:
+                    self._changed.wait()
+                new_lines = self.lines[position:]
+                finished = self.finished
+            for line in new_lines:
+                yield line
+            position += len(new_lines)
+            if finished and position >= len(self.lines):
+                return
+
+    def _record_result(self, result):
+        line = json.dumps(result, ensure_ascii=False)
+        with open(self.output_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        with self._changed:
+            self.lines.append(line)
+            self._count(result)
+            self._changed.notify_all()
+
+    def _finish(self):
+        with self._changed:
+            self.finished_at = time.time()
+            self._changed.notify_all()
+
+    def status(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        with self._changed:
+            counts = dict(self._counts)
+        return {
+            "job_id": self.job_id,
+            "total": len(self.records),
+            "completed": counts["completed"],
+            "failed": counts["failed"],
+            "in_flight": len(self._in_flight),
+            "finished": self.finished,
+            "cancelled": self.cancelled,
+            "elapsed_s": round(elapsed, 3),
+            "generated_tokens": counts["generated_tokens"],
+        }
+
+
+class BatchJobManager:
+    """
+    Runs BatchJobs on a thread each, next to interactive traffic on the same scheduler.
+
+    make_request(record) turns a record into a GenerationRequest (or raises ValueError);
+    on_submit(request) is called before each submit, e.g. for metrics.
+    """
+
+    def __init__(self, scheduler, tokenizer, make_request, job_dir="batch_jobs", max_in_flight=8, on_submit=None):
+        self.scheduler = scheduler
+        self.tokenizer = tokenizer
+        self.make_request = make_request
+        self.job_dir = job_dir
+        self.max_in_flight = max_in_flight
+        self.on_submit = on_submit
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(job_dir, exist_ok=True)
+
+    def start(self, records=None, job_id=None):
+        """
+        Start a job, or resume one: a job_id that is already running is returned as is,
+        and one with results on disk continues with the records it has not finished.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        if not JOB_ID_PATTERN.match(job_id):
+            raise ValueError("job_id may only contain letters, digits, '-' and '_' (at most 64)")
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and not job.finished:
+                return job
+            # A resumed job keeps its original records, so result indices stay valid
+            records = self._stored_records(job_id) or records
+            if not records:
+                raise ValueError("No records to generate")
+            job = BatchJob(job_id, records, self.job_dir)
+            self._jobs[job_id] = job
+
+        threading.Thread(target=self._run, args=(job,), name=f"batch-job-{job_id}", daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        """Running or finished job, resumed from disk if the server restarted meanwhile."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        if JOB_ID_PATTERN.match(job_id) and os.path.isfile(os.path.join(self.job_dir, f"{job_id}.input.jsonl")):
+            return self.start(job_id=job_id)
+        return None
+
+    def cancel(self, job_id):
+        """Stop a running job; a job that only exists on disk is marked cancelled, not resumed."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                records = self._stored_records(job_id) if JOB_ID_PATTERN.match(job_id) else None
+                if records is None:
+                    return None
+                job = BatchJob(job_id, records, self.job_dir)
+                job._finish()
+                self._jobs[job_id] = job
+        job.cancelled = True
+        for request in list(job._in_flight.values()):
+            self.scheduler.cancel(request)
+        return job
+
+    def _stored_records(self, job_id):
+        path = os.path.join(self.job_dir, f"{job_id}.input.jsonl")
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _run(self, job):
+        # Same persona next to each other, then similar prompt lengths
+        order = sorted(
+            job.remaining(),
+            key=lambda i: (str(job.records[i].get("persona_name", "")), len(str(job.records[i].get("prompt", "")))),
+        )
+        completions = queue.Queue()
+
+        def submit(index):
+            record = job.records[index]
+            try:
+                request = self.make_request(record)
+                if self.on_submit is not None:
+                    self.on_submit(request)
+                while True:
+                    try:
+                        self.scheduler.submit(request)
+                        break
+                    except QueueFullError as e:
+                        # Interactive traffic has the queue full: back off instead of failing
+                        if job.cancelled:
+                            return
+                        time.sleep(min(e.retry_after, 5))
+            except Exception as e:
+                job._record_result({"index": index, "id": record.get("id"), "error": str(e)})
+                return
+            job._in_flight[index] = request
+            request.add_done_callback(lambda r: completions.put(index))
+
+        try:
+            for index in order:
+                if job.cancelled:
+                    break
+                while len(job._in_flight) >= self.max_in_flight:
+                    self._collect(job, completions.get())
+                submit(index)
+            while job._in_flight:
+                self._collect(job, completions.get())
+        finally:
+            job._finish()
+
+    def _collect(self, job, index):
+        request = job._in_flight.pop(index)
+        record = job.records[index]
+        result = {"index": index, "id": record.get("id"), "persona_name": request.adapter_name}
+        if request.error is not None:
+            result["error"] = str(request.error)
+        else:
+            result["response"] = self.tokenizer.decode(request.output_ids, skip_special_tokens=True).strip()
+            result["finish_reason"] = request.finish_reason
+            result["usage"] = request.usage()
+        job._record_result(result)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "max_in_flight": self.max_in_flight,
+            "jobs": [job.status() for job in jobs],
+        }
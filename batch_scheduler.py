@@ -0,0 +1,625 @@
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+
+import torch
+import transformers
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+def to_model_cache(past):
+    """
+    DynamicCache holding legacy (key, value) tuples, or an empty one for past=None.
+
+    Always passed explicitly: left to itself, Gemma-2 allocates a HybridCache, whose
+    fixed-size layers the batch cannot be padded, trimmed or merged in.
+    """
+    if not hasattr(DynamicCache, "from_legacy_cache"):
+        raise RuntimeError(
+            f"transformers {transformers.__version__} has no DynamicCache.from_legacy_cache; "
+            "install the versions pinned in requirements.txt"
+        )
+    return DynamicCache.from_legacy_cache(past)
+
+
+def from_model_cache(past):
+    if isinstance(past, DynamicCache):
+        return past.to_legacy_cache()
+    if isinstance(past, tuple):
+        return past
+    raise TypeError(
+        f"The model returned a {type(past).__name__} cache; the scheduler only handles DynamicCache "
+        "(check the transformers version against requirements.txt)"
+    )
+
+
+def _left_pad_past(past, length):
+    """Left-pad every layer's key/value tensors to `length` positions."""
+    padded = []
+    for key, value in past:
+        pad = length - key.shape[2]
+        if pad > 0:
+            key = torch.cat([key.new_zeros(key.shape[0], key.shape[1], pad, key.shape[3]), key], dim=2)
+            value = torch.cat([value.new_zeros(value.shape[0], value.shape[1], pad, value.shape[3]), value], dim=2)
+        padded.append((key, value))
+    return tuple(padded)
+
+
+def _left_pad_mask(mask, length):
+    pad = length - mask.shape[1]
+    if pad > 0:
+        mask = torch.cat([mask.new_zeros(mask.shape[0], pad), mask], dim=1)
+    return mask
+
+
+def length_buckets(requests, length, max_padding_ratio):
+    """
+    Split requests into groups of similar length for separate padded forwards.
+
+    Requests are sorted by length and a group is closed as soon as adding the next one
+    would make padding more than max_padding_ratio of the group's padded tokens.
+    """
+    buckets = []
+    for r in sorted(requests, key=length):
+        if buckets:
+            bucket = buckets[-1]
+            padded = length(r) * (len(bucket) + 1)
+            real = sum(length(b) for b in bucket) + length(r)
+            if (padded - real) / padded <= max_padding_ratio:
+                bucket.append(r)
+                continue
+        buckets.append([r])
+    return buckets
+
+
+class QueueFullError(Exception):
+    """Raised by submit() when the waiting queue is at capacity."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class RequestCancelled(Exception):
+    """Stored on a request that was cancelled before it finished."""
+
+
+class GenerationRequest:
+    """A single prompt waiting for, or undergoing, generation in the scheduler."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, adapter_name, input_ids, max_new_tokens=256, do_sample=False, temperature=1.0, top_p=1.0,
+                 stream=False, timeout=None, prefix_cache=None, return_cache=False, seed=None, deadline=None,
+                 stop_on_repetition=True):
+        self.id = next(self._ids)
+        self.adapter_name = adapter_name
+        self.input_ids = list(input_ids)
+        # Legacy (key, value) tuples covering a prefix of input_ids, e.g. an earlier dialogue turn
+        self.prefix_cache = prefix_cache
+        self.return_cache = return_cache
+        self.cache = None
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.seed = seed
+        self.stop_on_repetition = stop_on_repetition
+        self._generator = None
+
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        # Absolute time after which generation stops: the earlier of timeout and deadline
+        self.deadline = self.submitted_at + timeout if timeout else None
+        if deadline is not None:
+            self.deadline = min(self.deadline or deadline, deadline)
+        self.cancelled = False
+        self.reserved_bytes = 0  # memory held for this request by admission control
+        self.deferred = False  # held back by admission control at least once
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        # Token ids are pushed here as they are produced, followed by a None sentinel
+        self._tokens = queue.Queue() if stream else None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def usage(self):
+        return {"prompt_tokens": len(self.input_ids), "generated_tokens": len(self.output_ids)}
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.time()) > self.deadline
+
+    def cancel(self):
+        """Ask the scheduler to drop this request at its next step boundary."""
+        self.cancelled = True
+
+    def add_done_callback(self, fn):
+        """Call fn(request) from the scheduler thread once the request finishes."""
+        with self._callbacks_lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _append(self, token_id):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.output_ids.append(token_id)
+        if self._tokens is not None:
+            self._tokens.put(token_id)
+
+    def _finish(self, reason, error=None):
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self._tokens is not None:
+            self._tokens.put(None)
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.error(f"Done callback for request {self.id} failed: {e}")
+
+    def stream(self):
+        """Yield generated token ids as soon as the scheduler produces them."""
+        if self._tokens is None:
+            raise ValueError("Request was not submitted with stream=True")
+        while True:
+            token_id = self._tokens.get()
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    def result(self, timeout=None):
+        """Block until generation finishes and return the generated token ids."""
+        if timeout is None and self.deadline is not None:
+            # Leave the scheduler a moment to report the timeout itself
+            timeout = max(self.deadline - time.time(), 0) + 1.0
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Generation request {self.id} did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+class ContinuousBatchScheduler:
+    """
+    Background decode loop shared by every generation request on the server.
+
+    Waiting requests are admitted at step boundaries: their prompts are prefilled in one
+    left-padded forward pass and the resulting KV caches are merged into the running batch.
+    Each step then decodes one token for all active rows with a single multi-adapter
+    forward, and rows that hit EOS or their token limit leave the batch right away.
+
+    With an admission controller, requests whose KV cache would not fit into its memory
+    budget next to the running batch wait in a deferred list and are retried, ahead of
+    newer arrivals, at every step boundary.
+
+    With a repetition detector, rows whose output has fallen into a loop are finished
+    early with finish_reason "repetition" instead of decoding up to max_new_tokens.
+    """
+
+    def __init__(self, registry, tokenizer, device, eos_token_ids, max_batch_size=8, max_queue_size=64,
+                 adapter_bank=None, max_padding_ratio=0.25, admission=None, repetition=None):
+        self.registry = registry
+        self.adapter_bank = adapter_bank
+        self.tokenizer = tokenizer
+        self.device = device
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.max_padding_ratio = max_padding_ratio
+        self.pad_token_id = tokenizer.pad_token_id
+        self.admission = admission
+        self.repetition = repetition
+
+        self.max_queue_size = max_queue_size
+        self._waiting = queue.Queue(maxsize=max_queue_size)
+        self._deferred = []
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._next_tokens = None
+        self._counters = {
+            "steps": 0,
+            "admitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "cancelled": 0,
+            "batched_rows": 0,
+            "prefill_passes": 0,
+            "prefill_tokens": 0,
+            "prefill_padding": 0,
+            "trimmed_columns": 0,
+            "repetition_stops": 0,
+            "repetition_tokens_saved": 0,
+        }
+        self._service_time = None  # moving average of admission-to-finish seconds
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        """
+        Pin the request's adapter and queue it for the next step boundary.
+
+        Raises QueueFullError instead of blocking when the waiting queue is at capacity,
+        so callers can shed load before anything reaches the GPU, and MemoryBudgetExceeded
+        for a request too large for the admission controller's budget.
+        """
+        if self.admission is not None:
+            self.admission.check(request)
+        if self._waiting.full():
+            self._counters["rejected"] += 1
+            raise QueueFullError(self.retry_after())
+        self.registry.acquire(request.adapter_name)
+        try:
+            self._waiting.put_nowait(request)
+        except queue.Full:
+            self.registry.release(request.adapter_name)
+            self._counters["rejected"] += 1
+            raise QueueFullError(self.retry_after())
+        return request
+
+    def queue_depth(self):
+        return self._waiting.qsize() + len(self._deferred)
+
+    def retry_after(self):
+        """Rough number of seconds until the current backlog has drained."""
+        service_time = self._service_time or 1.0
+        rounds = (self.queue_depth() + len(self._active)) / max(self.max_batch_size, 1)
+        return max(1, math.ceil(rounds * service_time))
+
+    def cancel(self, request):
+        request.cancel()
+
+    def generate(self, adapter_name, input_ids, **kwargs):
+        return self.submit(GenerationRequest(adapter_name, input_ids, **kwargs)).result()
+
+    def stats(self):
+        steps = self._counters["steps"]
+        prefilled = self._counters["prefill_tokens"] + self._counters["prefill_padding"]
+        mask = self._attention_mask
+        return {
+            **self._counters,
+            "waiting": self.queue_depth(),
+            "deferred": len(self._deferred),
+            "active": len(self._active),
+            "max_batch_size": self.max_batch_size,
+            "max_queue_size": self.max_queue_size,
+            "service_time_avg": self._service_time,
+            "retry_after": self.retry_after(),
+            "mean_batch_size": self._counters["batched_rows"] / steps if steps else 0.0,
+            "prefill_padding_ratio": self._counters["prefill_padding"] / prefilled if prefilled else 0.0,
+            "kv_padding_ratio": 1.0 - mask.float().mean().item() if mask is not None else 0.0,
+            "admission": self.admission.stats() if self.admission is not None else None,
+            "repetition": self.repetition.stats() if self.repetition is not None else None,
+        }
+
+    def close(self):
+        """Stop the decode thread once everything already submitted has finished."""
+        self._closed = True
+        try:
+            self._waiting.put_nowait(None)  # wakes the thread if it is waiting for work
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            if self._closed and not self._active and not self._deferred and self._waiting.empty():
+                return
+            # Deferred requests go first; otherwise sleep until there is work, then top the
+            # batch up at the step boundary
+            pending, self._deferred = self._deferred, []
+            if not self._active and not pending:
+                pending.append(self._waiting.get())
+            while len(self._active) + len(pending) < self.max_batch_size:
+                try:
+                    pending.append(self._waiting.get_nowait())
+                except queue.Empty:
+                    break
+            pending = [r for r in pending if r is not None]
+
+            # Requests that were cancelled or waited past their deadline are dropped before
+            # they cost anything
+            now = time.time()
+            for r in [r for r in pending if r.cancelled or r.expired(now)]:
+                if r.cancelled:
+                    self._cancel(r)
+                else:
+                    self._timeout(r)
+                pending.remove(r)
+
+            if self.admission is not None and pending:
+                pending, self._deferred = self.admission.admit(pending)
+                if self._deferred and not self._active and not pending:
+                    # The budget is held by another scheduler sharing it; wait for a release
+                    time.sleep(0.01)
+
+            try:
+                if pending:
+                    self._admit(pending)
+                if self._active:
+                    self._step()
+            except Exception as e:
+                logger.error(f"Batch scheduler step failed: {e}")
+                self._fail_all(pending, e)
+
+    def _forward(self, requests, **inputs):
+        with torch.no_grad(), self.registry.lock:
+            if self.adapter_bank is not None:
+                return self.adapter_bank.forward([r.adapter_name for r in requests], use_cache=True, **inputs)
+            return self.registry.peft_model(
+                **inputs,
+                use_cache=True,
+                adapter_names=[r.adapter_name for r in requests],
+            )
+
+    def _admit(self, requests):
+        for r in requests:
+            r.admitted_at = time.time()
+
+        # Fresh prompts are prefilled in buckets of similar length; prompts that arrive with
+        # a cached prefix only prefill their new suffix on top of it, batched by prefix length
+        fresh = [r for r in requests if r.prefix_cache is None]
+        for bucket in length_buckets(fresh, lambda r: len(r.input_ids), self.max_padding_ratio):
+            self._merge(bucket, *self._prefill(bucket))
+        groups = {}
+        for r in requests:
+            if r.prefix_cache is not None:
+                groups.setdefault(r.prefix_cache[0][0].shape[2], []).append(r)
+        for cached, group in groups.items():
+            for bucket in length_buckets(group, lambda r: len(r.input_ids) - cached, self.max_padding_ratio):
+                self._merge(bucket, *self._prefill_cached(bucket))
+        self._counters["admitted"] += len(requests)
+
+        # Newly merged rows sit at the end of the batch
+        start = len(self._active) - len(requests)
+        self._emit(start, self._next_tokens[start:, 0])
+        self._drop_finished()
+
+    def _prefill(self, requests):
+        lengths = [len(r.input_ids) for r in requests]
+        max_len = max(lengths)
+        self._count_prefill(lengths, max_len)
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for i, r in enumerate(requests):
+            input_ids[i, max_len - lengths[i]:] = torch.tensor(r.input_ids, dtype=torch.long)
+            attention_mask[i, max_len - lengths[i]:] = 1
+
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        outputs = self._forward(
+            requests,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=to_model_cache(None),
+        )
+        next_tokens = self._sample(outputs.logits[:, -1, :], requests)
+        return from_model_cache(outputs.past_key_values), attention_mask, next_tokens
+
+    def _prefill_cached(self, requests):
+        """
+        Prefill the uncached suffixes of requests whose prefix caches have equal length.
+
+        Suffixes are left-padded, so padding sits between each row's cached prefix and its
+        suffix; the attention mask and position ids skip over it.
+        """
+        cached = requests[0].prefix_cache[0][0].shape[2]
+        prefix = tuple(
+            (
+                torch.cat([r.prefix_cache[layer][0].to(self.device) for r in requests], dim=0),
+                torch.cat([r.prefix_cache[layer][1].to(self.device) for r in requests], dim=0),
+            )
+            for layer in range(len(requests[0].prefix_cache))
+        )
+
+        lengths = [len(r.input_ids) - cached for r in requests]
+        max_len = max(lengths)
+        self._count_prefill(lengths, max_len)
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long)
+        suffix_mask = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for i, r in enumerate(requests):
+            input_ids[i, max_len - lengths[i]:] = torch.tensor(r.input_ids[cached:], dtype=torch.long)
+            suffix_mask[i, max_len - lengths[i]:] = 1
+            r.prefix_cache = None
+
+        input_ids = input_ids.to(self.device)
+        suffix_mask = suffix_mask.to(self.device)
+        attention_mask = torch.cat([suffix_mask.new_ones(len(requests), cached), suffix_mask], dim=1)
+        position_ids = cached + (suffix_mask.cumsum(-1) - 1).clamp(min=0)
+
+        outputs = self._forward(
+            requests,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=to_model_cache(prefix),
+        )
+        next_tokens = self._sample(outputs.logits[:, -1, :], requests)
+        return from_model_cache(outputs.past_key_values), attention_mask, next_tokens
+
+    def _count_prefill(self, lengths, max_len):
+        self._counters["prefill_passes"] += 1
+        self._counters["prefill_tokens"] += sum(lengths)
+        self._counters["prefill_padding"] += max_len * len(lengths) - sum(lengths)
+
+    def _merge(self, requests, past, attention_mask, next_tokens):
+        if not self._active:
+            self._past = past
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens[:, None]
+        else:
+            length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+            self._past = tuple(
+                (torch.cat([old_k, new_k], dim=0), torch.cat([old_v, new_v], dim=0))
+                for (old_k, old_v), (new_k, new_v) in zip(
+                    _left_pad_past(self._past, length), _left_pad_past(past, length)
+                )
+            )
+            self._attention_mask = torch.cat(
+                [_left_pad_mask(self._attention_mask, length), _left_pad_mask(attention_mask, length)], dim=0
+            )
+            self._next_tokens = torch.cat([self._next_tokens, next_tokens[:, None]], dim=0)
+        self._active.extend(requests)
+
+    def _step(self):
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones(len(self._active), 1)], dim=1
+        )
+        position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+
+        outputs = self._forward(
+            self._active,
+            input_ids=self._next_tokens,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=to_model_cache(self._past),
+        )
+        self._past = from_model_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        self._next_tokens = next_tokens[:, None]
+        self._counters["steps"] += 1
+        self._counters["batched_rows"] += len(self._active)
+
+        self._emit(0, next_tokens)
+        self._drop_finished()
+
+    def _sample(self, logits, requests):
+        if not any(r.do_sample for r in requests):
+            return logits.argmax(dim=-1)
+
+        tokens = []
+        for row, r in zip(logits, requests):
+            if not r.do_sample:
+                tokens.append(row.argmax())
+                continue
+            probs = torch.softmax(row.float() / max(r.temperature, 1e-5), dim=-1)
+            if r.top_p < 1.0:
+                sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+                cumulative = sorted_probs.cumsum(dim=-1)
+                sorted_probs[cumulative - sorted_probs > r.top_p] = 0
+                probs = torch.zeros_like(probs).scatter(0, sorted_idx, sorted_probs)
+            if r.seed is not None and r._generator is None:
+                r._generator = torch.Generator(device=probs.device).manual_seed(r.seed)
+            tokens.append(torch.multinomial(probs, 1, generator=r._generator)[0])
+        return torch.stack(tokens)
+
+    def _emit(self, start, next_tokens):
+        """Record the tokens sampled for the active rows from index `start` on."""
+        now = time.time()
+        for index, token in enumerate(next_tokens.tolist(), start):
+            r = self._active[index]
+            if r.cancelled:
+                self._cancel(r)
+                continue
+            if r.expired(now):
+                self._timeout(r)
+                continue
+            if token in self.eos_token_ids:
+                self._finish_row(index, "stop")
+                continue
+            r._append(token)
+            if len(r.output_ids) >= r.max_new_tokens:
+                self._finish_row(index, "length")
+            elif r.stop_on_repetition and self.repetition is not None and self.repetition.period(r.output_ids):
+                self._counters["repetition_stops"] += 1
+                self._counters["repetition_tokens_saved"] += r.max_new_tokens - len(r.output_ids)
+                self._finish_row(index, "repetition")
+
+    def _finish_row(self, index, reason):
+        r = self._active[index]
+        if r.return_cache:
+            r.cache = self._row_cache(index)
+        self._complete(r, reason)
+
+    def _row_cache(self, index):
+        """Gather one row's keys/values out of the batch, dropping every padded position."""
+        positions = self._attention_mask[index].nonzero().squeeze(-1)
+        return tuple(
+            (k[index:index + 1].index_select(2, positions), v[index:index + 1].index_select(2, positions))
+            for k, v in self._past
+        )
+
+    def _complete(self, request, reason, error=None):
+        if request.done:
+            return
+        request._finish(reason, error)
+        self.registry.release(request.adapter_name)
+        if self.admission is not None:
+            self.admission.release(request)
+        self._counters["failed" if error is not None else "completed"] += 1
+        if error is None and request.admitted_at is not None:
+            elapsed = request.finished_at - request.admitted_at
+            self._service_time = elapsed if self._service_time is None else 0.9 * self._service_time + 0.1 * elapsed
+
+    def _timeout(self, request):
+        self._counters["timed_out"] += 1
+        self._complete(request, "timeout", TimeoutError(f"Generation request {request.id} exceeded its deadline"))
+
+    def _cancel(self, request):
+        self._counters["cancelled"] += 1
+        self._complete(request, "cancelled", RequestCancelled(f"Generation request {request.id} was cancelled"))
+
+    def _drop_finished(self):
+        keep = [i for i, r in enumerate(self._active) if not r.done]
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        self._past = tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self._past)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[i] for i in keep]
+        self._trim_padding()
+
+    def _trim_padding(self):
+        """Cut leading columns that are padding for every remaining row, e.g. after the longest prompt left."""
+        occupied = self._attention_mask.any(dim=0).nonzero()
+        first = occupied[0, 0].item() if len(occupied) else 0
+        if first == 0:
+            return
+        self._past = tuple((k[:, :, first:], v[:, :, first:]) for k, v in self._past)
+        self._attention_mask = self._attention_mask[:, first:]
+        self._counters["trimmed_columns"] += first
+
+    def _reset(self):
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _fail_all(self, pending, error):
+        for r in self._active + pending:
+            self._complete(r, "error", error)
+        self._reset()
+        if isinstance(error, torch.cuda.OutOfMemoryError):
+            torch.cuda.empty_cache()
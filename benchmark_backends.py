@@ -0,0 +1,158 @@
+"""
+Throughput benchmark of the CUDA (4-bit) and CPU (dynamic int8) inference backends.
+
+    python benchmark_backends.py --backends cuda cpu --persona <persona> --batch-sizes 1 4 8
+
+Each backend runs in a fresh Python process so the two models never share memory. The
+process loads the model the same way flask_api.py does, attaches the persona adapter and
+pushes batches of /generate-style prompts through the continuous batching scheduler.
+Load time, request latency and generated tokens per second are written as JSON. The
+"stub" backend (tiny random model, see stub_backend.py) needs neither weights nor a GPU
+and measures the scheduler's own overhead.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODEL_ID = "google/gemma-2-9b-it"
+DEFAULT_ADAPTER_PATH = "/home/elalem/claim_questions/{}"
+
+PROMPTS = [
+    "Aşılar otizme neden olur.",
+    "İklim değişikliği insan kaynaklı değildir.",
+    "5G baz istasyonları salgın hastalıkları yayar.",
+    "Ay'a hiç insan gitmedi.",
+    "Kahve içmek ömrü uzatır.",
+    "Dünya düzdür.",
+    "Şekerli içecekler çocukları hiperaktif yapar.",
+    "Yapay zeka beş yıl içinde tüm işleri ortadan kaldıracak.",
+]
+
+
+def measure(backend, model_id, quantized_dir, adapter_path, persona, batch_sizes, max_new_tokens, cpu_threads):
+    """Load one backend, run every batch size once after a warmup and print JSON."""
+    start = time.time()
+    from adapter_registry import AdapterRegistry
+    from batch_scheduler import ContinuousBatchScheduler, GenerationRequest
+    from debate_engine import SYSTEM_MESSAGE
+    from model_loader import load_model
+    import torch
+
+    model, tokenizer, device = load_model(backend, model_id, quantized_dir=quantized_dir, cpu_threads=cpu_threads)
+    if backend == "stub":
+        from stub_backend import write_stub_adapters
+
+        adapter_path = write_stub_adapters("stub_adapters", [persona])
+    registry = AdapterRegistry(model, adapter_path)
+    registry.acquire(persona)
+    load_seconds = time.time() - start
+
+    eos_token_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")}
+    scheduler = ContinuousBatchScheduler(
+        registry, tokenizer, device, eos_token_ids, max_batch_size=max(batch_sizes), max_queue_size=max(batch_sizes)
+    )
+
+    def run_batch(size):
+        requests = []
+        for i in range(size):
+            prompt = PROMPTS[i % len(PROMPTS)]
+            messages = [{"role": "user", "content": f"{SYSTEM_MESSAGE}\n\n{prompt}"}]
+            input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+            requests.append(scheduler.submit(GenerationRequest(persona, input_ids, max_new_tokens=max_new_tokens)))
+        batch_start = time.time()
+        latencies, tokens = [], 0
+        for r in requests:
+            r.result()
+            latencies.append(r.finished_at - r.submitted_at)
+            tokens += len(r.output_ids)
+        elapsed = time.time() - batch_start
+        return {
+            "batch_size": size,
+            "seconds": round(elapsed, 3),
+            "generated_tokens": tokens,
+            "tokens_per_second": round(tokens / elapsed, 2) if elapsed else 0.0,
+            "latency_median": round(statistics.median(latencies), 3),
+            "latency_max": round(max(latencies), 3),
+        }
+
+    run_batch(1)  # warmup: kernel selection, allocator growth
+    results = [run_batch(size) for size in batch_sizes]
+
+    report = {
+        "backend": backend,
+        "load_seconds": round(load_seconds, 3),
+        "threads": torch.get_num_threads() if backend == "cpu" else None,
+        "batches": results,
+    }
+    if backend == "cuda":
+        report["gpu_memory_mb"] = round(torch.cuda.max_memory_allocated() / 1024 / 1024, 1)
+    print(json.dumps(report))
+
+
+def benchmark(args):
+    results = {}
+    for backend in args.backends:
+        print(f"[{backend}] loading and generating...")
+        command = [
+            sys.executable, os.path.abspath(__file__), "--measure", backend,
+            "--model-id", args.model_id,
+            "--quantized-dir", args.quantized_dir,
+            "--adapter-path", args.adapter_path,
+            "--persona", args.persona,
+            "--max-new-tokens", str(args.max_new_tokens),
+            "--cpu-threads", str(args.cpu_threads),
+            "--batch-sizes", *[str(size) for size in args.batch_sizes],
+        ]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        results[backend] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    if "cuda" in results and "cpu" in results:
+        results["cuda_over_cpu"] = {
+            str(cuda["batch_size"]): round(cuda["tokens_per_second"] / cpu["tokens_per_second"], 2)
+            for cuda, cpu in zip(results["cuda"]["batches"], results["cpu"]["batches"])
+            if cpu["tokens_per_second"]
+        }
+
+    print(json.dumps(results, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", choices=["cuda", "cpu", "stub"], default=["cuda", "cpu"])
+    parser.add_argument("--model-id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--quantized-dir", default="gemma-2-9b-it-4bit")
+    parser.add_argument("--adapter-path", default=DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--persona", required=True, help="Adapter directory name under --adapter-path")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--cpu-threads", type=int, default=0)
+    parser.add_argument("--report", default="backend_benchmark.json")
+    # Internal: executed in a fresh process by the benchmark
+    parser.add_argument("--measure", choices=["cuda", "cpu", "stub"], help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.measure:
+        measure(
+            args.measure,
+            args.model_id,
+            args.quantized_dir,
+            args.adapter_path,
+            args.persona,
+            args.batch_sizes,
+            args.max_new_tokens,
+            args.cpu_threads or None,
+        )
+    else:
+        benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
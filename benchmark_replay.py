@@ -0,0 +1,237 @@
+"""
+Load-replay benchmark of a running inference server.
+
+    python benchmark_replay.py --log captured_requests.jsonl --url http://127.0.0.1:5000 \\
+        --concurrency 8 --rate 2 --report replay_report.json
+
+Every line of the log is one request, either {"endpoint": "/generate", "payload": {...}}
+with an optional "offset_s" (seconds since the start of the capture), or a bare payload
+whose endpoint is inferred from its fields (persona_name + prompt -> /generate, prompt_1
+-> /generate_llm_to_llm, selected_personas -> /generate_multi_llm).
+
+Requests are sent at --rate arrivals per second (Poisson), at the captured offsets with
+--replay-timing, or back to back, never more than --concurrency at a time. /generate
+payloads are sent to /generate_stream so time to first token can be measured. The report
+holds p50/p95/p99 latency, TTFT, generated tokens per second and error rates per endpoint,
+plus the git commit it was measured at; --compare prints the change against an older report.
+Nothing leaves the machine except the requests to --url.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import subprocess
+import time
+
+import aiohttp
+
+ENDPOINTS = ("/generate", "/generate_llm_to_llm", "/generate_multi_llm")
+
+
+def infer_endpoint(payload):
+    if "selected_personas" in payload:
+        return "/generate_multi_llm"
+    if "prompt_1" in payload:
+        return "/generate_llm_to_llm"
+    return "/generate"
+
+
+def load_log(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "payload" in record:
+                endpoint = record.get("endpoint") or infer_endpoint(record["payload"])
+                entries.append((endpoint, record["payload"], record.get("offset_s")))
+            else:
+                entries.append((infer_endpoint(record), record, None))
+            if entries[-1][0] not in ENDPOINTS:
+                raise ValueError(f"{path}:{line_number}: unsupported endpoint {entries[-1][0]}")
+    if not entries:
+        raise ValueError(f"{path} contains no requests")
+    return entries
+
+
+def generated_tokens(endpoint, body):
+    if endpoint == "/generate":
+        return (body.get("usage") or {}).get("generated_tokens", 0)
+    return sum(item.get("generated_tokens", 0) for item in body.get("conversation", []))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return round(ordered[index], 4)
+
+
+async def send(session, url, endpoint, payload, stream, timeout):
+    """One request; returns a result dict with status, latency, TTFT and generated tokens."""
+    start = time.perf_counter()
+    result = {"endpoint": endpoint, "status": None, "latency": None, "ttft": None, "tokens": 0, "error": None}
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    try:
+        if endpoint == "/generate" and stream:
+            async with session.post(f"{url}/generate_stream", json=payload, timeout=client_timeout) as response:
+                result["status"] = response.status
+                if response.status != 200:
+                    result["error"] = (await response.text())[:200]
+                else:
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        event = json.loads(line[len("data:"):])
+                        if "token" in event and result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - start
+                        elif "error" in event:
+                            result["error"] = event["error"]
+                        elif "response" in event:
+                            result["tokens"] = generated_tokens(endpoint, event)
+        else:
+            async with session.post(f"{url}{endpoint}", json=payload, timeout=client_timeout) as response:
+                result["status"] = response.status
+                if response.status != 200:
+                    result["error"] = (await response.text())[:200]
+                else:
+                    result["tokens"] = generated_tokens(endpoint, await response.json())
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        result["error"] = str(e) or type(e).__name__
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def replay(args, entries):
+    schedule = []
+    clock = 0.0
+    # Replayed captures repeat after their last offset when --requests exceeds the log
+    capture_span = max((float(offset) for _, _, offset in entries if offset is not None), default=0.0) + 1.0
+    for i in range(args.requests or len(entries)):
+        endpoint, payload, offset = entries[i % len(entries)]
+        if args.replay_timing and offset is not None:
+            clock = float(offset) + (i // len(entries)) * capture_span
+        elif args.rate > 0:
+            clock += random.expovariate(args.rate)
+        schedule.append((clock, endpoint, payload))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+
+        async def run(at, endpoint, payload):
+            delay = at - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with semaphore:
+                results.append(await send(session, args.url, endpoint, payload, not args.no_stream, args.timeout))
+
+        await asyncio.gather(*(run(*item) for item in schedule))
+        wall_seconds = time.perf_counter() - started
+    return results, wall_seconds
+
+
+def summarize(results, wall_seconds):
+    ok = [r for r in results if r["status"] == 200 and r["error"] is None]
+    statuses = {}
+    for r in results:
+        key = str(r["status"]) if r["status"] is not None else "connection_error"
+        statuses[key] = statuses.get(key, 0) + 1
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "statuses": statuses,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "ttft_p99": percentile(ttfts, 99),
+        "generated_tokens": tokens,
+        "tokens_per_second": round(tokens / wall_seconds, 2) if wall_seconds else 0.0,
+        "requests_per_second": round(len(ok) / wall_seconds, 3) if wall_seconds else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+
+def compare(report, baseline):
+    """Relative change of the headline numbers against an older report."""
+    changes = {}
+    for scope, current in [("overall", report["overall"]), *report["endpoints"].items()]:
+        old = baseline["overall"] if scope == "overall" else baseline.get("endpoints", {}).get(scope)
+        if not old:
+            continue
+        for key in ("latency_p50", "latency_p95", "latency_p99", "ttft_p50", "tokens_per_second", "error_rate"):
+            if current.get(key) is None or not old.get(key):
+                continue
+            changes[f"{scope} {key}"] = f"{old[key]} -> {current[key]} ({(current[key] - old[key]) / old[key]:+.1%})"
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", required=True, help="JSONL file of captured request payloads")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0.0, help="Poisson arrivals per second (0 = back to back)")
+    parser.add_argument("--replay-timing", action="store_true", help="Send requests at their captured offset_s")
+    parser.add_argument("--requests", type=int, default=0, help="Number of requests to send (cycles the log)")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--no-stream", action="store_true", help="Send /generate as is (no TTFT)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the arrival process")
+    parser.add_argument("--report", default="replay_report.json")
+    parser.add_argument("--compare", help="Earlier report to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    entries = load_log(args.log)
+    results, wall_seconds = asyncio.run(replay(args, entries))
+
+    report = {
+        "commit": git_commit(),
+        "url": args.url,
+        "log": args.log,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "replay_timing": args.replay_timing,
+        "stream": not args.no_stream,
+        "wall_seconds": round(wall_seconds, 3),
+        "overall": summarize(results, wall_seconds),
+        "endpoints": {
+            endpoint: summarize([r for r in results if r["endpoint"] == endpoint], wall_seconds)
+            for endpoint in ENDPOINTS
+            if any(r["endpoint"] == endpoint for r in results)
+        },
+        "errors": sorted({r["error"] for r in results if r["error"]})[:20],
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f))
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from batch_scheduler import RequestCancelled
+
+
+class CancelScope:
+    """
+    Scheduler view for a single client call.
+
+    Every generation request of the call is submitted through the scope, which applies
+    the call's deadline to it and remembers it, so cancelling the scope stops all of the
+    call's requests at the scheduler's next step, and any later turn is refused.
+    on_submit(request) runs before each submit, on_reject(request, error) when the
+    scheduler refuses one.
+    """
+
+    def __init__(self, scheduler, request_id, deadline=None, on_submit=None, on_reject=None):
+        self.scheduler = scheduler
+        self.request_id = request_id
+        self.deadline = deadline
+        self.on_submit = on_submit
+        self.on_reject = on_reject
+        self.cancelled = False
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def submit(self, request):
+        with self._lock:
+            if self.cancelled:
+                raise RequestCancelled(f"Request {self.request_id} was cancelled")
+            if self.deadline is not None:
+                request.deadline = min(request.deadline or self.deadline, self.deadline)
+            self._requests.append(request)
+        if self.on_submit is not None:
+            self.on_submit(request)
+        try:
+            self.scheduler.submit(request)
+        except Exception as e:
+            if self.on_reject is not None:
+                self.on_reject(request, e)
+            raise
+        if self.cancelled:
+            # cancel() ran between the bookkeeping above and the submit
+            self.scheduler.cancel(request)
+        return request
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            requests = list(self._requests)
+        for r in requests:
+            if not r.done:
+                self.scheduler.cancel(r)
+
+
+class CancelRegistry:
+    """
+    Open cancel scopes by client-supplied request id.
+
+    A cancel may arrive before the call it targets has been opened (the client went away
+    right after sending it); such ids are remembered for early_cancel_ttl_s and the
+    scope is cancelled as soon as it opens.
+    """
+
+    def __init__(self, scheduler, early_cancel_ttl_s=60):
+        self.scheduler = scheduler
+        self.early_cancel_ttl_s = early_cancel_ttl_s
+        self._scopes = {}
+        self._early = {}  # request id -> time the cancel arrived
+        self._lock = threading.Lock()
+        self._counters = {"opened": 0, "cancelled": 0, "early_cancels": 0}
+
+    def open(self, request_id, deadline=None, on_submit=None, on_reject=None):
+        scope = CancelScope(self.scheduler, request_id, deadline, on_submit, on_reject)
+        with self._lock:
+            self._scopes[request_id] = scope
+            self._counters["opened"] += 1
+            if self._early.pop(request_id, None) is not None:
+                scope.cancelled = True
+        return scope
+
+    def close(self, scope):
+        """Forget the scope and cancel whatever it still has running, e.g. after an error."""
+        with self._lock:
+            if self._scopes.get(scope.request_id) is scope:
+                del self._scopes[scope.request_id]
+        scope.cancel()
+
+    def cancel(self, request_id):
+        """Cancel the call with this id; returns False if it is not (yet) running."""
+        with self._lock:
+            scope = self._scopes.get(request_id)
+            if scope is None:
+                now = time.time()
+                self._early = {k: t for k, t in self._early.items() if now - t < self.early_cancel_ttl_s}
+                self._early[request_id] = now
+                self._counters["early_cancels"] += 1
+                return False
+            self._counters["cancelled"] += 1
+        scope.cancel()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "open": len(self._scopes)}
@@ -0,0 +1,133 @@
+import re
+
+from batch_scheduler import GenerationRequest
+from profiling import span
+
+SYSTEM_MESSAGE = "Sen bir Türk köşe yazarısın. Görevin sorulan soru hakkındaki fikrini ve gerekçesini açıklamaktır."
+DEBATE_INSTRUCTION = (
+    "Diğer yazarlar bu konuda yukarıdaki görüşleri paylaştı. "
+    "Onların yanıtlarını göz önünde bulundurarak kendi görüşünü ve gerekçeni yeniden açıkla."
+)
+# Every quoted answer keeps at least this many tokens, however long the claim
+MIN_ANSWER_TOKENS = 32
+
+
+def persona_prefix(tokenizer):
+    """Rendered chat-template text every persona prompt starts with."""
+    rendered = tokenizer.apply_chat_template(
+        [{"role": "user", "content": f"{SYSTEM_MESSAGE}\n\n{{prompt}}"}],
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    return rendered.split("{prompt}")[0]
+
+
+def encode_chat(tokenizer, messages):
+    """apply_chat_template in two steps, so template rendering and tokenization are timed apart."""
+    with span("chat_template"):
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    with span("tokenize", chars=len(text)):
+        return tokenizer.encode(text, add_special_tokens=False)
+
+
+def decode_response(tokenizer, output_ids):
+    with span("detokenize", tokens=len(output_ids)):
+        text = tokenizer.decode(output_ids, skip_special_tokens=True)
+    with span("cleanup"):
+        return clean_response(text)
+
+
+def clean_response(text):
+    return re.sub(r"</?div.*?>", "", text).strip()
+
+
+def trim_to_tokens(tokenizer, text, max_tokens):
+    """Keep the first max_tokens tokens of text (an answer's thesis comes first)."""
+    if max_tokens <= 0:
+        return ""
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(token_ids) <= max_tokens:
+        return text
+    return tokenizer.decode(token_ids[:max_tokens], skip_special_tokens=True).strip() + " ..."
+
+
+def fixed_prompt_tokens(tokenizer, claim):
+    """Tokens of a debate turn besides the quoted answers: system message, claim, instruction."""
+    return len(tokenizer.encode(f"{SYSTEM_MESSAGE}\n\n{claim}\n\n{DEBATE_INSTRUCTION}", add_special_tokens=False))
+
+
+def check_claim_length(tokenizer, claim, num_personas, context_token_budget):
+    """ValueError if the claim leaves less than MIN_ANSWER_TOKENS per quoted answer."""
+    needed = fixed_prompt_tokens(tokenizer, claim) + (num_personas - 1) * MIN_ANSWER_TOKENS
+    if needed > context_token_budget:
+        raise ValueError(
+            f"The claim is too long for a context budget of {context_token_budget} tokens "
+            f"with {num_personas} personas; shorten it or raise context_token_budget"
+        )
+
+
+def build_turn_prompt(tokenizer, persona, claim, previous_answers, context_token_budget):
+    """
+    Chat prompt for one persona's next turn.
+
+    The claim always stays intact; the other personas' previous answers share whatever is
+    left of context_token_budget equally, but never less than MIN_ANSWER_TOKENS each. For
+    claims that passed check_claim_length the prompt stays within the budget, apart from
+    the "name: " labels.
+    """
+    content = f"{SYSTEM_MESSAGE}\n\n{claim}"
+    others = [(name, answer) for name, answer in previous_answers.items() if name != persona]
+    if others:
+        share = (context_token_budget - fixed_prompt_tokens(tokenizer, claim)) // len(others)
+        share = max(share, MIN_ANSWER_TOKENS)
+        opinions = "\n\n".join(
+            f"{name}: {trim_to_tokens(tokenizer, answer, share)}" for name, answer in others
+        )
+        content = f"{content}\n\n{opinions}\n\n{DEBATE_INSTRUCTION}"
+
+    return encode_chat(tokenizer, [{"role": "user", "content": content}])
+
+
+def run_debate(scheduler, tokenizer, personas, claim, iterations, context_token_budget=1024,
+               max_new_tokens=256, prefix_cache=None, timeout=None):
+    """
+    Run an N-persona debate for `iterations` rounds.
+
+    Every round submits one request per persona to the batch scheduler at once, so the
+    whole round is prefilled and decoded as one multi-adapter batch. From the second
+    round on each prompt contains the other personas' answers from the previous round.
+    """
+    conversation = []
+    previous_answers = {}
+    prefix_text = persona_prefix(tokenizer)
+
+    for round_index in range(iterations):
+        requests = []
+        for persona in personas:
+            prompt_ids = build_turn_prompt(tokenizer, persona, claim, previous_answers, context_token_budget)
+            with span("prefix_cache", persona=persona):
+                prefix = prefix_cache.lookup(persona, prefix_text, prompt_ids) if prefix_cache else None
+            requests.append(scheduler.submit(
+                GenerationRequest(
+                    persona,
+                    prompt_ids,
+                    max_new_tokens=max_new_tokens,
+                    timeout=timeout,
+                    prefix_cache=prefix,
+                )
+            ))
+
+        answers = {}
+        for persona, gen_request in zip(personas, requests):
+            response = decode_response(tokenizer, gen_request.result())
+            answers[persona] = response
+            conversation.append({
+                "round": round_index + 1,
+                "persona": persona,
+                "response": response,
+                "finish_reason": gen_request.finish_reason,
+                **gen_request.usage(),
+            })
+        previous_answers = answers
+
+    return conversation
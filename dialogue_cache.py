@@ -0,0 +1,179 @@
+import threading
+from collections import OrderedDict
+
+from batch_scheduler import GenerationRequest
+from debate_engine import encode_chat
+
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def cache_bytes(cache):
+    if not cache:
+        return 0
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in cache)
+
+
+class DialogueSession:
+    """
+    Token history and KV cache of one persona within one conversation.
+
+    Sessions handed out by a DialogueCacheStore stop caching once the store evicts
+    them: update() is then a no-op and every later turn is prefilled in full.
+    """
+
+    def __init__(self, persona, store=None, key=None):
+        self.persona = persona
+        self.token_ids = []  # tokens whose keys/values are held in self.cache
+        self.cache = None
+        self.size = 0
+        self.evicted = False
+        self.prefilled_tokens = 0
+        self.reused_tokens = 0
+        self._store = store
+        self._key = key
+
+    def prepare(self, prompt_ids):
+        """
+        Crop the cache to the longest prefix it shares with the new prompt.
+
+        Re-rendering the chat template can tokenize an earlier turn slightly differently
+        from how it was generated, so only the matching prefix is kept. At least one
+        prompt token is always left uncached so there is something to prefill.
+        """
+        # The store may evict this session from another thread at any point
+        cache, token_ids = self.cache, self.token_ids
+        keep = 0
+        if cache is not None:
+            keep = min(common_prefix_length(token_ids, prompt_ids), len(prompt_ids) - 1)
+        if keep <= 0:
+            self.cache = None
+            keep = 0
+        elif keep < len(token_ids):
+            self.cache = tuple((k[:, :, :keep], v[:, :, :keep]) for k, v in cache)
+        self.token_ids = token_ids[:keep]
+
+        self.reused_tokens += keep
+        self.prefilled_tokens += len(prompt_ids) - keep
+
+    def update(self, cache, sequence):
+        if self._store is not None:
+            self._store.update(self, cache, sequence)
+        else:
+            self._set(cache, sequence)
+
+    def _set(self, cache, sequence):
+        self.cache = cache
+        self.token_ids = sequence[:cache[0][0].shape[2]] if cache else []
+        self.size = cache_bytes(cache)
+
+    def cached_tokens(self):
+        return len(self.token_ids)
+
+
+class DialogueCacheStore:
+    """
+    Per-conversation KV caches for LLM-to-LLM dialogues.
+
+    Sessions are keyed by (conversation_id, speaker), so a persona debating itself still
+    gets one cache per side. Their KV caches together stay within max_bytes, evicting
+    the least recently updated sessions, and each session's context is capped at
+    max_cache_tokens. Callers drop a conversation's sessions with end() when it finishes.
+    """
+
+    def __init__(self, max_bytes, max_cache_tokens=4096):
+        self.max_bytes = max_bytes
+        self.max_cache_tokens = max_cache_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"sessions_created": 0, "sessions_evicted": 0, "prefilled_tokens": 0, "reused_tokens": 0}
+
+    def session(self, conversation_id, speaker, persona):
+        key = (conversation_id, speaker)
+        with self._lock:
+            if key in self._sessions:
+                self._sessions.move_to_end(key)
+                return self._sessions[key]
+            session = DialogueSession(persona, store=self, key=key)
+            self._sessions[key] = session
+            self._counters["sessions_created"] += 1
+            return session
+
+    def update(self, session, cache, sequence):
+        """Store a session's new cache, unless the session was evicted meanwhile."""
+        with self._lock:
+            if session.evicted:
+                # Also drops a cropped cache prepare() may have put back after the eviction
+                session.cache = None
+                return
+            session._set(cache, sequence)
+            self._sessions.move_to_end(session._key)
+            while self._sessions and sum(s.size for s in self._sessions.values()) > self.max_bytes:
+                _, evicted = self._sessions.popitem(last=False)
+                self._retire(evicted)
+                self._counters["sessions_evicted"] += 1
+
+    def end(self, conversation_id):
+        with self._lock:
+            for key in [k for k in self._sessions if k[0] == conversation_id]:
+                self._retire(self._sessions.pop(key))
+
+    def _retire(self, session):
+        self._counters["prefilled_tokens"] += session.prefilled_tokens
+        self._counters["reused_tokens"] += session.reused_tokens
+        session.evicted = True
+        session.cache = None
+        session.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "active_sessions": len(self._sessions),
+                "cached_tokens": sum(s.cached_tokens() for s in self._sessions.values()),
+                "cached_bytes": sum(s.size for s in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+                "max_cache_tokens": self.max_cache_tokens,
+            }
+
+
+def fit_messages(tokenizer, messages, max_tokens):
+    """Drop the oldest exchanges (keeping the opening message) until the prompt fits."""
+    messages = list(messages)
+    prompt_ids = encode_chat(tokenizer, messages)
+    while len(prompt_ids) > max_tokens and len(messages) > 2:
+        del messages[1:3]
+        prompt_ids = encode_chat(tokenizer, messages)
+    return prompt_ids
+
+
+def generate_turn(scheduler, tokenizer, session, messages, max_cache_tokens, **request_kwargs):
+    """
+    Generate the persona's next turn through the shared batch scheduler.
+
+    The session's cached prefix travels with the request, so only the tokens not already
+    cached are prefilled, and turns from every conversation that is ready at the same
+    step boundary are decoded together. Returns the finished GenerationRequest.
+    """
+    max_new_tokens = request_kwargs.get("max_new_tokens", 50)
+    prompt_ids = fit_messages(tokenizer, messages, max_cache_tokens - max_new_tokens)
+    session.prepare(prompt_ids)
+
+    gen_request = scheduler.submit(
+        GenerationRequest(
+            session.persona,
+            prompt_ids,
+            prefix_cache=session.cache,
+            return_cache=True,
+            **request_kwargs,
+        )
+    )
+    output_ids = gen_request.result()
+    session.update(gen_request.cache, prompt_ids + output_ids)
+    return gen_request
@@ -0,0 +1,137 @@
+"""
+One-time export of the 4-bit inference model, plus a startup benchmark.
+
+    python export_quantized.py export --output gemma-2-9b-it-4bit
+    python export_quantized.py benchmark --artifact gemma-2-9b-it-4bit --runs 3
+
+`export` quantizes google/gemma-2-9b-it with the same BitsAndBytesConfig as the server
+and writes the 4-bit weights as safetensors together with the tokenizer. flask_api.py
+picks the artifact up through QUANTIZED_MODEL_DIR.
+
+`benchmark` starts a fresh Python process per run for each loading path (quantize on
+load vs. pre-quantized artifact), so every run pays the full cold-start cost, and
+reports load time, time to the first generated token and GPU memory as JSON.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODEL_ID = "google/gemma-2-9b-it"
+
+
+def export(model_id, output_dir):
+    import torch
+    import transformers
+    from model_loader import load_quantized, load_tokenizer
+
+    start = time.time()
+    print(f"Quantizing {model_id} to 4-bit...")
+    model = load_quantized(model_id)
+    tokenizer = load_tokenizer(model_id)
+
+    print(f"Writing artifact to: {output_dir}")
+    model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+
+    info = {
+        "source_model": model_id,
+        "quantization": "bitsandbytes nf4, double quant, fp16 compute",
+        "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "export_seconds": round(time.time() - start, 2),
+        "torch_version": torch.__version__,
+        "transformers_version": transformers.__version__,
+    }
+    with open(os.path.join(output_dir, "export_info.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    print(json.dumps(info, indent=2))
+
+
+def measure_startup(mode, source):
+    """Load the model one way, run a single generation step and print timings as JSON."""
+    start = time.time()
+    import torch
+    from model_loader import load_prequantized, load_quantized, load_tokenizer
+    import_seconds = time.time() - start
+
+    tokenizer = load_tokenizer(source)
+    model = load_prequantized(source) if mode == "artifact" else load_quantized(source)
+    model.eval()
+    torch.cuda.synchronize()
+    load_seconds = time.time() - start
+
+    inputs = tokenizer("Merhaba", return_tensors="pt").to("cuda")
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=1)
+    torch.cuda.synchronize()
+
+    print(json.dumps({
+        "mode": mode,
+        "import_seconds": round(import_seconds, 3),
+        "load_seconds": round(load_seconds, 3),
+        "first_token_seconds": round(time.time() - start, 3),
+        "gpu_memory_mb": round(torch.cuda.max_memory_allocated() / 1024 / 1024, 1),
+    }))
+
+
+def benchmark(model_id, artifact_dir, runs, report_path):
+    results = {}
+    for mode, source in (("quantize_on_load", model_id), ("artifact", artifact_dir)):
+        samples = []
+        for run in range(runs):
+            print(f"[{mode}] run {run + 1}/{runs}...")
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "measure", "--mode", mode, "--source", source],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        results[mode] = {
+            "runs": samples,
+            "load_seconds_median": statistics.median(s["load_seconds"] for s in samples),
+            "first_token_seconds_median": statistics.median(s["first_token_seconds"] for s in samples),
+        }
+
+    baseline = results["quantize_on_load"]["first_token_seconds_median"]
+    results["speedup"] = round(baseline / results["artifact"]["first_token_seconds_median"], 2)
+    print(json.dumps(results, indent=2))
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write the 4-bit artifact")
+    export_parser.add_argument("--model-id", default=DEFAULT_MODEL_ID)
+    export_parser.add_argument("--output", default="gemma-2-9b-it-4bit")
+
+    bench_parser = subparsers.add_parser("benchmark", help="Compare startup time of both loading paths")
+    bench_parser.add_argument("--model-id", default=DEFAULT_MODEL_ID)
+    bench_parser.add_argument("--artifact", default="gemma-2-9b-it-4bit")
+    bench_parser.add_argument("--runs", type=int, default=3)
+    bench_parser.add_argument("--report", default="startup_benchmark.json")
+
+    # Internal: executed in a fresh process by `benchmark`
+    measure_parser = subparsers.add_parser("measure")
+    measure_parser.add_argument("--mode", choices=["quantize_on_load", "artifact"], required=True)
+    measure_parser.add_argument("--source", required=True)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model_id, args.output)
+    elif args.command == "benchmark":
+        benchmark(args.model_id, args.artifact, args.runs, args.report)
+    else:
+        measure_startup(args.mode, args.source)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,34 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
-from transformers import BitsAndBytesConfig
 import torch
 import time
-from flask import Flask, request, jsonify
+import math
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 import os
+import json
+import uuid
+import threading
 import traceback
-import re
+import profiling
+from adapter_bank import AdapterBank
+from adapter_registry import AdapterRegistry
+from admission import MemoryAdmission, MemoryBudgetExceeded, available_memory
+from model_loader import load_model
+from batch_jobs import BatchJobManager
+from batch_scheduler import ContinuousBatchScheduler, GenerationRequest, QueueFullError, RequestCancelled
+from cancellation import CancelRegistry
+from debate_engine import SYSTEM_MESSAGE, check_claim_length, encode_chat, persona_prefix, run_debate
+from dialogue_cache import DialogueCacheStore, generate_turn
+from hot_replicas import HotReplicaRouter
+from metrics import InferenceMetrics
+from prefix_cache import PrefixCache
+from repetition import RepetitionDetector
+from response_cache import ResponseCache, is_cacheable
+from worker_pool import WorkerPool
 
 app = Flask(__name__)
 
+# Filled in by warm_up(); /readyz answers 503 until state is "ready"
+startup_status = {"state": "warming_up", "started_at": time.time(), "ready_at": None, "adapters": {}}
+
 @app.route("/", methods=["GET"])
 def home():
     return "Flask API is running!"
@@ -17,42 +36,409 @@ def home():
 # Environment variable for better memory management
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
+# Bind address; give each replica its own port when several run behind router.py
+FLASK_HOST = os.environ.get("FLASK_HOST", "10.3.0.96")
+FLASK_PORT = int(os.environ.get("FLASK_PORT", "5000"))
+
 # Model and adapter paths
 model_id = "google/gemma-2-9b-it"
 adapter_path = "/home/elalem/claim_questions/{}"
 
-def load_model_and_tokenizer():
-    print(f"Loading tokenizer from: {model_id}")
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "right"
-
-    print("Loading model...")
-    device = torch.device("cuda")
-    quant_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True
+# 4-bit artifact written by export_quantized.py; used instead of model_id when present
+QUANTIZED_MODEL_DIR = os.environ.get("QUANTIZED_MODEL_DIR", "gemma-2-9b-it-4bit")
+
+# "cuda" serves the 4-bit model on the GPU, "cpu" a dynamic int8 model for GPU-less hosts,
+# "stub" a tiny random model with fake persona adapters for load tests and CI
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "cuda")
+CPU_THREADS = int(os.environ.get("CPU_THREADS", "0")) or None  # default: all cores available to the process
+
+# Stub backend: adapters are written to STUB_ADAPTER_DIR for STUB_PERSONAS (default: the
+# adapter directories in Models/), and every forward pass sleeps STUB_TOKEN_LATENCY_MS
+STUB_ADAPTER_DIR = os.environ.get("STUB_ADAPTER_DIR", "stub_adapters")
+STUB_PERSONAS = os.environ.get("STUB_PERSONAS", "")
+STUB_TOKEN_LATENCY_MS = float(os.environ.get("STUB_TOKEN_LATENCY_MS", "0"))
+
+# CPU backend only: number of forked worker processes sharing the base weights (0 = serve in-process)
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", "0"))
+
+# Personas above HOT_PERSONA_RPM requests/minute get a replica with their adapter merged in,
+# released again once they fall below COOL_PERSONA_RPM. Each replica holds dense copies of
+# the q/v projections outside the admission budget, so they are opt-in
+MAX_HOT_REPLICAS = int(os.environ.get("MAX_HOT_REPLICAS", "0"))
+HOT_PERSONA_RPM = float(os.environ.get("HOT_PERSONA_RPM", "30"))
+COOL_PERSONA_RPM = float(os.environ.get("COOL_PERSONA_RPM", "10"))
+
+# Personas loaded and warmed up before /readyz reports ready: comma-separated names,
+# or "all" for every adapter directory next to adapter_path
+PRELOAD_PERSONAS = os.environ.get("PRELOAD_PERSONAS", "")
+WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", "8"))
+
+# Adapter residency budget (either limit may be left unset)
+ADAPTER_MEMORY_BUDGET_MB = float(os.environ.get("ADAPTER_MEMORY_BUDGET_MB", "0")) or None
+MAX_RESIDENT_ADAPTERS = int(os.environ.get("MAX_RESIDENT_ADAPTERS", "0")) or None
+
+# Apply LoRA deltas for mixed-persona batches through the stacked adapter bank
+USE_ADAPTER_BANK = os.environ.get("USE_ADAPTER_BANK", "1") == "1"
+
+# Maximum number of concurrent /generate sequences decoded together
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+
+# Prompts are prefilled in separate passes once padding would exceed this share of a pass
+PREFILL_MAX_PADDING = float(os.environ.get("PREFILL_MAX_PADDING", "0.25"))
+
+# Backpressure: requests beyond the queue bound are rejected with 429, and every
+# request is abandoned once it has been in the system longer than the timeout
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "64"))
+REQUEST_TIMEOUT_S = float(os.environ.get("REQUEST_TIMEOUT_S", "120"))
+
+# Requests are admitted only while their estimated KV cache and prefill activations fit
+# into this many MB; 0 = MEMORY_BUDGET_FRACTION of the memory left after loading the model
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_FRACTION = float(os.environ.get("MEMORY_BUDGET_FRACTION", "0.9"))
+
+# Rows whose output ends in REPETITION_MIN_REPEATS copies of an n-gram of up to
+# REPETITION_MAX_NGRAM tokens (REPETITION_MIN_TOKENS at least) stop early; 0 disables
+REPETITION_MAX_NGRAM = int(os.environ.get("REPETITION_MAX_NGRAM", "32"))
+REPETITION_MIN_REPEATS = int(os.environ.get("REPETITION_MIN_REPEATS", "3"))
+REPETITION_MIN_TOKENS = int(os.environ.get("REPETITION_MIN_TOKENS", "24"))
+
+# Token budget for the other personas' answers quoted in each debate turn
+DEBATE_CONTEXT_TOKENS = int(os.environ.get("DEBATE_CONTEXT_TOKENS", "1024"))
+if DEBATE_CONTEXT_TOKENS <= 0:
+    raise ValueError("DEBATE_CONTEXT_TOKENS must be a positive number of tokens")
+
+# Per-persona KV caches kept for the lifetime of an LLM-to-LLM conversation
+DIALOGUE_CACHE_MB = float(os.environ.get("DIALOGUE_CACHE_MB", "2048"))
+DIALOGUE_CACHE_TOKENS = int(os.environ.get("DIALOGUE_CACHE_TOKENS", "4096"))
+
+# Memory reserved for prefilled persona system-prompt prefixes
+PREFIX_CACHE_MB = float(os.environ.get("PREFIX_CACHE_MB", "512"))
+
+# Opt-in response cache; the shared tier is meant to point at the Redis used by CHANNEL_LAYERS
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("RESPONSE_CACHE_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_S = float(os.environ.get("RESPONSE_CACHE_TTL_S", "3600"))
+RESPONSE_CACHE_REDIS_URL = os.environ.get("RESPONSE_CACHE_REDIS_URL")  # e.g. redis://127.0.0.1:6379/1
+RESPONSE_CACHE_REDIS_TTL_S = int(os.environ.get("RESPONSE_CACHE_REDIS_TTL_S", "86400"))
+
+# Offline /generate_batch jobs: results are kept under BATCH_JOB_DIR, and a job keeps at
+# most BATCH_JOB_IN_FLIGHT requests in the scheduler (default: one full batch)
+BATCH_JOB_DIR = os.environ.get("BATCH_JOB_DIR", "batch_jobs")
+BATCH_JOB_IN_FLIGHT = int(os.environ.get("BATCH_JOB_IN_FLIGHT", "0")) or MAX_BATCH_SIZE
+
+# Stage timings for a share of generation requests (plus any sent with "X-Profile: 1"),
+# returned under "profile" and, with PROFILE_TRACE_DIR set, saved as Chrome traces
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TRACE_DIR = os.environ.get("PROFILE_TRACE_DIR")
+PROFILED_ENDPOINTS = {"generate", "generate_stream", "generate_llm_to_llm", "generate_multi_llm"}
+
+# With a worker pool the model is loaded on a single intra-op thread: a forked child
+# cannot use an OpenMP thread pool its parent already started, so none may exist yet
+model, tokenizer, device = load_model(
+    INFERENCE_BACKEND,
+    model_id,
+    quantized_dir=QUANTIZED_MODEL_DIR,
+    cpu_threads=1 if WORKER_POOL_SIZE else CPU_THREADS,
+    stub_token_latency_s=STUB_TOKEN_LATENCY_MS / 1000,
+)
+
+if INFERENCE_BACKEND == "stub":
+    from stub_backend import stub_persona_names, write_stub_adapters
+
+    stub_personas = [p.strip() for p in STUB_PERSONAS.split(",") if p.strip()] or stub_persona_names()
+    adapter_path = write_stub_adapters(STUB_ADAPTER_DIR, stub_personas)
+    print(f"Stub adapters for {', '.join(stub_personas)} in {STUB_ADAPTER_DIR}")
+
+# Gemma ends chat turns with <end_of_turn> rather than <eos>
+eos_token_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")}
+
+repetition = None
+if REPETITION_MAX_NGRAM:
+    repetition = RepetitionDetector(REPETITION_MAX_NGRAM, REPETITION_MIN_REPEATS, REPETITION_MIN_TOKENS)
+
+memory_budget_bytes = None
+if ADMISSION_CONTROL:
+    if MEMORY_BUDGET_MB:
+        memory_budget_bytes = int(MEMORY_BUDGET_MB * 1024 * 1024)
+    else:
+        # The prefix caches (one per worker) and the dialogue caches grow into the same memory later on
+        prefix_cache_total = PREFIX_CACHE_MB * 1024 * 1024 * max(1, WORKER_POOL_SIZE)
+        # Pool workers do not return dialogue caches, so those only exist without a pool
+        dialogue_cache_total = 0 if WORKER_POOL_SIZE else DIALOGUE_CACHE_MB * 1024 * 1024
+        memory_budget_bytes = int(
+            available_memory(device) * MEMORY_BUDGET_FRACTION - prefix_cache_total - dialogue_cache_total
+        )
+        if memory_budget_bytes <= 0:
+            raise ValueError("No memory left for generation after loading the model; set MEMORY_BUDGET_MB")
+    print(f"Memory budget for generation: {memory_budget_bytes / 2**20:.0f} MB")
+
+# Fork the CPU workers before torch runs anything multi-threaded in this process; each
+# worker then starts an intra-op pool of its own
+worker_pool = None
+if WORKER_POOL_SIZE:
+    if INFERENCE_BACKEND not in ("cpu", "stub"):
+        raise ValueError("WORKER_POOL_SIZE requires INFERENCE_BACKEND=cpu or stub")
+    worker_pool = WorkerPool(
+        model,
+        tokenizer,
+        WORKER_POOL_SIZE,
+        threads_per_worker=max(1, (CPU_THREADS or len(os.sched_getaffinity(0))) // WORKER_POOL_SIZE),
+        adapter_path=adapter_path,
+        eos_token_ids=eos_token_ids,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_queue_size=MAX_QUEUE_SIZE,
+        adapter_memory_budget_mb=ADAPTER_MEMORY_BUDGET_MB,
+        max_resident_adapters=MAX_RESIDENT_ADAPTERS,
+        use_adapter_bank=USE_ADAPTER_BANK,
+        prefix_cache_bytes=int(PREFIX_CACHE_MB * 1024 * 1024),
+        max_padding_ratio=PREFILL_MAX_PADDING,
+        memory_budget_bytes=memory_budget_bytes,
+        repetition=repetition,
     )
 
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id,
-        quantization_config=quant_config,
-        device_map="auto",
-        torch_dtype=torch.float16,
-        use_cache=True
+adapter_registry = AdapterRegistry(
+    model,
+    adapter_path,
+    memory_budget_mb=ADAPTER_MEMORY_BUDGET_MB,
+    max_adapters=MAX_RESIDENT_ADAPTERS,
+)
+
+adapter_bank = AdapterBank(adapter_registry) if USE_ADAPTER_BANK and worker_pool is None else None
+
+admission = None
+if memory_budget_bytes and worker_pool is None:
+    admission = MemoryAdmission(model.config, memory_budget_bytes, model.dtype, padding_overhead=PREFILL_MAX_PADDING)
+
+if worker_pool is not None:
+    batch_scheduler = worker_pool
+else:
+    batch_scheduler = ContinuousBatchScheduler(
+        adapter_registry,
+        tokenizer,
+        device,
+        eos_token_ids,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_queue_size=MAX_QUEUE_SIZE,
+        adapter_bank=adapter_bank,
+        max_padding_ratio=PREFILL_MAX_PADDING,
+        admission=admission,
+        repetition=repetition,
     )
+    if MAX_HOT_REPLICAS:
+        batch_scheduler = HotReplicaRouter(
+            batch_scheduler,
+            adapter_registry,
+            tokenizer,
+            device,
+            eos_token_ids,
+            max_replicas=MAX_HOT_REPLICAS,
+            hot_rpm=HOT_PERSONA_RPM,
+            cool_rpm=COOL_PERSONA_RPM,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_queue_size=MAX_QUEUE_SIZE,
+        )
 
-    model.gradient_checkpointing_enable()
-    return model, tokenizer, device
+dialogue_caches = DialogueCacheStore(
+    max_bytes=int(DIALOGUE_CACHE_MB * 1024 * 1024),
+    max_cache_tokens=DIALOGUE_CACHE_TOKENS,
+)
+
+prefix_caches = PrefixCache(
+    adapter_registry,
+    tokenizer,
+    device,
+    max_bytes=int(PREFIX_CACHE_MB * 1024 * 1024),
+)
+PERSONA_PREFIX = persona_prefix(tokenizer)
+
+def cached_persona_prefix(persona_name, input_ids):
+    # Pool workers keep prefix caches of their own
+    if worker_pool is not None:
+        return None
+    with profiling.span("prefix_cache", persona=persona_name):
+        return prefix_caches.lookup(persona_name, PERSONA_PREFIX, input_ids)
+
+# Client calls by request_id, so POST /cancel/<request_id> can stop their generation
+cancel_scopes = CancelRegistry(batch_scheduler)
+
+# Served at /metrics; pooled workers keep their adapters to themselves, so adapter
+# load times are only recorded in-process
+metrics = InferenceMetrics()
+metrics.watch_registry(adapter_registry)
+metrics.add_gauge("llm_queue_depth", "Requests waiting for or holding a batch slot.", batch_scheduler.queue_depth)
+metrics.add_gauge("llm_active_rows", "Rows in the running decode batch.", lambda: batch_scheduler.stats()["active"])
+if admission is not None:
+    metrics.add_gauge("llm_admission_reserved_bytes", "Memory reserved for admitted requests.", lambda: admission.stats()["reserved_bytes"])
+
+profiler = profiling.Profiler(sample_rate=PROFILE_SAMPLE_RATE, trace_dir=PROFILE_TRACE_DIR)
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_ENTRIES,
+    ttl_s=RESPONSE_CACHE_TTL_S,
+    redis_url=RESPONSE_CACHE_REDIS_URL,
+    redis_ttl_s=RESPONSE_CACHE_REDIS_TTL_S,
+)
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "alive", "uptime_s": round(time.time() - startup_status["started_at"], 1)})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    ready = startup_status["state"] == "ready"
+    return jsonify({
+        "ready": ready,
+        "state": startup_status["state"],
+        "ready_at": startup_status["ready_at"],
+        "adapters": dict(startup_status["adapters"]),
+        "queue_depth": batch_scheduler.queue_depth(),
+    }), 200 if ready else 503
+
+@app.route("/cancel/<request_id>", methods=["POST"])
+def cancel(request_id):
+    cancelled = cancel_scopes.cancel(request_id)
+    app.logger.info(f"Cancel for request {request_id}: {'stopped' if cancelled else 'not running'}")
+    return jsonify({"request_id": request_id, "cancelled": cancelled}), 200 if cancelled else 404
+
+@app.route("/adapters", methods=["GET"])
+def adapter_stats():
+    stats = adapter_registry.stats()
+    if adapter_bank is not None:
+        stats["bank"] = adapter_bank.stats()
+    return jsonify(stats)
+
+@app.route("/scheduler", methods=["GET"])
+def scheduler_stats():
+    return jsonify(batch_scheduler.stats())
+
+@app.before_request
+def start_timer():
+    g.request_started = time.time()
+    g.profile = profiler.start(request.endpoint, request.headers) if request.endpoint in PROFILED_ENDPOINTS else None
+    # Worker threads are reused, so every request sets (and teardown resets) the profile
+    g.profile_token = profiling.activate(g.profile)
+
+@app.teardown_request
+def reset_profile(error=None):
+    token = g.pop("profile_token", None)
+    if token is not None:
+        profiling.deactivate(token)
+
+@app.after_request
+def record_latency(response):
+    if request.endpoint is not None:
+        metrics.observe_http(request.endpoint, response.status_code, time.time() - g.request_started)
+    # Streaming responses add their profile to the final event instead
+    profile = g.get("profile")
+    if profile is not None and not response.is_streamed and response.is_json:
+        body = response.get_json()
+        if isinstance(body, dict):
+            body["profile"] = profile.to_json()
+            response.set_data(json.dumps(body, ensure_ascii=False))
+        trace_path = profiler.finish(profile)
+        if trace_path is not None:
+            response.headers["X-Profile-Trace"] = trace_path
+    return response
+
+@app.route("/admission", methods=["GET"])
+def admission_stats():
+    if admission is None:
+        # Worker processes each admit against their own share of the budget
+        return jsonify({"enabled": False, "memory_budget_bytes": memory_budget_bytes})
+    return jsonify({"enabled": True, **admission.stats()})
+
+@app.route("/profiling", methods=["GET"])
+def profiling_stats():
+    return jsonify(profiler.stats())
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cancellations", methods=["GET"])
+def cancellation_stats():
+    return jsonify(cancel_scopes.stats())
+
+@app.route("/dialogue_cache", methods=["GET"])
+def dialogue_cache_stats():
+    return jsonify(dialogue_caches.stats())
+
+@app.route("/prefix_cache", methods=["GET"])
+def prefix_cache_stats():
+    return jsonify(prefix_caches.stats())
+
+@app.route("/response_cache", methods=["GET"])
+def response_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route("/queue", methods=["GET"])
+def queue_depth():
+    return jsonify({
+        "queue_depth": batch_scheduler.queue_depth(),
+        "max_queue_size": batch_scheduler.max_queue_size,
+        "active": batch_scheduler.stats()["active"],
+        "retry_after": batch_scheduler.retry_after(),
+    })
+
+def number_field(data, name, default=None):
+    """data[name] as a finite float, or a ValueError naming the field."""
+    value = data.get(name, default)
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name} value: {value!r}") from None
+    if not math.isfinite(value):
+        raise ValueError(f"Invalid {name} value: {value!r}")
+    return value
+
+def request_limits(data):
+    """
+    (deadline, timeout) of a request: the optional absolute deadline (epoch seconds)
+    after which generation stops, and the server-side timeout in seconds.
+    """
+    deadline = number_field(data, "deadline")
+    timeout = number_field(data, "timeout", REQUEST_TIMEOUT_S)
+    if timeout <= 0:
+        raise ValueError(f"Invalid timeout value: {timeout!r}")
+    return deadline, timeout
+
+def open_cancel_scope(data, deadline):
+    endpoint = request.endpoint
+    profile = g.get("profile")
+
+    def on_submit(gen_request):
+        metrics.track(gen_request, endpoint)
+        if profile is not None:
+            profile.track(gen_request)
+
+    def on_reject(gen_request, error):
+        metrics.reject(gen_request, endpoint, error)
+
+    return cancel_scopes.open(
+        data.get("request_id") or uuid.uuid4().hex, deadline, on_submit=on_submit, on_reject=on_reject
+    )
 
-model, tokenizer, device = load_model_and_tokenizer()
+def busy_response(message, status, retry_after=None):
+    retry_after = retry_after or batch_scheduler.retry_after()
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, status
 
-def load_adapter_for_model(adapter_name):
-    try:
-        return PeftModel.from_pretrained(model, adapter_path.format(adapter_name), adapter_name=adapter_name)
-    except Exception as e:
-        raise ValueError(f"Adapter '{adapter_name}' could not be loaded. Ensure it exists. Error: {str(e)}")
+def timeout_response(error, deadline):
+    """
+    504 without Retry-After once the client's own deadline has passed, since the same
+    request can never succeed; 503 with Retry-After for the server-side timeout.
+    """
+    if deadline is not None and time.time() >= deadline:
+        return jsonify({"error": str(error)}), 504
+    return busy_response(str(error), 503)
+
+def opponent_message(speaker, response):
+    return f"{speaker}: {response}\nBu yazar ({speaker}) bahsedilen konuda böyle bir şey dedi. Senin bu konu hakkındaki düşüncelerin nedir? Karşı yazarın verdiği cevaba göre onun yanıtını göz önünde bulundurarak yeni bir cevap üret."
 
 @app.route("/generate_llm_to_llm", methods=["POST"])
 def generate_llm_to_llm():
@@ -74,78 +460,84 @@ def generate_llm_to_llm():
         return jsonify({"error": "Both persona names are required"}), 400
     if not isinstance(iterations, int) or iterations <= 0:
         return jsonify({"error": "Iterations must be a positive integer"}), 400
+    try:
+        deadline, timeout = request_limits(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conversation_id = uuid.uuid4().hex
+    scope = open_cancel_scope(data, deadline)
+    session_1 = dialogue_caches.session(conversation_id, "llm_1", persona_1)
+    session_2 = dialogue_caches.session(conversation_id, "llm_2", persona_2)
+    sampling = {
+        "max_new_tokens": 50,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "do_sample": True,
+        "timeout": timeout,
+    }
 
     try:
         conversation = []
-        last_response_llm1 = prompt_1  # Initial message from the user
-        last_response_llm2 = ""  # Initially, LLM2 has no response
-
-        # Load adapters for personas
-        app.logger.info(f"Loading adapter for persona_1: {persona_1}")
-        adapter_path_persona_1 = adapter_path.format(persona_1)
-        model_1 = PeftModel.from_pretrained(model, adapter_path_persona_1, adapter_name=persona_1)
-
-        app.logger.info(f"Loading adapter for persona_2: {persona_2}")
-        adapter_path_persona_2 = adapter_path.format(persona_2)
-        model_2 = PeftModel.from_pretrained(model, adapter_path_persona_2, adapter_name=persona_2)
-
-        # Iteratively generate responses
+        # Each persona keeps its own view of the dialogue; its KV cache covers everything
+        # but the opponent's newest message, which is all that gets prefilled per turn
+        messages_1 = [{"role": "user", "content": prompt_1}]
+        messages_2 = []
+
+        # Turns go through the shared scheduler, so concurrent dialogues advance in lockstep
+        # and every conversation whose next speaker is ready shares the same decode steps
+        app.logger.info(f"Starting dialogue between personas: {persona_1}, {persona_2}")
         for i in range(iterations):
             # Generate response from LLM1
-            llm1_input = f"LLM2: {last_response_llm2}\nBu yazar (LLM2) bahsedilen konuda böyle bir şey dedi. Senin bu konu hakkındaki düşüncelerin nedir? Karşı yazarın verdiği cevaba göre onun yanıtını göz önünde bulundurarak yeni bir cevap üret."
-            inputs = tokenizer(
-                llm1_input,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=128,
-                return_attention_mask=True
-            )
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-            outputs = model_1.generate(
-                **inputs,
-                max_new_tokens=50,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True
-            )
-            response_1 = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
+            turn = generate_turn(scope, tokenizer, session_1, messages_1, DIALOGUE_CACHE_TOKENS, **sampling)
+            output_ids = turn.output_ids
+            with profiling.span("detokenize", tokens=len(output_ids)):
+                response_1 = tokenizer.decode(output_ids, skip_special_tokens=True).strip()
 
             if not response_1:
                 raise ValueError("LLM1 generated an empty response.")
 
-            conversation.append({"llm_1_response": response_1})
-            last_response_llm1 = response_1
+            conversation.append({
+                "llm_1_response": response_1,
+                "generated_tokens": len(output_ids),
+                "finish_reason": turn.finish_reason,
+            })
+            messages_1.append({"role": "model", "content": response_1})
+            opening = f"{prompt_1}\n\n" if not messages_2 else ""
+            messages_2.append({"role": "user", "content": opening + opponent_message("LLM1", response_1)})
 
             # Generate response from LLM2
-            llm2_input = f"LLM1: {response_1}\nBu yazar (LLM1) bahsedilen konuda böyle bir şey dedi. Senin bu konu hakkındaki düşüncelerin nedir? Karşı yazarın verdiği cevaba göre onun yanıtını göz önünde bulundurarak yeni bir cevap üret."
-            inputs = tokenizer(
-                llm2_input,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=128,
-                return_attention_mask=True
-            )
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-            outputs = model_2.generate(
-                **inputs,
-                max_new_tokens=50,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True
-            )
-            response_2 = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
+            turn = generate_turn(scope, tokenizer, session_2, messages_2, DIALOGUE_CACHE_TOKENS, **sampling)
+            output_ids = turn.output_ids
+            with profiling.span("detokenize", tokens=len(output_ids)):
+                response_2 = tokenizer.decode(output_ids, skip_special_tokens=True).strip()
 
             if not response_2:
                 raise ValueError("LLM2 generated an empty response.")
 
-            conversation.append({"llm_2_response": response_2})
-            last_response_llm2 = response_2
+            conversation.append({
+                "llm_2_response": response_2,
+                "generated_tokens": len(output_ids),
+                "finish_reason": turn.finish_reason,
+            })
+            messages_2.append({"role": "model", "content": response_2})
+            messages_1.append({"role": "user", "content": opponent_message("LLM2", response_2)})
 
         # Return the conversation as a response
         return jsonify({"conversation": conversation})
 
+    except QueueFullError as e:
+        app.logger.warning(f"Rejecting LLM-to-LLM turn: {e}")
+        return busy_response(str(e), 429, e.retry_after)
+    except RequestCancelled as e:
+        app.logger.info(f"LLM-to-LLM dialogue stopped: {e}")
+        return jsonify({"error": str(e)}), 499
+    except MemoryBudgetExceeded as e:
+        app.logger.warning(f"Rejecting LLM-to-LLM turn: {e}")
+        return jsonify({"error": str(e)}), 413
+    except TimeoutError as e:
+        app.logger.warning(f"LLM-to-LLM turn timed out: {e}")
+        return timeout_response(e, deadline)
     except ValueError as ve:
         app.logger.error(f"Validation error during LLM-to-LLM interaction: {str(ve)}")
         return jsonify({"error": f"Validation Error: {str(ve)}"}), 400
@@ -153,10 +545,14 @@ def generate_llm_to_llm():
     except Exception as e:
         app.logger.error(f"Unexpected error during LLM-to-LLM interaction: {traceback.format_exc()}")
         return jsonify({"error": f"Internal Server Error: {str(e)}"}), 500
+    finally:
+        cancel_scopes.close(scope)
+        dialogue_caches.end(conversation_id)
 
 
 @app.route("/generate_multi_llm", methods=["POST"])
 def generate_multi_llm():
+    scope = None
     try:
         # Parse and validate incoming JSON data
         data = request.get_json()
@@ -173,92 +569,116 @@ def generate_multi_llm():
             return jsonify({"error": "claim is empty"}), 400
         if not isinstance(iterations, int) or iterations <= 0:
             return jsonify({"error": "Invalid iterations value"}), 400
+        context_token_budget = data.get("context_token_budget", DEBATE_CONTEXT_TOKENS)
+        if not isinstance(context_token_budget, int) or context_token_budget <= 0:
+            return jsonify({"error": "Invalid context_token_budget value"}), 400
+        try:
+            deadline, timeout = request_limits(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Ensure personas are unique and valid
         selected_personas = [p.strip().lower() for p in selected_personas if p.strip()]
         if len(set(selected_personas)) != len(selected_personas):
             return jsonify({"error": "Duplicate personas found in selected_personas"}), 400
+        try:
+            check_claim_length(tokenizer, claim, len(selected_personas), context_token_budget)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         torch.cuda.empty_cache()
 
         app.logger.info("START INFERENCE")
         start_time = time.time()
 
-        # Load the initial LoRA adapter
-        peft_model = PeftModel.from_pretrained(
-            model, adapter_path.format(selected_personas[0]), adapter_name=selected_personas[0]
-        )
-        adapters = {}
-        adapter_names = []
-
-        # Load all adapters for the selected personas
-        for persona_name in selected_personas:
-            adapter_path_persona = adapter_path.format(persona_name)
-            app.logger.info(f"Loading adapter for persona: {persona_name}")
-            adapters[persona_name] = peft_model.load_adapter(adapter_path_persona, persona_name)
-            adapter_names.append(persona_name)
-
-        # Prepare the initial input
-        system_message = "Sen bir Türk köşe yazarısın. Görevin sorulan soru hakkındaki fikrini ve gerekçesini açıklamaktır."
-
-        conversation = []
-        input_prompts = []
-
-        for persona_name in selected_personas:
-            question = claim
-            input_prompts.append(
-                [{"role": "user", "content": f"{system_message}\n\n{question}"}]
-            )
-
-        # Validate input_prompts structure
-        if not all(isinstance(p, list) and "role" in p[0] and "content" in p[0] for p in input_prompts):
-            return jsonify({"error": "Invalid input_prompts format"}), 500
-
-        # Tokenize all prompts in parallel
-        input_ids = tokenizer.apply_chat_template(
-            input_prompts,
-            return_tensors="pt",
-            return_dict=True,
-            add_generation_prompt=True,
-        ).to("cuda")
-
-        # Validate the consistency between adapter_names and input_prompts
-        if len(adapter_names) != len(input_prompts):
-            return jsonify({"error": "Mismatch between adapter_names and input_prompts"}), 500
-
-        # Generate responses in parallel
-        outputs = peft_model.generate(
-            **input_ids, adapter_names=list(adapters.keys()), max_new_tokens=256
+        # Every round's turns are submitted to the scheduler together, each persona seeing
+        # the others' previous answers
+        scope = open_cancel_scope(data, deadline)
+        conversation = run_debate(
+            scope,
+            tokenizer,
+            selected_personas,
+            claim,
+            iterations,
+            context_token_budget=context_token_budget,
+            max_new_tokens=256,
+            prefix_cache=prefix_caches if worker_pool is None else None,
+            timeout=timeout,
         )
 
-        # Decode all outputs
-        for i, output in enumerate(outputs):
-            response = tokenizer.decode(output, skip_special_tokens=True).strip()
-            response = response.split("\nmodel\n")[1].strip()
-            response = re.sub(r"</?div.*?>", "", response).strip()
-
-
-
-            conversation.append({"persona": adapter_names[i], "response": response})
-
         end_time = time.time()
         app.logger.info("END INFERENCE")
         app.logger.info(f"Total time taken: {end_time - start_time:.2f} seconds")
 
         return jsonify({"conversation": conversation}), 200
-   
+
+    except QueueFullError as e:
+        app.logger.warning(f"Rejecting multi-LLM round: {e}")
+        return busy_response(str(e), 429, e.retry_after)
+    except RequestCancelled as e:
+        app.logger.info(f"Multi-LLM debate stopped: {e}")
+        return jsonify({"error": str(e)}), 499
+    except MemoryBudgetExceeded as e:
+        app.logger.warning(f"Rejecting multi-LLM round: {e}")
+        return jsonify({"error": str(e)}), 413
+    except TimeoutError as e:
+        app.logger.warning(f"Multi-LLM round timed out: {e}")
+        return timeout_response(e, deadline)
+    except ValueError as e:
+        app.logger.error(f"Validation error in generate_multi_llm: {str(e)}")
+        return jsonify({"error": f"Validation Error: {str(e)}"}), 400
     except Exception as e:
         app.logger.error(f"Error in generate_multi_llm: {str(e)}\n{traceback.format_exc()}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
+    finally:
+        if scope is not None:
+            cancel_scopes.close(scope)
 
 
 
     
 
+def build_persona_input(prompt):
+    input_prompt = [
+        {"role": "user", "content": f"{SYSTEM_MESSAGE}\n\n{prompt}"},
+    ]
+    return encode_chat(tokenizer, input_prompt)
+
+def sampling_params(data):
+    """Sampling parameters of a request; ValueError naming the field if one is invalid."""
+    seed = data.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+        raise ValueError(f"Invalid seed value: {seed!r}")
+    temperature = number_field(data, "temperature", 1.0)
+    if temperature < 0:
+        raise ValueError(f"Invalid temperature value: {temperature!r}")
+    top_p = number_field(data, "top_p", 1.0)
+    if not 0 <= top_p <= 1:
+        raise ValueError(f"Invalid top_p value: {top_p!r}")
+    return {
+        "max_new_tokens": 256,
+        "do_sample": bool(data.get("do_sample", False)),
+        "temperature": temperature,
+        "top_p": top_p,
+        "seed": seed,
+        "stop_on_repetition": bool(data.get("stop_on_repetition", True)),
+    }
+
+def response_cache_key(data, persona_name, prompt, params):
+    """Cache key for requests that opted in with "cache": true and are reproducible."""
+    if not data.get("cache"):
+        return None
+    if not is_cacheable(params):
+        response_cache.record_uncacheable()
+        return None
+    return response_cache.make_key(persona_name, prompt, params)
+
 @app.route("/generate", methods=["POST"])
 def generate():
     data = request.get_json()
     app.logger.info(f"Received payload: {data}")
+    if not isinstance(data, dict):
+        return jsonify({"error": "Invalid JSON format"}), 400
 
     # Validate input data
     prompt = data.get("prompt", "").strip()
@@ -267,37 +687,63 @@ def generate():
         return jsonify({"error": "No prompt provided"}), 400
     if not persona_name:
         return jsonify({"error": "No persona name provided"}), 400
-
     try:
-       
-
-        # Tokenize the input
-        # Load the adapter using persona_name
-        adapter_path_persona = adapter_path.format(persona_name)
-        peft_model = PeftModel.from_pretrained(model, adapter_path_persona, adapter_name=persona_name)
-        app.logger.info(f"Using adapter: {persona_name}")
+        deadline, timeout = request_limits(data)
+        params = sampling_params(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        system_message = "Sen bir Türk köşe yazarısın. Görevin sorulan soru hakkındaki fikrini ve gerekçesini açıklamaktır."
-        question = prompt
+    scope = None
+    try:
+        cache_key = response_cache_key(data, persona_name, prompt, params)
+        if cache_key is not None:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return jsonify({"response": cached, "cached": True})
 
-        input_prompt = [
-            {"role": "user", "content": f"{system_message}\n\n{prompt}"},
-        ]
-        input_ids = tokenizer.apply_chat_template(input_prompt, return_tensors="pt", return_dict=True).to("cuda")
+        input_ids = build_persona_input(prompt)
 
-        # Generate response
-        outputs = peft_model.generate(
-            **input_ids,
-            max_new_tokens=256,
+        # Queue the request; the scheduler batches it with other concurrent requests
+        # and resumes from the persona's cached system-prompt prefix
+        app.logger.info(f"Using adapter: {persona_name}")
+        scope = open_cancel_scope(data, deadline)
+        gen_request = scope.submit(
+            GenerationRequest(
+                persona_name,
+                input_ids,
+                timeout=timeout,
+                prefix_cache=cached_persona_prefix(persona_name, input_ids),
+                **params,
+            )
         )
+        output_ids = gen_request.result()
 
         # Decode generated text
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        generated_text = generated_text.split("\nmodel\n")[1].strip()
+        with profiling.span("detokenize", tokens=len(output_ids)):
+            generated_text = tokenizer.decode(output_ids, skip_special_tokens=True).strip()
         app.logger.info(f"Generated text: {generated_text}")
 
-        return jsonify({"response": generated_text})
-
+        if cache_key is not None:
+            response_cache.put(cache_key, generated_text)
+
+        return jsonify({
+            "response": generated_text,
+            "finish_reason": gen_request.finish_reason,
+            "usage": gen_request.usage(),
+        })
+
+    except QueueFullError as e:
+        app.logger.warning(f"Rejecting request for persona {persona_name}: {e}")
+        return busy_response(str(e), 429, e.retry_after)
+    except TimeoutError as e:
+        app.logger.warning(f"Request for persona {persona_name} timed out: {e}")
+        return timeout_response(e, deadline)
+    except RequestCancelled as e:
+        app.logger.info(f"Request for persona {persona_name} stopped: {e}")
+        return jsonify({"error": str(e)}), 499
+    except MemoryBudgetExceeded as e:
+        app.logger.warning(f"Rejecting request for persona {persona_name}: {e}")
+        return jsonify({"error": str(e)}), 413
     except torch.cuda.OutOfMemoryError:
         app.logger.error(f"Out of memory for persona: {persona_name}. Skipping...")
         torch.cuda.empty_cache()
@@ -308,10 +754,252 @@ def generate():
     except Exception as e:
         app.logger.error(f"Error during generation: {traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if scope is not None:
+            cancel_scopes.close(scope)
+
+@app.route("/generate_stream", methods=["POST"])
+def generate_stream():
+    """
+    Same as /generate, but streams the answer as server-sent events.
+
+    Each event carries a JSON object: {"token": "..."} for every decoded chunk, then a
+    final {"response": "...", "finish_reason": "..."} or {"error": "..."}.
+    """
+    data = request.get_json()
+    app.logger.info(f"Received streaming payload: {data}")
+    if not isinstance(data, dict):
+        return jsonify({"error": "Invalid JSON format"}), 400
 
+    prompt = data.get("prompt", "").strip()
+    persona_name = data.get("persona_name", "").strip()
+    if not prompt:
+        return jsonify({"error": "No prompt provided"}), 400
+    if not persona_name:
+        return jsonify({"error": "No persona name provided"}), 400
+    try:
+        deadline, timeout = request_limits(data)
+        params = sampling_params(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    cache_key = response_cache_key(data, persona_name, prompt, params)
+    cached = response_cache.get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        final = {"response": cached, "finish_reason": "cached", "cached": True}
+        profile = g.get("profile")
+        if profile is not None:
+            final["profile"] = profile.to_json()
+            profiler.finish(profile)
+        body = (
+            f"data: {json.dumps({'token': cached}, ensure_ascii=False)}\n\n"
+            f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+        )
+        return Response(body, mimetype="text/event-stream")
 
-    
+    scope = open_cancel_scope(data, deadline)
+    try:
+        input_ids = build_persona_input(prompt)
+        gen_request = scope.submit(
+            GenerationRequest(
+                persona_name,
+                input_ids,
+                stream=True,
+                timeout=timeout,
+                prefix_cache=cached_persona_prefix(persona_name, input_ids),
+                **params,
+            )
+        )
+    except QueueFullError as e:
+        cancel_scopes.close(scope)
+        app.logger.warning(f"Rejecting streaming request for persona {persona_name}: {e}")
+        return busy_response(str(e), 429, e.retry_after)
+    except MemoryBudgetExceeded as e:
+        cancel_scopes.close(scope)
+        app.logger.warning(f"Rejecting streaming request for persona {persona_name}: {e}")
+        return jsonify({"error": str(e)}), 413
+    except (ValueError, RequestCancelled) as e:
+        cancel_scopes.close(scope)
+        app.logger.error(f"Error with persona {persona_name}: {e}")
+        return jsonify({"error": f"Invalid persona: {persona_name}. {str(e)}"}), 400
 
+    profile = g.get("profile")
+
+    def events():
+        token_ids = []
+        text = ""
+        try:
+            for token_id in gen_request.stream():
+                token_ids.append(token_id)
+                decoded = tokenizer.decode(token_ids, skip_special_tokens=True)
+                # Hold back partial multi-byte characters until the next token completes them
+                if decoded.endswith("\ufffd"):
+                    continue
+                chunk, text = decoded[len(text):], decoded
+                if chunk:
+                    yield f"data: {json.dumps({'token': chunk}, ensure_ascii=False)}\n\n"
+            final = {
+                "response": tokenizer.decode(token_ids, skip_special_tokens=True).strip(),
+                "finish_reason": gen_request.finish_reason,
+                "usage": gen_request.usage(),
+            }
+            if cache_key is not None:
+                response_cache.put(cache_key, final["response"])
+        except Exception as e:
+            app.logger.error(f"Error during streaming generation: {traceback.format_exc()}")
+            final = {"error": str(e)}
+        finally:
+            # Also runs when the client disconnects and the server closes this generator,
+            # which stops the request at the scheduler's next step
+            cancel_scopes.close(scope)
+        if profile is not None:
+            final["profile"] = profile.to_json()
+            profiler.finish(profile)
+        yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def batch_record_request(record):
+    prompt = str(record.get("prompt", "")).strip()
+    persona_name = str(record.get("persona_name", "")).strip()
+    if not prompt or not persona_name:
+        raise ValueError("Every record needs a persona_name and a prompt")
+    params = sampling_params(record)
+    params["max_new_tokens"] = int(record.get("max_new_tokens", params["max_new_tokens"]))
+    input_ids = build_persona_input(prompt)
+    return GenerationRequest(
+        persona_name,
+        input_ids,
+        prefix_cache=cached_persona_prefix(persona_name, input_ids),
+        **params,
+    )
+
+batch_jobs = BatchJobManager(
+    batch_scheduler,
+    tokenizer,
+    batch_record_request,
+    job_dir=BATCH_JOB_DIR,
+    max_in_flight=BATCH_JOB_IN_FLIGHT,
+    on_submit=lambda gen_request: metrics.track(gen_request, "generate_batch"),
+)
+
+def stream_batch_job(job, start=0):
+    """JSONL response: one line per result in completion order, then the job's status."""
+    def lines():
+        yield json.dumps({"job_id": job.job_id, "total": len(job.records)}) + "\n"
+        for line in job.follow(start):
+            yield line + "\n"
+        yield json.dumps({"status": job.status()}) + "\n"
+
+    return Response(lines(), mimetype="application/x-ndjson", headers={"X-Batch-Job-Id": job.job_id})
+
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    """
+    Start (or resume) an offline generation job.
+
+    The body is either JSONL, one {"persona_name", "prompt", optional "id" and sampling
+    params} record per line, or {"records": [...], "job_id": ...}. Results stream back as
+    JSONL in completion order; with "stream": false (or ?stream=0) the job id is returned
+    right away and results can be followed later at GET /generate_batch/<job_id>.
+    """
+    job_id = request.args.get("job_id")
+    stream = request.args.get("stream", "1") != "0"
+    data = request.get_json(silent=True)
+    try:
+        if isinstance(data, dict):
+            records = data.get("records")
+            job_id = data.get("job_id", job_id)
+            stream = bool(data.get("stream", stream))
+        else:
+            body = request.get_data(as_text=True)
+            records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        if records is not None and not all(isinstance(r, dict) for r in records):
+            raise ValueError("Records must be JSON objects")
+        job = batch_jobs.start(records, job_id)
+    except (ValueError, json.JSONDecodeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    app.logger.info(f"Batch job {job.job_id}: {len(job.remaining())} of {len(job.records)} records to generate")
+    if not stream:
+        return jsonify(job.status()), 202
+    return stream_batch_job(job)
+
+@app.route("/generate_batch/<job_id>", methods=["GET"])
+def follow_batch_job(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown batch job: {job_id}"}), 404
+    return stream_batch_job(job, start=int(request.args.get("from", 0)))
+
+@app.route("/generate_batch/<job_id>", methods=["DELETE"])
+def cancel_batch_job(job_id):
+    job = batch_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown batch job: {job_id}"}), 404
+    return jsonify(job.status())
+
+@app.route("/batch_jobs", methods=["GET"])
+def batch_job_stats():
+    return jsonify(batch_jobs.stats())
+
+def preload_persona_names():
+    if PRELOAD_PERSONAS.strip().lower() == "all":
+        adapter_dir = os.path.dirname(adapter_path.format(""))
+        return sorted(
+            name for name in os.listdir(adapter_dir)
+            if os.path.isfile(os.path.join(adapter_dir, name, "adapter_config.json"))
+        )
+    return [p.strip() for p in PRELOAD_PERSONAS.split(",") if p.strip()]
+
+def warm_up():
+    """
+    Load the preloaded personas and run one short generation for each, so kernel
+    selection, allocator growth and prefix prefill happen before real traffic arrives.
+    """
+    personas = preload_persona_names()
+    if MAX_RESIDENT_ADAPTERS and len(personas) > MAX_RESIDENT_ADAPTERS:
+        app.logger.warning(f"Preloading {len(personas)} personas but only {MAX_RESIDENT_ADAPTERS} stay resident")
+
+    pending = {}
+    for persona_name in personas:
+        startup_status["adapters"][persona_name] = {"status": "loading"}
+        try:
+            input_ids = build_persona_input("Merhaba")
+            pending[persona_name] = batch_scheduler.submit(
+                GenerationRequest(
+                    persona_name,
+                    input_ids,
+                    max_new_tokens=WARMUP_MAX_NEW_TOKENS,
+                    timeout=REQUEST_TIMEOUT_S,
+                    prefix_cache=cached_persona_prefix(persona_name, input_ids),
+                )
+            )
+        except Exception as e:
+            app.logger.error(f"Preloading persona {persona_name} failed: {e}")
+            startup_status["adapters"][persona_name] = {"status": "failed", "error": str(e)}
+
+    for persona_name, gen_request in pending.items():
+        try:
+            gen_request.result()
+            startup_status["adapters"][persona_name] = {
+                "status": "ready",
+                "warmup_seconds": round(gen_request.finished_at - gen_request.submitted_at, 3),
+            }
+        except Exception as e:
+            app.logger.error(f"Warmup generation for persona {persona_name} failed: {e}")
+            startup_status["adapters"][persona_name] = {"status": "failed", "error": str(e)}
+
+    startup_status["state"] = "ready"
+    startup_status["ready_at"] = time.time()
+    app.logger.info(f"Warmup finished in {startup_status['ready_at'] - startup_status['started_at']:.1f}s")
+
+threading.Thread(target=warm_up, name="warmup", daemon=True).start()
 
 if __name__ == "__main__":
-    app.run(host="10.3.0.96", port=5000, debug=False)
+    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=False, threaded=True)
@@ -0,0 +1,305 @@
+import copy
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+from peft.tuners.lora import LoraLayer
+from peft.utils.integrations import dequantize_bnb_weight
+
+from batch_scheduler import ContinuousBatchScheduler, GenerationRequest, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_memo(peft_model):
+    """
+    deepcopy memo that shares every module except the ancestors of LoRA layers. The copy
+    therefore only duplicates the module tree leading to the wrapped projections, which
+    _merge_dense then swaps out without touching the primary model.
+    """
+    lora_names = [name for name, module in peft_model.named_modules() if isinstance(module, LoraLayer)]
+    memo = {}
+    for name, module in peft_model.named_modules():
+        prefix = f"{name}." if name else ""
+        if not any(lora.startswith(prefix) for lora in lora_names if lora != name):
+            memo[id(module)] = module
+    return memo
+
+
+def _dense_weight(base_layer):
+    """Weight of a possibly quantized linear layer, in its compute dtype."""
+    weight = base_layer.weight
+    if callable(weight):  # torch dynamic int8 linear
+        return weight().dequantize()
+    if hasattr(weight, "quant_state"):  # bitsandbytes 4-bit
+        return dequantize_bnb_weight(weight, state=weight.quant_state)
+    if hasattr(weight, "SCB"):  # bitsandbytes 8-bit
+        return dequantize_bnb_weight(weight, state=base_layer.state)
+    return weight.data
+
+
+def _merge_dense(model, adapter_name):
+    """
+    Replace every LoRA layer with a plain Linear holding base + delta. Unlike
+    merge_and_unload, this never re-quantizes: a 4-bit base is dequantized first, so the
+    small LoRA delta survives the merge.
+    """
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, LoraLayer):
+            continue
+        base = module.get_base_layer()
+        weight = _dense_weight(base)
+        weight = weight + module.get_delta_weight(adapter_name).to(weight.dtype)
+        linear = torch.nn.Linear(
+            base.in_features, base.out_features, bias=base.bias is not None, device=weight.device, dtype=weight.dtype
+        )
+        with torch.no_grad():
+            linear.weight.copy_(weight)
+            if base.bias is not None:
+                linear.bias.copy_(base.bias)
+        parent_name, _, child = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child, linear)
+    return model.get_base_model()
+
+
+class MergedAdapter:
+    """
+    AdapterRegistry stand-in for a model with a single adapter merged into its weights,
+    so a regular ContinuousBatchScheduler can drive it.
+    """
+
+    def __init__(self, adapter_name, model):
+        self.adapter_name = adapter_name
+        self.model = model
+        self.lock = threading.RLock()
+
+    def peft_model(self, adapter_names=None, **inputs):
+        return self.model(**inputs)
+
+    def acquire(self, *adapter_names):
+        return self.peft_model
+
+    def release(self, *adapter_names):
+        pass
+
+    @contextmanager
+    def use(self, *adapter_names):
+        with self.lock:
+            yield self.peft_model
+
+    def resident_adapters(self):
+        return [self.adapter_name]
+
+
+class Replica:
+    def __init__(self, adapter_name, scheduler, build_seconds):
+        self.adapter_name = adapter_name
+        self.scheduler = scheduler
+        self.build_seconds = build_seconds
+        self.created_at = time.time()
+        self.draining = False
+        self.requests = 0
+
+    def idle(self):
+        stats = self.scheduler.stats()
+        return stats["waiting"] == 0 and stats["active"] == 0
+
+
+class HotReplicaRouter:
+    """
+    Routes traffic of hot personas to dedicated replicas with the adapter merged in.
+
+    Every submitted request is counted per persona over a sliding window. When a
+    persona's rate reaches hot_rpm, a replica is built from the shared PeftModel: each
+    LoRA-wrapped projection is replaced by a dense copy in the compute dtype (dequantized
+    from 4-bit or int8 if need be) with the persona's delta added, and everything else is
+    shared with the primary model. That
+    persona's requests then run on the replica's own scheduler without any LoRA
+    overhead. Once the rate falls below cool_rpm the replica stops taking requests,
+    drains and is released.
+
+    Cached prefixes computed on the primary model stay valid on a replica, since the
+    merged weights produce the same keys and values as base + LoRA up to rounding. The
+    dense projections do cost memory: for a 4-bit base, roughly four times what the
+    quantized q/v projections take.
+    """
+
+    def __init__(self, scheduler, registry, tokenizer, device, eos_token_ids, max_replicas=1, hot_rpm=30,
+                 cool_rpm=10, window_s=60, max_batch_size=8, max_queue_size=64):
+        self.scheduler = scheduler
+        self.registry = registry
+        self.tokenizer = tokenizer
+        self.device = device
+        self.eos_token_ids = eos_token_ids
+        self.max_replicas = max_replicas
+        self.hot_rpm = hot_rpm
+        self.cool_rpm = cool_rpm
+        self.window_s = window_s
+        self.max_batch_size = max_batch_size
+        self.replica_queue_size = max_queue_size
+        self.max_queue_size = scheduler.max_queue_size
+
+        self._lock = threading.Lock()
+        self._arrivals = {}  # adapter name -> deque of submit timestamps
+        self._replicas = {}  # adapter name -> Replica
+        self._failed_at = {}  # adapter name -> time of the last failed build
+        self._counters = {
+            "replica_builds": 0,
+            "replica_build_failures": 0,
+            "replica_teardowns": 0,
+            "replica_requests": 0,
+            "primary_requests": 0,
+        }
+
+        self._monitor = threading.Thread(target=self._run, name="hot-replicas", daemon=True)
+        self._monitor.start()
+
+    def submit(self, request):
+        with self._lock:
+            self._arrivals.setdefault(request.adapter_name, deque()).append(time.time())
+            replica = self._replicas.get(request.adapter_name)
+            # Submitting under the lock keeps requests from reaching a replica being torn down
+            if replica is not None and not replica.draining:
+                try:
+                    replica.scheduler.submit(request)
+                    replica.requests += 1
+                    self._counters["replica_requests"] += 1
+                    return request
+                except QueueFullError:
+                    pass  # the primary still serves this persona
+
+        self.scheduler.submit(request)
+        with self._lock:
+            self._counters["primary_requests"] += 1
+        return request
+
+    def rates(self):
+        """Requests per minute of every persona over the sliding window."""
+        cutoff = time.time() - self.window_s
+        with self._lock:
+            rates = {}
+            for adapter_name, arrivals in list(self._arrivals.items()):
+                while arrivals and arrivals[0] < cutoff:
+                    arrivals.popleft()
+                if not arrivals:
+                    del self._arrivals[adapter_name]
+                    continue
+                rates[adapter_name] = len(arrivals) * 60.0 / self.window_s
+            return rates
+
+    def _run(self):
+        while True:
+            time.sleep(self.window_s / 6)
+            try:
+                self._rebalance()
+            except Exception as e:
+                logger.error(f"Hot replica rebalance failed: {e}")
+
+    def _rebalance(self):
+        rates = self.rates()
+        now = time.time()
+
+        for adapter_name, replica in list(self._replicas.items()):
+            if not replica.draining and rates.get(adapter_name, 0.0) < self.cool_rpm:
+                logger.info(f"Persona {adapter_name} cooled down, draining its replica")
+                with self._lock:
+                    replica.draining = True
+            if replica.draining and replica.idle():
+                self._teardown(replica)
+
+        hot = sorted(
+            (rate, adapter_name) for adapter_name, rate in rates.items()
+            if rate >= self.hot_rpm
+            and adapter_name not in self._replicas
+            and now - self._failed_at.get(adapter_name, 0) > self.window_s
+        )
+        while hot and len(self._replicas) < self.max_replicas:
+            rate, adapter_name = hot.pop()
+            logger.info(f"Persona {adapter_name} is hot ({rate:.1f} req/min), building a merged replica")
+            self._build(adapter_name)
+
+    def _build(self, adapter_name):
+        start = time.time()
+        try:
+            # The adapter stays pinned while it is merged; only the copy needs the model lock
+            peft_model = self.registry.acquire(adapter_name)
+            try:
+                with self.registry.lock:
+                    replica_model = copy.deepcopy(peft_model, _shared_memo(peft_model))
+                merged = _merge_dense(replica_model, adapter_name)
+            finally:
+                self.registry.release(adapter_name)
+            merged.eval()
+        except Exception as e:
+            logger.error(f"Building a replica for {adapter_name} failed: {e}")
+            self._failed_at[adapter_name] = time.time()
+            self._counters["replica_build_failures"] += 1
+            torch.cuda.empty_cache()
+            return
+
+        scheduler = ContinuousBatchScheduler(
+            MergedAdapter(adapter_name, merged),
+            self.tokenizer,
+            self.device,
+            self.eos_token_ids,
+            max_batch_size=self.max_batch_size,
+            max_queue_size=self.replica_queue_size,
+            # KV caches of the replica come out of the same memory as the primary's
+            admission=self.scheduler.admission,
+            repetition=self.scheduler.repetition,
+        )
+        with self._lock:
+            self._replicas[adapter_name] = Replica(adapter_name, scheduler, time.time() - start)
+            self._counters["replica_builds"] += 1
+
+    def _teardown(self, replica):
+        with self._lock:
+            del self._replicas[replica.adapter_name]
+            self._counters["replica_teardowns"] += 1
+        replica.scheduler.close()
+        logger.info(f"Released the replica for {replica.adapter_name} after {replica.requests} requests")
+        del replica
+        torch.cuda.empty_cache()
+
+    def cancel(self, request):
+        # Replica and primary schedulers both watch the request's own flag
+        request.cancel()
+
+    def queue_depth(self):
+        return self.scheduler.queue_depth() + sum(r.scheduler.queue_depth() for r in list(self._replicas.values()))
+
+    def retry_after(self):
+        return self.scheduler.retry_after()
+
+    def generate(self, adapter_name, input_ids, **kwargs):
+        return self.submit(GenerationRequest(adapter_name, input_ids, **kwargs)).result()
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        replicas = {}
+        for adapter_name, replica in list(self._replicas.items()):
+            replica_stats = replica.scheduler.stats()
+            stats["active"] += replica_stats["active"]
+            stats["waiting"] += replica_stats["waiting"]
+            replicas[adapter_name] = {
+                "draining": replica.draining,
+                "requests": replica.requests,
+                "build_seconds": round(replica.build_seconds, 3),
+                "age_s": round(time.time() - replica.created_at, 1),
+                "active": replica_stats["active"],
+                "waiting": replica_stats["waiting"],
+            }
+        with self._lock:
+            counters = dict(self._counters)
+        stats["hot_replicas"] = {
+            **counters,
+            "replicas": replicas,
+            "rates": {k: round(v, 1) for k, v in self.rates().items()},
+            "max_replicas": self.max_replicas,
+            "hot_rpm": self.hot_rpm,
+            "cool_rpm": self.cool_rpm,
+        }
+        return stats
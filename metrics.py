@@ -0,0 +1,233 @@
+import logging
+import os
+import queue
+import resource
+import threading
+
+import torch
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5)
+ADAPTER_LOAD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _labels(self.labelnames, key, [("le", _number(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Sampled at scrape time: fn() returns {label values tuple: value}."""
+
+    def __init__(self, name, help, labelnames, fn):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.fn().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+def memory_usage():
+    """Bytes in use per (device, kind): CUDA allocator stats per GPU and the process RSS."""
+    usage = {}
+    if torch.cuda.is_available():
+        for index in range(torch.cuda.device_count()):
+            device = f"cuda:{index}"
+            usage[(device, "allocated")] = torch.cuda.memory_allocated(index)
+            usage[(device, "reserved")] = torch.cuda.memory_reserved(index)
+            usage[(device, "peak_allocated")] = torch.cuda.max_memory_allocated(index)
+    try:
+        with open("/proc/self/statm") as f:
+            usage[("cpu", "rss")] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    usage[("cpu", "peak_rss")] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return usage
+
+
+class InferenceMetrics:
+    """
+    Prometheus metrics of the inference server, rendered in the text exposition format.
+
+    Generation requests are observed once they finish: their done callback, which runs
+    on the scheduler thread, only queues them, and a metrics thread does the histogram
+    updates, so the decode loop never waits on a metrics lock. Requests the scheduler
+    refuses (queue full, over the memory budget) are counted by reject(). Per-token latency is the request's decode
+    time divided by the tokens after the first, which keeps it one observation per
+    request; real tokens/sec per persona is rate(llm_completion_tokens_total).
+    """
+
+    def __init__(self):
+        labels = ("endpoint", "persona")
+        self.queue_seconds = Histogram(
+            "llm_queue_seconds", "Time from submission until the request joined the batch.", labels
+        )
+        self.ttft_seconds = Histogram(
+            "llm_time_to_first_token_seconds", "Time from submission until the first generated token.", labels
+        )
+        self.token_seconds = Histogram(
+            "llm_decode_token_seconds", "Average decode latency per generated token.", labels,
+            TOKEN_LATENCY_BUCKETS,
+        )
+        self.request_seconds = Histogram(
+            "llm_request_seconds", "Time from submission until generation finished.", labels
+        )
+        self.http_seconds = Histogram(
+            "llm_http_request_seconds", "HTTP handler latency until the response is returned.", ("endpoint", "status")
+        )
+        self.adapter_load_seconds = Histogram(
+            "llm_adapter_load_seconds", "Time to read a persona adapter from disk and attach it.", ("persona",),
+            ADAPTER_LOAD_BUCKETS,
+        )
+        self.requests = Counter(
+            "llm_generation_requests_total", "Finished generation requests.", labels + ("finish_reason",)
+        )
+        self.prompt_tokens = Counter("llm_prompt_tokens_total", "Prompt tokens of finished requests.", labels)
+        self.completion_tokens = Counter("llm_completion_tokens_total", "Generated tokens.", labels)
+        self.rejected = Counter(
+            "llm_rejected_requests_total", "Generation requests refused at submission.", labels + ("reason",)
+        )
+        self.repetition_tokens_saved = Counter(
+            "llm_repetition_tokens_saved_total",
+            "Tokens of max_new_tokens left ungenerated because the output fell into a repetition loop.",
+            labels,
+        )
+        self._metrics = [
+            self.queue_seconds,
+            self.ttft_seconds,
+            self.token_seconds,
+            self.request_seconds,
+            self.http_seconds,
+            self.adapter_load_seconds,
+            self.requests,
+            self.prompt_tokens,
+            self.completion_tokens,
+            self.rejected,
+            self.repetition_tokens_saved,
+            Gauge("llm_memory_bytes", "Memory in use by the inference process.", ("device", "kind"), memory_usage),
+        ]
+        self._finished = queue.SimpleQueue()
+        threading.Thread(target=self._observe_finished, name="metrics", daemon=True).start()
+
+    def add_gauge(self, name, help, fn):
+        """Unlabelled gauge sampled from fn() at scrape time."""
+        self._metrics.append(Gauge(name, help, (), lambda: {(): fn()}))
+
+    def watch_registry(self, registry):
+        def on_event(event, adapter_name):
+            if event == "loaded":
+                self.adapter_load_seconds.observe(registry.load_seconds[adapter_name], persona=adapter_name)
+
+        registry.add_listener(on_event)
+
+    def track(self, request, endpoint):
+        request.add_done_callback(lambda r: self._finished.put((r, endpoint)))
+
+    def reject(self, request, endpoint, error):
+        reason = {"QueueFullError": "queue_full", "MemoryBudgetExceeded": "memory_budget", "ValueError": "invalid"}.get(
+            type(error).__name__, type(error).__name__
+        )
+        self.rejected.inc(endpoint=endpoint, persona=request.adapter_name, reason=reason)
+
+    def _observe_finished(self):
+        while True:
+            r, endpoint = self._finished.get()
+            try:
+                self._observe(r, endpoint)
+            except Exception as e:
+                logger.error(f"Recording metrics of request {r.id} failed: {e}")
+
+    def _observe(self, r, endpoint):
+        labels = {"endpoint": endpoint, "persona": r.adapter_name}
+        # Pooled requests are admitted inside their worker, so admitted_at stays unset here
+        if r.admitted_at is not None:
+            self.queue_seconds.observe(r.admitted_at - r.submitted_at, **labels)
+        if r.first_token_at is not None:
+            self.ttft_seconds.observe(r.first_token_at - r.submitted_at, **labels)
+            if len(r.output_ids) > 1:
+                self.token_seconds.observe((r.finished_at - r.first_token_at) / (len(r.output_ids) - 1), **labels)
+        self.request_seconds.observe(r.finished_at - r.submitted_at, **labels)
+        self.requests.inc(finish_reason=r.finish_reason, **labels)
+        self.prompt_tokens.inc(len(r.input_ids), **labels)
+        self.completion_tokens.inc(len(r.output_ids), **labels)
+        if r.finish_reason == "repetition":
+            self.repetition_tokens_saved.inc(r.max_new_tokens - len(r.output_ids), **labels)
+
+    def observe_http(self, endpoint, status, seconds):
+        self.http_seconds.observe(seconds, endpoint=endpoint, status=status)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
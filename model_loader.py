@@ -0,0 +1,126 @@
+import os
+
+import torch
+from torch import nn
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import BitsAndBytesConfig
+
+
+def quantization_config():
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=torch.float16,
+        bnb_4bit_use_double_quant=True
+    )
+
+
+def load_tokenizer(path):
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    return tokenizer
+
+
+def load_quantized(model_id):
+    """Read the fp16 checkpoint and quantize it to 4-bit while loading (slow)."""
+    return AutoModelForCausalLM.from_pretrained(
+        model_id,
+        quantization_config=quantization_config(),
+        device_map="auto",
+        torch_dtype=torch.float16,
+        use_cache=True
+    )
+
+
+def is_prequantized_artifact(path):
+    if not path or not os.path.isfile(os.path.join(path, "config.json")):
+        return False
+    return any(name.endswith(".safetensors") for name in os.listdir(path))
+
+
+def load_prequantized(artifact_dir):
+    """
+    Load 4-bit weights written by export_quantized.py.
+
+    The quantization config travels in config.json, so nothing is re-quantized, and the
+    safetensors shards are memory-mapped instead of being read through pickle.
+    """
+    return AutoModelForCausalLM.from_pretrained(
+        artifact_dir,
+        device_map="auto",
+        torch_dtype=torch.float16,
+        use_cache=True,
+        use_safetensors=True
+    )
+
+
+# LoRA persona adapters wrap these projections, so they have to stay plain nn.Linear;
+# lm_head shares its weight with the embedding table
+CPU_FLOAT_MODULES = ("q_proj", "v_proj", "lm_head")
+
+
+def configure_cpu_threads(num_threads=None):
+    """Pin intra-op threads to the cores this process may run on and keep inter-op serial."""
+    num_threads = num_threads or len(os.sched_getaffinity(0))
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before the first parallel region has run
+        pass
+    return num_threads
+
+
+def load_cpu_int8(model_id):
+    """
+    Load the fp32 checkpoint on the CPU and quantize its linear layers to int8.
+
+    Weights are quantized once at load time and activations per batch (dynamic
+    quantization), which maps onto the fbgemm/onednn int8 GEMM kernels.
+    """
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        torch_dtype=torch.float32,
+        low_cpu_mem_usage=True,
+        use_cache=True
+    )
+    quantize = {
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.rsplit(".", 1)[-1] not in CPU_FLOAT_MODULES
+    }
+    return torch.ao.quantization.quantize_dynamic(model, quantize, dtype=torch.qint8)
+
+
+def load_model(backend, model_id, quantized_dir=None, cpu_threads=None, stub_token_latency_s=0.0):
+    """Return (model, tokenizer, device) for the "cuda" (4-bit), "cpu" (int8) or "stub" backend."""
+    if backend == "stub":
+        from stub_backend import load_stub
+
+        configure_cpu_threads(cpu_threads)
+        print("Loading the stub model (tiny random weights, no checkpoint)...")
+        model, tokenizer = load_stub(token_latency_s=stub_token_latency_s)
+        device = torch.device("cpu")
+    elif backend == "cpu":
+        threads = configure_cpu_threads(cpu_threads)
+        print(f"Loading tokenizer from: {model_id}")
+        tokenizer = load_tokenizer(model_id)
+        print(f"Loading model on CPU (dynamic int8, {threads} threads)...")
+        model = load_cpu_int8(model_id)
+        device = torch.device("cpu")
+    elif backend == "cuda":
+        if is_prequantized_artifact(quantized_dir):
+            print(f"Loading pre-quantized model and tokenizer from: {quantized_dir}")
+            tokenizer = load_tokenizer(quantized_dir)
+            model = load_prequantized(quantized_dir)
+        else:
+            print(f"Loading tokenizer from: {model_id}")
+            tokenizer = load_tokenizer(model_id)
+            print("Loading model (quantizing to 4-bit, run export_quantized.py to skip this)...")
+            model = load_quantized(model_id)
+        device = torch.device("cuda")
+    else:
+        raise ValueError(f"Unknown inference backend: {backend}")
+
+    # Inference only: no gradient checkpointing, no dropout
+    model.eval()
+    return model, tokenizer, device
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from batch_scheduler import from_model_cache, to_model_cache
+from dialogue_cache import common_prefix_length
+
+
+class PrefixEntry:
+    def __init__(self, token_ids, past):
+        self.token_ids = token_ids
+        self.past = past
+        self.size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+class PrefixCache:
+    """
+    LRU cache of prefilled prompt prefixes, keyed by (adapter, rendered prefix).
+
+    Persona prompts all open with the same chat-template header and system message.
+    The first request for an adapter prefills that prefix once; later requests hand the
+    stored keys/values to the scheduler and only prefill their own question. Values
+    depend on the adapter (LoRA touches v_proj), hence one entry per adapter.
+    """
+
+    def __init__(self, registry, tokenizer, device, max_bytes):
+        self.registry = registry
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "reused_tokens": 0}
+
+    def lookup(self, adapter_name, prefix_text, prompt_ids):
+        """
+        Return (key, value) tuples covering the longest cached prefix of prompt_ids,
+        prefilling and storing prefix_text first if needed. Returns None if nothing usable.
+        """
+        key = (adapter_name, prefix_text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+            else:
+                self._counters["misses"] += 1
+
+        if entry is None:
+            entry = self._prefill(adapter_name, prefix_text)
+            with self._lock:
+                self._entries[key] = entry
+                self._evict()
+
+        usable = min(common_prefix_length(entry.token_ids, prompt_ids), len(prompt_ids) - 1)
+        if usable <= 0:
+            return None
+        with self._lock:
+            self._counters["reused_tokens"] += usable
+        if usable == len(entry.token_ids):
+            return entry.past
+        return tuple((k[:, :, :usable], v[:, :, :usable]) for k, v in entry.past)
+
+    def _prefill(self, adapter_name, prefix_text):
+        token_ids = self.tokenizer(prefix_text, add_special_tokens=False)["input_ids"]
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        with self.registry.use(adapter_name) as peft_model, torch.no_grad():
+            outputs = peft_model(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=to_model_cache(None),
+                use_cache=True,
+                adapter_names=[adapter_name],
+            )
+        return PrefixEntry(token_ids, from_model_cache(outputs.past_key_values))
+
+    def _evict(self):
+        while len(self._entries) > 1 and sum(e.size for e in self._entries.values()) > self.max_bytes:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "cached_bytes": sum(e.size for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,166 @@
+"""
+Per-request timing spans for the generation path.
+
+Code on the request thread wraps its stages in span(...), which records into the
+profile of the current request and costs a single context variable lookup when the
+request is not being profiled. Stages that run on the batch scheduler thread (queueing,
+prefill and decode) are reconstructed from the timestamps every GenerationRequest
+already carries, so the decode loop itself is never instrumented.
+"""
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("profile", default=None)
+
+
+def _span(name, start, end, thread, args):
+    return {"name": name, "start": start, "end": end, "thread": thread, "args": args}
+
+
+class Profile:
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.spans = []
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, thread=None, **args):
+        with self._lock:
+            self.spans.append(_span(name, start, end, thread or threading.current_thread().name, args))
+
+    def track(self, gen_request):
+        """Add the request's scheduler stages once the profile is rendered."""
+        with self._lock:
+            self._requests.append(gen_request)
+
+    def _request_spans(self):
+        spans = []
+        for r in self._requests:
+            lane = f"request-{r.id}"
+            args = {"persona": r.adapter_name}
+            end = r.finished_at or time.time()
+            # Pooled requests are admitted inside their worker, without a timestamp here
+            prefill_from = r.admitted_at or r.submitted_at
+            if r.admitted_at is not None:
+                spans.append(_span("queue", r.submitted_at, r.admitted_at, lane, args))
+            if r.first_token_at is not None:
+                name = "prefill" if r.admitted_at is not None else "queue_and_prefill"
+                spans.append(_span(name, prefill_from, r.first_token_at, lane, args))
+                decode_args = {**args, "tokens": len(r.output_ids), "finish_reason": r.finish_reason}
+                spans.append(_span("decode", r.first_token_at, end, lane, decode_args))
+        return spans
+
+    def all_spans(self):
+        with self._lock:
+            return sorted(self.spans + self._request_spans(), key=lambda s: s["start"])
+
+    def to_json(self):
+        return [
+            {
+                "name": s["name"],
+                "start_ms": round((s["start"] - self.started_at) * 1000, 3),
+                "duration_ms": round((s["end"] - s["start"]) * 1000, 3),
+                "thread": s["thread"],
+                **s["args"],
+            }
+            for s in self.all_spans()
+        ]
+
+    def chrome_trace(self):
+        """Trace Event Format, loadable in chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for s in self.all_spans():
+            tid = threads.setdefault(s["thread"], len(threads) + 1)
+            events.append({
+                "name": s["name"],
+                "cat": self.name,
+                "ph": "X",
+                "ts": round(s["start"] * 1e6),
+                "dur": round((s["end"] - s["start"]) * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": s["args"],
+            })
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+class Profiler:
+    """
+    Decides which requests are profiled and where their traces go.
+
+    A request is profiled when its X-Profile header is "1"/"true", never when it is
+    "0"/"false", and otherwise with probability sample_rate, so a small rate can stay on
+    in production. With trace_dir set every profile is also written there as a Chrome
+    trace JSON file.
+    """
+
+    def __init__(self, sample_rate=0.0, trace_dir=None, header="X-Profile"):
+        self.sample_rate = sample_rate
+        self.trace_dir = trace_dir
+        self.header = header
+        self._counters = {"profiled": 0, "traces_written": 0}
+
+    def start(self, name, headers):
+        flag = headers.get(self.header, "").strip().lower()
+        if flag in ("1", "true", "yes"):
+            enabled = True
+        elif flag in ("0", "false", "no"):
+            enabled = False
+        else:
+            enabled = self.sample_rate > 0 and random.random() < self.sample_rate
+        profile = Profile(name) if enabled else None
+        if profile is not None:
+            self._counters["profiled"] += 1
+        return profile
+
+    def finish(self, profile):
+        """Write the profile's Chrome trace if a trace directory is configured."""
+        if self.trace_dir is None:
+            return None
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f"{profile.name}-{int(profile.started_at * 1000)}-{id(profile):x}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(profile.chrome_trace(), f)
+        self._counters["traces_written"] += 1
+        return path
+
+    def stats(self):
+        return {**self._counters, "sample_rate": self.sample_rate, "trace_dir": self.trace_dir}
+
+
+def current():
+    return _current.get()
+
+
+def activate(profile):
+    """Make profile (or None) the current request's profile; pass the result to deactivate()."""
+    return _current.set(profile)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextmanager
+def span(name, **args):
+    """Time the enclosed block as a stage of the current request, if it is being profiled."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, start, time.time(), **args)
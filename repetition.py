@@ -0,0 +1,31 @@
+class RepetitionDetector:
+    """
+    Stopping criterion for generations stuck in a loop.
+
+    A row counts as looping once the tail of its output is at least min_repeats
+    back-to-back copies of the same n-gram of up to max_ngram tokens, and the repeated
+    span covers at least min_tokens tokens, so very short periods ("!!!!") need more
+    copies before they count. The check only looks at the end of the output, which is
+    a handful of list comparisons per row and decoding step.
+    """
+
+    def __init__(self, max_ngram=32, min_repeats=3, min_tokens=24):
+        self.max_ngram = max_ngram
+        self.min_repeats = min_repeats
+        self.min_tokens = min_tokens
+
+    def period(self, token_ids):
+        """Length of the n-gram the end of token_ids keeps repeating, or 0."""
+        for n in range(1, self.max_ngram + 1):
+            span = max(n * self.min_repeats, self.min_tokens)
+            if len(token_ids) < span:
+                break
+            if token_ids[-1] != token_ids[-1 - n]:
+                continue
+            tail = token_ids[-span:]
+            if tail[n:] == tail[:-n]:
+                return n
+        return 0
+
+    def stats(self):
+        return {"max_ngram": self.max_ngram, "min_repeats": self.min_repeats, "min_tokens": self.min_tokens}
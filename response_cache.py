@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def is_cacheable(params):
+    """Only greedy decoding or sampling with an explicit seed reproduces the same answer."""
+    return not params.get("do_sample") or params.get("seed") is not None
+
+
+class ResponseCache:
+    """
+    Opt-in cache of generated answers keyed by (persona, normalized prompt, sampling
+    params, seed).
+
+    The local tier is an in-process LRU with a TTL. If a Redis URL is given, a shared
+    tier on that Redis instance lets every server replica reuse each other's answers;
+    local misses fall through to it and shared hits are copied into the local tier.
+    """
+
+    def __init__(self, max_entries=1024, ttl_s=3600, redis_url=None, redis_ttl_s=86400, key_prefix="llm:response:"):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.redis_ttl_s = redis_ttl_s
+        self.key_prefix = key_prefix
+        self._entries = OrderedDict()  # key -> (expires_at, response)
+        self._lock = threading.Lock()
+        self._counters = {"local_hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "uncacheable": 0, "shared_errors": 0}
+
+        self._redis = None
+        if redis_url:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(redis_url)
+            except ImportError:
+                logger.warning("redis package is not installed; shared response cache tier disabled")
+
+    def make_key(self, persona_name, prompt, params):
+        payload = json.dumps(
+            {"persona": persona_name, "prompt": normalize_prompt(prompt), "params": params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._counters["local_hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+
+        if self._redis is not None:
+            try:
+                value = self._redis.get(self.key_prefix + key)
+            except Exception as e:
+                logger.warning(f"Shared response cache lookup failed: {e}")
+                value = None
+                with self._lock:
+                    self._counters["shared_errors"] += 1
+            if value is not None:
+                response = json.loads(value)
+                self._store_local(key, response)
+                with self._lock:
+                    self._counters["shared_hits"] += 1
+                return response
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key, response):
+        self._store_local(key, response)
+        with self._lock:
+            self._counters["stores"] += 1
+        if self._redis is not None:
+            try:
+                self._redis.set(self.key_prefix + key, json.dumps(response, ensure_ascii=False), ex=self.redis_ttl_s)
+            except Exception as e:
+                logger.warning(f"Shared response cache store failed: {e}")
+                with self._lock:
+                    self._counters["shared_errors"] += 1
+
+    def record_uncacheable(self):
+        with self._lock:
+            self._counters["uncacheable"] += 1
+
+    def _store_local(self, key, response):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_s, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self._counters["local_hits"] + self._counters["shared_hits"]
+            lookups = hits + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "shared_tier": self._redis is not None,
+            }
@@ -0,0 +1,294 @@
+"""
+Persona-aware router in front of several flask_api.py replicas.
+
+    INFERENCE_REPLICAS=http://127.0.0.1:5000,http://127.0.0.1:5002 python router.py
+
+Every replica is health-checked in the background through its /readyz endpoint, so a
+replica that is still loading or warming up its adapters receives no traffic. A request
+for a persona goes to the replica chosen by rendezvous hashing of the persona name over
+the healthy replicas, so each persona keeps landing where its adapter and cached prefix
+are already resident, and adding or losing a replica only moves the personas that
+hashed to it. If that replica is much busier than the least loaded one, or the request
+carries no persona, the least loaded replica is used instead.
+
+A request is only retried on another replica when its replica cannot have acted on it:
+the connection was refused, or the answer was 429/503. A replica that drops the
+connection or times out may already have started the work (a batch job, a DELETE), so
+the client gets 502/504 instead. When no other replica is left, a 429/503 answer is
+relayed as is, Retry-After included. Request headers (e.g. X-Profile) are passed
+through. POST /cancel/<request_id> is sent to every replica, since the call it targets
+may have landed on any of them.
+
+Run with: python router.py (ROUTER_PORT defaults to 5100)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+ROUTER_HOST = os.environ.get("ROUTER_HOST", "0.0.0.0")
+ROUTER_PORT = int(os.environ.get("ROUTER_PORT", "5100"))
+INFERENCE_REPLICAS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("INFERENCE_REPLICAS", "http://127.0.0.1:5000").split(",")
+    if url.strip()
+]
+HEALTH_INTERVAL_S = float(os.environ.get("ROUTER_HEALTH_INTERVAL_S", "5"))
+HEALTH_TIMEOUT_S = float(os.environ.get("ROUTER_HEALTH_TIMEOUT_S", "2"))
+# How much busier than the least loaded replica the persona's own replica may be
+AFFINITY_SLACK = int(os.environ.get("ROUTER_AFFINITY_SLACK", "8"))
+MAX_RETRIES = int(os.environ.get("ROUTER_RETRIES", "1"))
+REQUEST_TIMEOUT_S = float(os.environ.get("ROUTER_REQUEST_TIMEOUT_S", "300"))
+
+RETRY_STATUSES = {429, 503}
+RELAYED_HEADERS = ("Content-Type", "Retry-After", "Cache-Control", "X-Profile-Trace")
+# Request headers that describe the client connection rather than the request
+HOP_BY_HOP_HEADERS = {
+    "host", "content-length", "connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade",
+    "proxy-authorization", "proxy-authenticate",
+}
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.last_check = None
+        self.last_error = None
+        self.requests = 0
+        self.failures = 0
+
+    def load(self):
+        return self.in_flight + self.queue_depth
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+        }
+
+
+def affinity_key(data):
+    """Persona(s) a request is for, or None if it names none."""
+    if not isinstance(data, dict):
+        return None
+    persona_name = data.get("persona_name")
+    if isinstance(persona_name, str) and persona_name.strip():
+        return persona_name.strip().lower()
+    personas = data.get("selected_personas")
+    if isinstance(personas, list) and personas:
+        return ",".join(sorted(str(p).strip().lower() for p in personas))
+    return None
+
+
+def rendezvous_score(key, url):
+    return hashlib.sha1(f"{key}|{url}".encode("utf-8")).hexdigest()
+
+
+class Router:
+    def __init__(self, urls):
+        self.replicas = [Replica(url) for url in urls]
+        self.session = None
+        self._counters = {"requests": 0, "affinity": 0, "least_loaded": 0, "retries": 0, "no_replica": 0}
+
+    def choose(self, key, exclude=()):
+        candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not candidates:
+            # Health checks can lag behind a replica coming back; better to try than to fail
+            candidates = [r for r in self.replicas if r not in exclude]
+        if not candidates:
+            return None
+
+        least_loaded = min(candidates, key=lambda r: r.load())
+        if key is not None:
+            preferred = max(candidates, key=lambda r: rendezvous_score(key, r.url))
+            if preferred.load() - least_loaded.load() <= AFFINITY_SLACK:
+                self._counters["affinity"] += 1
+                return preferred
+        self._counters["least_loaded"] += 1
+        return least_loaded
+
+    def has_candidate(self, exclude):
+        return any(r not in exclude for r in self.replicas)
+
+    async def check(self, replica):
+        try:
+            async with self.session.get(
+                f"{replica.url}/readyz", timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT_S)
+            ) as response:
+                replica.healthy = response.status == 200
+                if replica.healthy:
+                    replica.queue_depth = (await response.json()).get("queue_depth", 0)
+                replica.last_error = None if replica.healthy else f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            replica.healthy = False
+            replica.last_error = str(e) or type(e).__name__
+        replica.last_check = time.time()
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(r) for r in self.replicas))
+            await asyncio.sleep(HEALTH_INTERVAL_S)
+
+    async def forward(self, request):
+        body = await request.read()
+        key = None
+        if body:
+            try:
+                key = affinity_key(json.loads(body))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                pass
+        self._counters["requests"] += 1
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+
+        tried = []
+        while len(tried) <= MAX_RETRIES:
+            replica = self.choose(key, exclude=tried)
+            if replica is None:
+                break
+            if tried:
+                self._counters["retries"] += 1
+            tried.append(replica)
+
+            replica.in_flight += 1
+            replica.requests += 1
+            try:
+                upstream = await self.session.request(
+                    request.method,
+                    f"{replica.url}{request.rel_url}",
+                    data=body,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S),
+                )
+            except aiohttp.ClientConnectorError as e:
+                # Refused before anything was sent, so any replica may take the request
+                logger.warning(f"Replica {replica.url} unreachable: {e}")
+                replica.healthy = False
+                replica.failures += 1
+                replica.in_flight -= 1
+                continue
+            except asyncio.TimeoutError:
+                logger.warning(f"Replica {replica.url} did not answer within {REQUEST_TIMEOUT_S:.0f}s")
+                replica.failures += 1
+                replica.in_flight -= 1
+                return self.error_response(f"Replica {replica.url} timed out", 504)
+            except aiohttp.ClientError as e:
+                logger.warning(f"Replica {replica.url} failed mid-request: {e}")
+                replica.failures += 1
+                replica.in_flight -= 1
+                return self.error_response(f"Replica {replica.url} failed: {e}", 502)
+
+            try:
+                # With no other replica to try, the client gets this one's answer and Retry-After
+                if upstream.status in RETRY_STATUSES and len(tried) <= MAX_RETRIES and self.has_candidate(tried):
+                    replica.failures += 1
+                    continue
+                return await self.relay(request, upstream)
+            finally:
+                upstream.release()
+                replica.in_flight -= 1
+
+        self._counters["no_replica"] += 1
+        return self.error_response("No inference replica available", 503)
+
+    def error_response(self, message, status):
+        return web.json_response(
+            {"error": message, "retry_after": 1},
+            status=status,
+            headers={"Retry-After": "1"},
+        )
+
+    async def relay(self, request, upstream):
+        headers = {name: upstream.headers[name] for name in RELAYED_HEADERS if name in upstream.headers}
+        response = web.StreamResponse(status=upstream.status, headers=headers)
+        await response.prepare(request)
+        try:
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # The status line is already out; all that is left is to end the body early
+            logger.warning(f"Relaying from {upstream.url} broke off: {e or type(e).__name__}")
+            return response
+        await response.write_eof()
+        return response
+
+    async def cancel(self, request_id):
+        async def post(replica):
+            try:
+                async with self.session.post(
+                    f"{replica.url}/cancel/{request_id}", timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT_S)
+                ) as response:
+                    return response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+        cancelled = any(await asyncio.gather(*(post(r) for r in self.replicas)))
+        return web.json_response({"request_id": request_id, "cancelled": cancelled}, status=200 if cancelled else 404)
+
+    def stats(self):
+        return {
+            **self._counters,
+            "replicas": [r.stats() for r in self.replicas],
+            "affinity_slack": AFFINITY_SLACK,
+            "max_retries": MAX_RETRIES,
+        }
+
+
+async def home(request):
+    return web.Response(text="Inference router is running!")
+
+
+async def router_stats(request):
+    return web.json_response(request.app["router"].stats())
+
+
+async def cancel(request):
+    return await request.app["router"].cancel(request.match_info["request_id"])
+
+
+async def proxy(request):
+    return await request.app["router"].forward(request)
+
+
+async def on_startup(app):
+    router = app["router"]
+    router.session = aiohttp.ClientSession()
+    app["health_task"] = asyncio.create_task(router.health_loop())
+
+
+async def on_cleanup(app):
+    app["health_task"].cancel()
+    await app["router"].session.close()
+
+
+def create_app(urls=INFERENCE_REPLICAS):
+    app = web.Application()
+    app["router"] = Router(urls)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_get("/", home)
+    app.router.add_get("/router", router_stats)
+    app.router.add_post("/cancel/{request_id}", cancel)
+    app.router.add_route("*", "/{path:.+}", proxy)
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host=ROUTER_HOST, port=ROUTER_PORT)
@@ -0,0 +1,157 @@
+"""
+Tiny, deterministic stand-in for Gemma-2-9b-it and its persona adapters.
+
+INFERENCE_BACKEND=stub serves a randomly initialized two-layer causal LM on the CPU with
+a character-level tokenizer that renders Gemma's chat template, and writes LoRA adapters
+with the rank and target modules of the real persona adapters in Models/. Scheduling,
+adapter swapping, prefix/dialogue caching and streaming then run through exactly the
+code paths of the real server, on any machine, in seconds. The weights come from a
+fixed seed, so greedy outputs are the same on every run. The stub never samples
+<eos> or <end_of_turn>, so requests generate exactly max_new_tokens tokens (greedy
+outputs of a random model do loop, though: set REPETITION_MAX_NGRAM=0 to keep the
+repetition detector from stopping them early).
+
+STUB_TOKEN_LATENCY_MS adds a sleep to every forward pass, to approximate the step time
+of the real model when load-testing the consumers and pages in front of it.
+"""
+
+import glob
+import json
+import os
+import time
+
+import torch
+from peft import LoraConfig, get_peft_model
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+ALPHABET = (
+    "abcçdefgğhıijklmnoöprsştuüvyzqwx"
+    "ABCÇDEFGĞHIİJKLMNOÖPRSŞTUÜVYZQWX"
+    "0123456789.,;:!?'\"()[]{}<>-_/\\*%&+=#@$^|~`\n\t"
+    "âîûÂÎÛ"
+)
+
+# Gemma's chat template: no system role, assistant turns are called "model"
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{% if message['role'] == 'assistant' %}{% set role = 'model' %}{% else %}{% set role = message['role'] %}{% endif %}"
+    "<start_of_turn>{{ role }}\n{{ message['content'] | trim }}<end_of_turn>\n"
+    "{% endfor %}{% if add_generation_prompt %}<start_of_turn>model\n{% endif %}"
+)
+
+# Shape of the adapters written for personas that have none in Models/ to copy
+DEFAULT_LORA = {"r": 1, "lora_alpha": 4, "target_modules": ["q_proj", "v_proj"]}
+
+
+def load_stub_tokenizer():
+    """Character-level tokenizer with Gemma's special tokens and chat template."""
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS)}
+    for char in "▁" + ALPHABET:
+        vocab.setdefault(char, len(vocab))
+
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Metaspace()
+    backend.decoder = decoders.Metaspace()
+    backend.add_special_tokens(SPECIAL_TOKENS)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<bos>",
+        eos_token="<eos>",
+        unk_token="<unk>",
+        pad_token="<eos>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.padding_side = "right"
+    return tokenizer
+
+
+def build_stub_model(tokenizer, seed=0, hidden_size=64, num_layers=2):
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=True,
+        use_cache=True,
+    )
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(config)
+
+
+def load_stub(seed=0, token_latency_s=0.0):
+    """Return (model, tokenizer) of the stub backend."""
+    tokenizer = load_stub_tokenizer()
+    model = build_stub_model(tokenizer, seed)
+    # Hooks go on submodules: PEFT calls the wrapped model's forward() directly, which
+    # skips hooks registered on the model itself
+    stop_ids = torch.tensor([tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")])
+    model.lm_head.register_forward_hook(
+        lambda module, args, logits: logits.index_fill(-1, stop_ids.to(logits.device), float("-inf"))
+    )
+    if token_latency_s:
+        # One forward per decoding step (or prefill), whatever the batch size, like on a GPU
+        model.model.register_forward_pre_hook(lambda module, args: time.sleep(token_latency_s))
+    return model, tokenizer
+
+
+def persona_lora_shapes(models_dir="Models"):
+    """Rank, alpha and target modules of each real persona adapter, by lower-cased persona name."""
+    shapes = {}
+    for path in sorted(glob.glob(os.path.join(models_dir, "*", "adapter_config.json"))):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        persona = os.path.basename(os.path.dirname(path)).lower()
+        shapes[persona] = {key: config[key] for key in DEFAULT_LORA}
+    return shapes
+
+
+def stub_persona_names(models_dir="Models"):
+    """Lower-cased names of the adapter directories in Models/, as the endpoints expect them."""
+    paths = glob.glob(os.path.join(models_dir, "*", "adapter_config.json"))
+    return sorted(os.path.basename(os.path.dirname(path)).lower() for path in paths)
+
+
+def _lora_shape(config):
+    return config.get("r"), config.get("lora_alpha"), sorted(config.get("target_modules") or [])
+
+
+def write_stub_adapters(directory, personas, seed=0, models_dir="Models"):
+    """
+    Write a random LoRA adapter per persona under directory and return the absolute path
+    template (PEFT takes a relative path that does not exist for a hub repo id).
+
+    Each adapter is built on a fresh copy of the stub model (LoRA injection modifies the
+    model it is applied to) and its B matrices are randomized, since PEFT initializes them
+    to zero and every persona would otherwise answer exactly like the base model. Each
+    adapter copies the shape of the persona's own adapter in models_dir, if it has one.
+    """
+    shapes = persona_lora_shapes(models_dir)
+    tokenizer = load_stub_tokenizer()
+    for index, persona in enumerate(personas):
+        path = os.path.join(directory, persona)
+        shape = shapes.get(persona, DEFAULT_LORA)
+        config_path = os.path.join(path, "adapter_config.json")
+        if os.path.isfile(config_path):
+            with open(config_path, encoding="utf-8") as f:
+                written = json.load(f)
+            if _lora_shape(written) == _lora_shape(shape):
+                continue
+        base = build_stub_model(tokenizer, seed)
+        peft_model = get_peft_model(base, LoraConfig(task_type="CAUSAL_LM", lora_dropout=0.0, **shape))
+        generator = torch.Generator().manual_seed(seed + index + 1)
+        with torch.no_grad():
+            for name, parameter in peft_model.named_parameters():
+                if "lora_B" in name:
+                    parameter.copy_(torch.randn(parameter.shape, generator=generator) * 0.5)
+        peft_model.save_pretrained(path)
+    return os.path.join(os.path.abspath(directory), "{}")
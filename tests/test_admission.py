@@ -0,0 +1,84 @@
+import unittest
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from admission import MemoryAdmission, MemoryBudgetExceeded
+
+# 2 layers x 2 KV heads x head_dim 4 x fp16: 2 * 2 * 2 * 4 * 2 = 64 bytes per token
+CONFIG = SimpleNamespace(
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    hidden_size=16,
+    intermediate_size=32,
+    vocab_size=100,
+)
+
+
+def request(prompt_tokens, max_new_tokens=0):
+    return SimpleNamespace(
+        input_ids=[1] * prompt_tokens,
+        max_new_tokens=max_new_tokens,
+        prefix_cache=None,
+        reserved_bytes=0,
+        deferred=False,
+    )
+
+
+class MemoryAdmissionTest(unittest.TestCase):
+    def admission(self, budget_bytes):
+        return MemoryAdmission(CONFIG, budget_bytes, torch.float16, padding_overhead=0.0)
+
+    def test_estimate(self):
+        admission = self.admission(10**9)
+        self.assertEqual(admission.kv_bytes_per_token, 64)
+        kv, prefill = admission.estimate(request(10, 6))
+        self.assertEqual(kv, 16 * 64)
+        attention_scores = 4 * 10 * 10 * 2
+        self.assertEqual(prefill, 10 * admission.activation_bytes_per_token + attention_scores)
+
+    def test_cached_prefix_is_not_prefilled_again(self):
+        admission = self.admission(10**9)
+        cached = request(10)
+        cached.prefix_cache = ((torch.zeros(1, 2, 8, 4), torch.zeros(1, 2, 8, 4)),)
+        self.assertEqual(admission.estimate(cached)[0], admission.estimate(request(10))[0])
+        self.assertLess(admission.estimate(cached)[1], admission.estimate(request(10))[1])
+
+    def test_request_larger_than_the_budget_is_rejected(self):
+        admission = self.admission(1000)
+        with self.assertRaises(MemoryBudgetExceeded):
+            admission.check(request(100, 100))
+        self.assertEqual(admission.stats()["rejected"], 1)
+
+    def test_requests_that_do_not_fit_are_deferred_until_memory_is_released(self):
+        kv, prefill = self.admission(10**9).estimate(request(1))
+        # Two KV caches fit, but only one prefill at a time next to them
+        admission = self.admission(2 * kv + prefill + kv // 2)
+
+        first, second, third = request(1), request(1), request(1)
+        admitted, deferred = admission.admit([first, second, third])
+        self.assertEqual((admitted, deferred), ([first], [second, third]))
+        self.assertEqual(first.reserved_bytes, kv)
+
+        admitted, deferred = admission.admit(deferred)
+        self.assertEqual((admitted, deferred), ([second], [third]))
+        self.assertEqual(admission.stats()["reserved_bytes"], 2 * kv)
+        # third was deferred twice but is counted once
+        self.assertEqual(admission.stats()["deferred"], 2)
+
+        admission.release(first)
+        self.assertEqual(first.reserved_bytes, 0)
+        admitted, deferred = admission.admit(deferred)
+        self.assertEqual((admitted, deferred), ([third], []))
+        self.assertEqual(admission.stats()["admitted"], 3)
+        self.assertEqual(admission.stats()["peak_reserved_bytes"], 2 * kv)
+
+    def test_idle_server_always_takes_the_first_request(self):
+        big = request(50, 50)
+        admission = self.admission(sum(self.admission(10**9).estimate(big)) - 1)
+        admitted, deferred = admission.admit([big, request(1)])
+        self.assertEqual(admitted, [big])
+        self.assertEqual(len(deferred), 1)
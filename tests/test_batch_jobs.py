@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+import unittest
+
+import pytest
+
+pytest.importorskip("torch")
+
+from batch_jobs import BatchJob, BatchJobManager
+from batch_scheduler import GenerationRequest, QueueFullError
+
+RECORDS = [{"id": f"r{i}", "persona_name": "alpha", "prompt": "x" * (i + 1)} for i in range(3)]
+
+
+class EchoScheduler:
+    """Finishes every request on submit, echoing its prompt; the first `full` submits hit a full queue."""
+
+    def __init__(self, full=0):
+        self.full = full
+        self.submitted = []
+
+    def submit(self, request):
+        if self.full:
+            self.full -= 1
+            raise QueueFullError(0)
+        self.submitted.append(request)
+        request.output_ids = list(request.input_ids)
+        request._finish("length")
+        return request
+
+    def cancel(self, request):
+        request.cancel()
+
+
+class CharTokenizer:
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(chr(i) for i in ids)
+
+
+def make_request(record):
+    if record.get("bad"):
+        raise ValueError("bad record")
+    return GenerationRequest(record["persona_name"], [ord(c) for c in record["prompt"]])
+
+
+class BatchJobTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.job_dir = tmp.name
+
+    def test_resume_skips_successful_records_and_retries_failed_ones(self):
+        job = BatchJob("job-1", RECORDS, self.job_dir)
+        self.assertTrue(os.path.isfile(job.input_path))
+        job._record_result({"index": 0, "response": "a", "usage": {"generated_tokens": 4}})
+        job._record_result({"index": 1, "error": "boom"})
+
+        resumed = BatchJob("job-1", RECORDS, self.job_dir)
+        self.assertEqual(resumed.remaining(), [1, 2])
+        status = resumed.status()
+        self.assertEqual((status["completed"], status["failed"], status["generated_tokens"]), (1, 1, 4))
+
+    def test_later_result_replaces_the_earlier_one(self):
+        job = BatchJob("job-1", RECORDS, self.job_dir)
+        job._record_result({"index": 1, "error": "boom"})
+        job._record_result({"index": 1, "response": "b", "usage": {"generated_tokens": 2}})
+        self.assertEqual(job.remaining(), [0, 2])
+        status = job.status()
+        self.assertEqual((status["completed"], status["failed"], status["generated_tokens"]), (1, 0, 2))
+
+
+class BatchJobManagerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.job_dir = tmp.name
+
+    def manager(self, scheduler):
+        return BatchJobManager(scheduler, CharTokenizer(), make_request, job_dir=self.job_dir, max_in_flight=2)
+
+    def test_job_runs_every_record(self):
+        job = self.manager(EchoScheduler()).start(RECORDS, job_id="job-1")
+        results = [json.loads(line) for line in job.follow()]
+
+        self.assertEqual(sorted(r["index"] for r in results), [0, 1, 2])
+        self.assertEqual({r["id"]: r["response"] for r in results}, {"r0": "x", "r1": "xx", "r2": "xxx"})
+        self.assertEqual(job.status()["completed"], 3)
+
+    def test_restart_resumes_with_the_stored_records(self):
+        records = RECORDS + [{"id": "r3", "persona_name": "alpha", "prompt": "y", "bad": True}]
+        job = self.manager(EchoScheduler()).start(records, job_id="job-1")
+        list(job.follow())
+        self.assertEqual((job.status()["completed"], job.status()["failed"]), (3, 1))
+
+        # A new server: only the failed record runs again, whatever records the caller sends
+        scheduler = EchoScheduler()
+        job = self.manager(scheduler).start([{"prompt": "ignored"}], job_id="job-1")
+        list(job.follow())
+        self.assertEqual(len(scheduler.submitted), 0)
+        self.assertEqual(len(job.records), 4)
+        self.assertEqual(job.remaining(), [3])
+
+    def test_full_queue_is_waited_out(self):
+        scheduler = EchoScheduler(full=2)
+        job = self.manager(scheduler).start(RECORDS, job_id="job-1")
+        list(job.follow())
+        self.assertEqual(len(scheduler.submitted), 3)
+        self.assertEqual(job.status()["failed"], 0)
+
+    def test_cancelling_a_stored_job_does_not_resume_it(self):
+        BatchJob("job-1", RECORDS, self.job_dir)
+        scheduler = EchoScheduler()
+        job = self.manager(scheduler).cancel("job-1")
+        self.assertTrue(job.cancelled and job.finished)
+        self.assertEqual(scheduler.submitted, [])
+        self.assertIsNone(self.manager(scheduler).cancel("job-2"))
@@ -0,0 +1,194 @@
+import tempfile
+import time
+import unittest
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from adapter_registry import AdapterRegistry
+from batch_scheduler import ContinuousBatchScheduler, GenerationRequest, QueueFullError, RequestCancelled, length_buckets
+from stub_backend import load_stub, write_stub_adapters
+
+
+class GenerationRequestTest(unittest.TestCase):
+    def test_deadline_is_the_earlier_of_timeout_and_deadline(self):
+        self.assertIsNone(GenerationRequest("alpha", [1]).deadline)
+
+        request = GenerationRequest("alpha", [1], timeout=5, deadline=time.time() + 60)
+        self.assertAlmostEqual(request.deadline, request.submitted_at + 5)
+
+        deadline = time.time() + 5
+        request = GenerationRequest("alpha", [1], timeout=60, deadline=deadline)
+        self.assertEqual(request.deadline, deadline)
+
+    def test_done_callbacks_run_once_finished(self):
+        request = GenerationRequest("alpha", [1, 2])
+        calls = []
+        request.add_done_callback(calls.append)
+        request._append(7)
+        self.assertEqual(calls, [])
+
+        request._finish("length")
+        # Registered after the fact: runs right away
+        request.add_done_callback(calls.append)
+        self.assertEqual(calls, [request, request])
+        self.assertEqual(request.result(), [7])
+        self.assertEqual(request.usage(), {"prompt_tokens": 2, "generated_tokens": 1})
+
+    def test_stream_yields_tokens_then_raises_the_error(self):
+        request = GenerationRequest("alpha", [1], stream=True)
+        request._append(3)
+        request._append(4)
+        request._finish("cancelled", RequestCancelled("gone"))
+
+        tokens = []
+        with self.assertRaises(RequestCancelled):
+            for token_id in request.stream():
+                tokens.append(token_id)
+        self.assertEqual(tokens, [3, 4])
+
+    def test_result_times_out(self):
+        with self.assertRaises(TimeoutError):
+            GenerationRequest("alpha", [1]).result(timeout=0.01)
+
+
+class LengthBucketsTest(unittest.TestCase):
+    def test_groups_close_once_padding_exceeds_the_ratio(self):
+        # 10, 11, 12 padded to 12 waste 3 of 36 tokens; adding 40 would waste 87 of 160
+        buckets = length_buckets([40, 12, 10, 11], lambda n: n, 0.25)
+        self.assertEqual(buckets, [[10, 11, 12], [40]])
+
+    def test_zero_ratio_only_groups_equal_lengths(self):
+        self.assertEqual(length_buckets([5, 3, 5, 3], lambda n: n, 0.0), [[3, 3], [5, 5]])
+
+    def test_empty(self):
+        self.assertEqual(length_buckets([], lambda n: n, 0.25), [])
+
+
+class TrimPaddingTest(unittest.TestCase):
+    def scheduler_with_batch(self, mask, requests):
+        # Just the batch state; no decode thread
+        scheduler = object.__new__(ContinuousBatchScheduler)
+        scheduler._counters = {"trimmed_columns": 0}
+        scheduler._attention_mask = torch.tensor(mask)
+        scheduler._past = ((torch.randn(len(mask), 1, len(mask[0]), 2), torch.randn(len(mask), 1, len(mask[0]), 2)),)
+        scheduler._next_tokens = torch.zeros(len(mask), 1, dtype=torch.long)
+        scheduler._active = requests
+        return scheduler
+
+    def test_dropping_the_longest_row_trims_shared_padding(self):
+        short, long = GenerationRequest("alpha", [1, 2]), GenerationRequest("alpha", [1, 2, 3, 4])
+        scheduler = self.scheduler_with_batch([[0, 0, 1, 1], [1, 1, 1, 1]], [short, long])
+        keys = scheduler._past[0][0][0].clone()
+        long._finish("length")
+
+        scheduler._drop_finished()
+        self.assertEqual(scheduler._active, [short])
+        self.assertEqual(scheduler._attention_mask.tolist(), [[1, 1]])
+        self.assertEqual(scheduler._past[0][0].shape[2], 2)
+        self.assertTrue(torch.equal(scheduler._past[0][0][0], keys[:, 2:]))
+        self.assertEqual(scheduler._counters["trimmed_columns"], 2)
+
+    def test_columns_used_by_any_row_stay(self):
+        scheduler = self.scheduler_with_batch([[0, 1, 1], [0, 0, 1]], [])
+        scheduler._trim_padding()
+        self.assertEqual(scheduler._attention_mask.tolist(), [[1, 1], [0, 1]])
+        self.assertEqual(scheduler._counters["trimmed_columns"], 1)
+
+
+class StubSchedulerTest(unittest.TestCase):
+    """Runs the real scheduler on the stub model, which never emits EOS."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.adapter_dir = tempfile.TemporaryDirectory()
+        # No adapters to copy shapes from: every persona gets the small default shape
+        cls.adapter_path = write_stub_adapters(
+            cls.adapter_dir.name, ["alpha", "beta"], models_dir=cls.adapter_dir.name
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.adapter_dir.cleanup()
+
+    def setUp(self):
+        # LoRA injection modifies the base model, so every test gets its own
+        model, self.tokenizer = load_stub()
+        self.registry = AdapterRegistry(model, self.adapter_path)
+        self.scheduler = self.make_scheduler()
+
+    def make_scheduler(self, **kwargs):
+        eos_token_ids = {self.tokenizer.eos_token_id, self.tokenizer.convert_tokens_to_ids("<end_of_turn>")}
+        scheduler = ContinuousBatchScheduler(
+            self.registry, self.tokenizer, torch.device("cpu"), eos_token_ids, **kwargs
+        )
+        self.addCleanup(scheduler.close)
+        return scheduler
+
+    def prompt(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def test_requests_run_to_max_new_tokens_and_release_their_adapters(self):
+        requests = [
+            self.scheduler.submit(GenerationRequest("alpha", self.prompt("merhaba"), max_new_tokens=5, timeout=30)),
+            self.scheduler.submit(GenerationRequest("beta", self.prompt("nasılsın bugün"), max_new_tokens=3, timeout=30)),
+        ]
+        self.assertEqual([len(r.result()) for r in requests], [5, 3])
+        self.assertEqual([r.finish_reason for r in requests], ["length", "length"])
+
+        self.assertEqual(self.registry.stats()["pinned"], {})
+        stats = self.scheduler.stats()
+        self.assertEqual(stats["completed"], 2)
+        self.assertEqual(stats["active"], 0)
+        self.assertEqual(stats["waiting"], 0)
+
+    def test_batched_rows_match_running_alone(self):
+        alone = self.scheduler.generate("alpha", self.prompt("kısa"), max_new_tokens=6, timeout=30)
+
+        # Hold the decode loop so the two rows share the batch, padded to different lengths
+        with self.registry.lock:
+            short = self.scheduler.submit(GenerationRequest("alpha", self.prompt("kısa"), max_new_tokens=6, timeout=30))
+            long = self.scheduler.submit(
+                GenerationRequest("beta", self.prompt("çok daha uzun bir soru metni"), max_new_tokens=6, timeout=30)
+            )
+        self.assertEqual(short.result(), alone)
+        self.assertEqual(len(long.result()), 6)
+
+    def test_cancel_stops_the_row(self):
+        request = self.scheduler.submit(
+            GenerationRequest("alpha", self.prompt("merhaba"), max_new_tokens=10_000, stream=True, timeout=30)
+        )
+        next(request.stream())
+        self.scheduler.cancel(request)
+        with self.assertRaises(RequestCancelled):
+            request.result()
+        self.assertEqual(request.finish_reason, "cancelled")
+        self.assertEqual(self.scheduler.stats()["cancelled"], 1)
+        self.assertEqual(self.registry.stats()["pinned"], {})
+
+    def test_expired_request_is_dropped_before_prefill(self):
+        request = self.scheduler.submit(
+            GenerationRequest("alpha", self.prompt("merhaba"), max_new_tokens=5, deadline=time.time() - 1)
+        )
+        with self.assertRaises(TimeoutError):
+            request.result(timeout=10)
+        self.assertEqual(request.finish_reason, "timeout")
+        self.assertEqual(request.output_ids, [])
+        self.assertEqual(self.scheduler.stats()["prefill_passes"], 0)
+
+    def test_full_queue_rejects_instead_of_blocking(self):
+        scheduler = self.make_scheduler(max_batch_size=1, max_queue_size=1)
+        with self.registry.lock:
+            # The decode loop takes the first request and then waits for the model lock
+            first = scheduler.submit(GenerationRequest("alpha", self.prompt("bir"), max_new_tokens=2, timeout=30))
+            while scheduler.queue_depth():
+                time.sleep(0.01)
+            second = scheduler.submit(GenerationRequest("alpha", self.prompt("iki"), max_new_tokens=2, timeout=30))
+            with self.assertRaises(QueueFullError) as raised:
+                scheduler.submit(GenerationRequest("alpha", self.prompt("üç"), max_new_tokens=2, timeout=30))
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(len(first.result()), 2)
+        self.assertEqual(len(second.result()), 2)
+        self.assertEqual(scheduler.stats()["rejected"], 1)
@@ -0,0 +1,83 @@
+import time
+import unittest
+
+import pytest
+
+pytest.importorskip("torch")
+
+from batch_scheduler import GenerationRequest, QueueFullError, RequestCancelled
+from cancellation import CancelRegistry
+
+
+class RecordingScheduler:
+    def __init__(self, error=None):
+        self.error = error
+        self.submitted = []
+        self.cancelled = []
+
+    def submit(self, request):
+        if self.error is not None:
+            raise self.error
+        self.submitted.append(request)
+        return request
+
+    def cancel(self, request):
+        request.cancel()
+        self.cancelled.append(request)
+
+
+class CancelRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = RecordingScheduler()
+        self.registry = CancelRegistry(self.scheduler)
+
+    def test_cancel_stops_every_request_of_the_call(self):
+        scope = self.registry.open("call-1")
+        first = scope.submit(GenerationRequest("alpha", [1]))
+        second = scope.submit(GenerationRequest("beta", [1]))
+
+        self.assertTrue(self.registry.cancel("call-1"))
+        self.assertEqual(self.scheduler.cancelled, [first, second])
+        with self.assertRaises(RequestCancelled):
+            scope.submit(GenerationRequest("alpha", [1]))
+
+    def test_finished_requests_are_left_alone(self):
+        scope = self.registry.open("call-1")
+        done = scope.submit(GenerationRequest("alpha", [1]))
+        done._finish("length")
+        running = scope.submit(GenerationRequest("alpha", [1]))
+
+        self.registry.close(scope)
+        self.assertEqual(self.scheduler.cancelled, [running])
+        self.assertEqual(self.registry.stats()["open"], 0)
+
+    def test_cancel_before_open_is_remembered(self):
+        self.assertFalse(self.registry.cancel("call-1"))
+        scope = self.registry.open("call-1")
+        with self.assertRaises(RequestCancelled):
+            scope.submit(GenerationRequest("alpha", [1]))
+        self.assertEqual(self.scheduler.submitted, [])
+        self.assertEqual(self.registry.stats()["early_cancels"], 1)
+
+    def test_scope_deadline_caps_request_deadlines(self):
+        deadline = time.time() + 5
+        scope = self.registry.open("call-1", deadline)
+        request = scope.submit(GenerationRequest("alpha", [1], timeout=60))
+        self.assertEqual(request.deadline, deadline)
+
+        scope = self.registry.open("call-2", time.time() + 60)
+        request = scope.submit(GenerationRequest("alpha", [1], timeout=5))
+        self.assertLess(request.deadline, deadline + 1)
+
+    def test_hooks_see_submits_and_rejections(self):
+        seen = []
+        self.scheduler.error = QueueFullError(3)
+        scope = self.registry.open(
+            "call-1",
+            on_submit=lambda request: seen.append(("submit", request)),
+            on_reject=lambda request, error: seen.append(("reject", error)),
+        )
+        request = GenerationRequest("alpha", [1])
+        with self.assertRaises(QueueFullError):
+            scope.submit(request)
+        self.assertEqual(seen, [("submit", request), ("reject", self.scheduler.error)])
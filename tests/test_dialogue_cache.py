@@ -0,0 +1,89 @@
+import unittest
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from dialogue_cache import DialogueCacheStore, DialogueSession, cache_bytes
+
+
+def kv_cache(tokens, layers=2):
+    """Legacy (key, value) tuples of float32 [1, 1, tokens, 4]: 32 bytes per token and layer."""
+    return tuple((torch.randn(1, 1, tokens, 4), torch.randn(1, 1, tokens, 4)) for _ in range(layers))
+
+
+class DialogueSessionTest(unittest.TestCase):
+    def test_cache_is_cropped_to_the_shared_prefix(self):
+        session = DialogueSession("alpha")
+        session.update(kv_cache(6), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(session.token_ids, [1, 2, 3, 4, 5, 6])
+
+        session.prepare([1, 2, 3, 9, 9])
+        self.assertEqual(session.token_ids, [1, 2, 3])
+        self.assertEqual(session.cache[0][0].shape[2], 3)
+        self.assertEqual((session.reused_tokens, session.prefilled_tokens), (3, 2))
+
+    def test_one_prompt_token_is_always_left_to_prefill(self):
+        session = DialogueSession("alpha")
+        session.update(kv_cache(4), [1, 2, 3, 4])
+        session.prepare([1, 2, 3, 4])
+        self.assertEqual(session.cached_tokens(), 3)
+
+    def test_nothing_in_common_drops_the_cache(self):
+        session = DialogueSession("alpha")
+        session.update(kv_cache(4), [1, 2, 3, 4])
+        session.prepare([5, 6])
+        self.assertIsNone(session.cache)
+        self.assertEqual(session.cached_tokens(), 0)
+
+
+class DialogueCacheStoreTest(unittest.TestCase):
+    def test_sessions_are_per_conversation_and_speaker(self):
+        store = DialogueCacheStore(max_bytes=10**6)
+        session = store.session("c1", "llm_1", "alpha")
+        self.assertIs(store.session("c1", "llm_1", "alpha"), session)
+        self.assertIsNot(store.session("c1", "llm_2", "alpha"), session)
+
+    def test_least_recently_updated_sessions_are_evicted_beyond_the_budget(self):
+        size = cache_bytes(kv_cache(10))
+        store = DialogueCacheStore(max_bytes=2 * size)
+        first = store.session("c1", "llm_1", "alpha")
+        second = store.session("c2", "llm_1", "beta")
+        third = store.session("c3", "llm_1", "alpha")
+
+        first.update(kv_cache(10), list(range(10)))
+        second.update(kv_cache(10), list(range(10)))
+        first.update(kv_cache(10), list(range(10)))
+        third.update(kv_cache(10), list(range(10)))
+
+        self.assertTrue(second.evicted)
+        self.assertFalse(first.evicted or third.evicted)
+        stats = store.stats()
+        self.assertEqual((stats["cached_bytes"], stats["active_sessions"], stats["sessions_evicted"]), (2 * size, 2, 1))
+
+    def test_evicted_session_stops_caching(self):
+        store = DialogueCacheStore(max_bytes=cache_bytes(kv_cache(10)))
+        first = store.session("c1", "llm_1", "alpha")
+        second = store.session("c2", "llm_1", "beta")
+        first.update(kv_cache(10), list(range(10)))
+        second.update(kv_cache(10), list(range(10)))
+        self.assertTrue(first.evicted)
+
+        # The conversation keeps going, but its turns no longer hold on to a cache
+        first.prepare(list(range(12)))
+        first.update(kv_cache(12), list(range(12)))
+        self.assertIsNone(first.cache)
+        self.assertEqual(first.cached_tokens(), 0)
+        self.assertEqual(store.stats()["cached_bytes"], cache_bytes(kv_cache(10)))
+
+    def test_end_drops_the_conversation(self):
+        store = DialogueCacheStore(max_bytes=10**6)
+        session = store.session("c1", "llm_1", "alpha")
+        store.session("c2", "llm_1", "alpha").update(kv_cache(2), [1, 2])
+        session.update(kv_cache(3), [1, 2, 3])
+
+        store.end("c1")
+        self.assertIsNone(session.cache)
+        self.assertEqual(store.stats()["active_sessions"], 1)
+        session.update(kv_cache(3), [1, 2, 3])
+        self.assertIsNone(session.cache)
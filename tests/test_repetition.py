@@ -0,0 +1,29 @@
+import unittest
+
+from repetition import RepetitionDetector
+
+
+class RepetitionDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = RepetitionDetector(max_ngram=8, min_repeats=3, min_tokens=12)
+
+    def test_repeated_ngram_at_the_end(self):
+        self.assertEqual(self.detector.period([9, 9] + [1, 2, 3, 4] * 3), 4)
+
+    def test_short_periods_need_min_tokens(self):
+        self.assertEqual(self.detector.period([5] * 11), 0)
+        self.assertEqual(self.detector.period([5] * 12), 1)
+
+    def test_long_periods_need_min_repeats(self):
+        ngram = list(range(1, 8))
+        self.assertEqual(self.detector.period(ngram * 2), 0)
+        self.assertEqual(self.detector.period(ngram * 3), 7)
+
+    def test_only_the_tail_counts(self):
+        self.assertEqual(self.detector.period([1, 2, 3] * 5 + [4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]), 0)
+
+    def test_periods_beyond_max_ngram_are_ignored(self):
+        self.assertEqual(self.detector.period(list(range(1, 10)) * 3), 0)
+
+    def test_varied_text(self):
+        self.assertEqual(self.detector.period(list(range(100))), 0)
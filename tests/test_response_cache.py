@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+from response_cache import ResponseCache, is_cacheable
+
+PARAMS = {"max_new_tokens": 256, "do_sample": False, "temperature": 1.0, "top_p": 1.0, "seed": None}
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_only_reproducible_params_are_cacheable(self):
+        self.assertTrue(is_cacheable(PARAMS))
+        self.assertFalse(is_cacheable({**PARAMS, "do_sample": True}))
+        self.assertTrue(is_cacheable({**PARAMS, "do_sample": True, "seed": 7}))
+
+    def test_key_ignores_whitespace_but_not_params(self):
+        cache = ResponseCache()
+        key = cache.make_key("ahmet", "Merhaba  dünya\n", PARAMS)
+        self.assertEqual(key, cache.make_key("ahmet", " Merhaba dünya", PARAMS))
+        self.assertNotEqual(key, cache.make_key("ahmet", "Merhaba dünya", {**PARAMS, "top_p": 0.9}))
+        self.assertNotEqual(key, cache.make_key("mehmet", "Merhaba dünya", PARAMS))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        self.assertEqual(cache.get("a"), "A")
+        cache.put("c", "C")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        stats = cache.stats()
+        self.assertEqual((stats["local_hits"], stats["misses"], stats["entries"]), (3, 1, 2))
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl_s=10)
+        with mock.patch("response_cache.time.time", return_value=1000.0):
+            cache.put("a", "A")
+        with mock.patch("response_cache.time.time", return_value=1009.0):
+            self.assertEqual(cache.get("a"), "A")
+        with mock.patch("response_cache.time.time", return_value=1011.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["entries"], 0)
@@ -0,0 +1,177 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from router import AFFINITY_SLACK, Router, affinity_key, create_app
+
+URLS = [f"http://127.0.0.1:{port}" for port in (5000, 5002, 5004, 5006)]
+PERSONAS = [f"persona-{i}" for i in range(200)]
+
+
+def healthy_router(urls=URLS):
+    router = Router(urls)
+    for replica in router.replicas:
+        replica.healthy = True
+    return router
+
+
+class AffinityKeyTest(unittest.TestCase):
+    def test_persona_name_is_normalized(self):
+        self.assertEqual(affinity_key({"persona_name": "  Ahmet Hakan "}), "ahmet hakan")
+
+    def test_debate_personas_are_order_independent(self):
+        self.assertEqual(
+            affinity_key({"selected_personas": ["B", "a"]}),
+            affinity_key({"selected_personas": ["A", "b"]}),
+        )
+
+    def test_requests_without_persona(self):
+        self.assertIsNone(affinity_key({"prompt": "merhaba"}))
+        self.assertIsNone(affinity_key(["not", "a", "dict"]))
+
+
+class ChooseTest(unittest.TestCase):
+    def test_a_persona_keeps_its_replica(self):
+        router = healthy_router()
+        first = router.choose("persona-1")
+        self.assertTrue(all(router.choose("persona-1") is first for _ in range(10)))
+
+    def test_losing_a_replica_only_moves_its_personas(self):
+        router = healthy_router()
+        before = {key: router.choose(key).url for key in PERSONAS}
+        lost = router.replicas[1]
+        lost.healthy = False
+        after = {key: router.choose(key).url for key in PERSONAS}
+
+        moved = {key for key in PERSONAS if before[key] != after[key]}
+        self.assertEqual(moved, {key for key in PERSONAS if before[key] == lost.url})
+        self.assertNotIn(lost.url, after.values())
+
+    def test_personas_spread_over_the_replicas(self):
+        router = healthy_router()
+        counts = {}
+        for key in PERSONAS:
+            url = router.choose(key).url
+            counts[url] = counts.get(url, 0) + 1
+        self.assertEqual(set(counts), set(URLS))
+        self.assertGreater(min(counts.values()), len(PERSONAS) / len(URLS) / 2)
+
+    def test_busy_preferred_replica_falls_back_to_least_loaded(self):
+        router = healthy_router()
+        preferred = router.choose("persona-1")
+        preferred.in_flight = AFFINITY_SLACK
+        self.assertIs(router.choose("persona-1"), preferred)
+
+        preferred.in_flight = AFFINITY_SLACK + 1
+        chosen = router.choose("persona-1")
+        self.assertIsNot(chosen, preferred)
+        self.assertEqual(chosen.load(), 0)
+
+    def test_requests_without_persona_go_to_the_least_loaded(self):
+        router = healthy_router()
+        for load, replica in enumerate(router.replicas):
+            replica.queue_depth = 10 - load
+        self.assertIs(router.choose(None), router.replicas[-1])
+
+    def test_retries_skip_replicas_already_tried(self):
+        router = healthy_router(URLS[:2])
+        first = router.choose("persona-1")
+        second = router.choose("persona-1", exclude=[first])
+        self.assertIsNot(second, first)
+        self.assertIsNone(router.choose("persona-1", exclude=[first, second]))
+        self.assertFalse(router.has_candidate([first, second]))
+
+    def test_unhealthy_replicas_are_tried_when_none_is_healthy(self):
+        router = Router(URLS[:1])
+        self.assertIs(router.choose("persona-1"), router.replicas[0])
+
+
+class ForwardTest(unittest.IsolatedAsyncioTestCase):
+    """Router in front of fake replicas that count the requests they get."""
+
+    async def asyncSetUp(self):
+        self.calls = []
+
+    async def replica(self, handler):
+        app = web.Application()
+
+        async def counted(request):
+            self.calls.append(request.host)
+            return await handler(request)
+
+        app.router.add_post("/generate", counted)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        return str(server.make_url("")).rstrip("/")
+
+    async def router_client(self, urls):
+        app = create_app(urls)
+        for replica in app["router"].replicas:
+            replica.healthy = True
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def test_busy_replica_is_retried_elsewhere(self):
+        async def busy(request):
+            return web.json_response({"error": "full"}, status=429, headers={"Retry-After": "3"})
+
+        async def ok(request):
+            return web.json_response({"response": "merhaba"})
+
+        client = await self.router_client([await self.replica(busy), await self.replica(ok)])
+        statuses = set()
+        for i in range(4):
+            response = await client.post("/generate", json={"persona_name": f"persona-{i}", "prompt": "x"})
+            statuses.add(response.status)
+        self.assertEqual(statuses, {200})
+
+    async def test_last_replica_answer_is_relayed_with_retry_after(self):
+        async def busy(request):
+            return web.json_response({"error": "full"}, status=429, headers={"Retry-After": "3"})
+
+        client = await self.router_client([await self.replica(busy)])
+        response = await client.post("/generate", json={"persona_name": "persona-1", "prompt": "x"})
+        self.assertEqual(response.status, 429)
+        self.assertEqual(response.headers["Retry-After"], "3")
+
+    async def test_refused_connection_is_retried(self):
+        async def ok(request):
+            return web.json_response({"response": "merhaba"})
+
+        # Nothing listens on port 9 (discard) on a test machine
+        client = await self.router_client(["http://127.0.0.1:9", await self.replica(ok)])
+        for i in range(4):
+            response = await client.post("/generate", json={"persona_name": f"persona-{i}", "prompt": "x"})
+            self.assertEqual(response.status, 200)
+
+    async def test_timed_out_request_is_not_retried(self):
+        async def slow(request):
+            await asyncio.sleep(2)
+            return web.json_response({"response": "late"})
+
+        client = await self.router_client([await self.replica(slow), await self.replica(slow)])
+        with mock.patch("router.REQUEST_TIMEOUT_S", 0.2):
+            response = await client.post("/generate", json={"persona_name": "persona-1", "prompt": "x"})
+        self.assertEqual(response.status, 504)
+        self.assertIn("error", await response.json())
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_dropped_connection_is_not_retried(self):
+        async def drop(request):
+            request.transport.close()
+            return web.Response()
+
+        client = await self.router_client([await self.replica(drop), await self.replica(drop)])
+        response = await client.post("/generate", json={"persona_name": "persona-1", "prompt": "x"})
+        self.assertEqual(response.status, 502)
+        self.assertEqual(len(self.calls), 1)
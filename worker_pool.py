@@ -0,0 +1,327 @@
+import logging
+import math
+import multiprocessing
+import queue
+import threading
+import time
+
+import torch
+
+from adapter_bank import AdapterBank
+from admission import MemoryAdmission, MemoryBudgetExceeded
+from adapter_registry import AdapterRegistry
+from batch_scheduler import ContinuousBatchScheduler, GenerationRequest, QueueFullError, RequestCancelled
+from debate_engine import persona_prefix
+from prefix_cache import PrefixCache
+
+logger = logging.getLogger(__name__)
+
+ERROR_TYPES = {
+    "QueueFullError": QueueFullError,
+    "TimeoutError": TimeoutError,
+    "ValueError": ValueError,
+    "RequestCancelled": RequestCancelled,
+    "MemoryBudgetExceeded": MemoryBudgetExceeded,
+}
+
+
+def _error_message(error):
+    if error is None:
+        return None
+    return (type(error).__name__, str(error), getattr(error, "retry_after", None))
+
+
+def _rebuild_error(error):
+    if error is None:
+        return None
+    kind, message, retry_after = error
+    if kind == "QueueFullError":
+        return QueueFullError(retry_after)
+    return ERROR_TYPES.get(kind, RuntimeError)(message)
+
+
+class _WorkerRequest(GenerationRequest):
+    """Worker-side request that reports tokens and completion back to the dispatcher."""
+
+    def __init__(self, results, pool_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._results = results
+        self._pool_id = pool_id
+
+    def _append(self, token_id):
+        super()._append(token_id)
+        self._results.put(("token", self._pool_id, token_id))
+
+    def _finish(self, reason, error=None):
+        super()._finish(reason, error)
+        self._results.put(("finish", self._pool_id, reason, _error_message(error)))
+
+
+def _worker_main(index, model, tokenizer, options, inbox, results):
+    """Entry point of a forked worker; model and tokenizer are inherited, not pickled."""
+    torch.set_num_threads(options["threads"])
+    device = torch.device("cpu")
+
+    registry = AdapterRegistry(
+        model,
+        options["adapter_path"],
+        memory_budget_mb=options["adapter_memory_budget_mb"],
+        max_adapters=options["max_resident_adapters"],
+    )
+    admission = None
+    if options["memory_budget_bytes"]:
+        admission = MemoryAdmission(
+            model.config, options["memory_budget_bytes"], model.dtype, padding_overhead=options["max_padding_ratio"]
+        )
+    scheduler = ContinuousBatchScheduler(
+        registry,
+        tokenizer,
+        device,
+        options["eos_token_ids"],
+        max_batch_size=options["max_batch_size"],
+        max_queue_size=options["max_queue_size"],
+        adapter_bank=AdapterBank(registry) if options["use_adapter_bank"] else None,
+        max_padding_ratio=options["max_padding_ratio"],
+        admission=admission,
+        repetition=options["repetition"],
+    )
+    prefix_caches = PrefixCache(registry, tokenizer, device, max_bytes=options["prefix_cache_bytes"])
+    prefix_text = persona_prefix(tokenizer)
+    logger.info(f"Worker {index} ready (pid {multiprocessing.current_process().pid}, {options['threads']} threads)")
+
+    live = {}  # pool id -> _WorkerRequest, for cancellation
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        if message[0] == "cancel":
+            request = live.pop(message[1], None)
+            if request is not None:
+                scheduler.cancel(request)
+            continue
+
+        _, pool_id, adapter_name, input_ids, kwargs = message
+        live = {i: r for i, r in live.items() if not r.done}
+        try:
+            prefix = prefix_caches.lookup(adapter_name, prefix_text, input_ids)
+            request = _WorkerRequest(results, pool_id, adapter_name, input_ids, prefix_cache=prefix, **kwargs)
+            live[pool_id] = scheduler.submit(request)
+        except Exception as e:
+            results.put(("finish", pool_id, "error", _error_message(e)))
+
+
+class WorkerPool:
+    """
+    CPU worker processes that share one copy of the base weights.
+
+    The model is loaded once in the parent and the workers are forked from it, so the
+    quantized weights are shared copy-on-write and never written to; each worker only
+    adds its own LoRA adapters, prefix cache and batch scheduler on top. Requests are
+    routed by persona affinity: a persona sticks to the worker it was first assigned,
+    so its adapter and cached prefix stay resident in one place.
+
+    submit() takes the same GenerationRequest objects as ContinuousBatchScheduler and
+    completes them from a reader thread as tokens arrive, so callers cannot tell the
+    difference. Dialogue KV caches do not cross process boundaries: prefix_cache and
+    return_cache are ignored and every turn is prefilled inside its worker.
+
+    memory_budget_bytes is split evenly between the workers, each of which admits its
+    requests against its own share.
+
+    The pool has to be created before torch has run anything with more than one
+    intra-op thread in this process: a forked child cannot use the OpenMP thread pool of
+    its parent, so the parent loads the model single-threaded and each worker sets up
+    its own pool of threads_per_worker threads. If a worker dies, the reader thread
+    fails its outstanding requests and its personas move to the surviving workers.
+    """
+
+    def __init__(self, model, tokenizer, num_workers, threads_per_worker, adapter_path, eos_token_ids,
+                 max_batch_size=8, max_queue_size=64, adapter_memory_budget_mb=None, max_resident_adapters=None,
+                 use_adapter_bank=True, prefix_cache_bytes=512 * 1024 * 1024, max_padding_ratio=0.25,
+                 memory_budget_bytes=None, repetition=None):
+        options = {
+            "threads": threads_per_worker,
+            "adapter_path": adapter_path,
+            "eos_token_ids": set(eos_token_ids),
+            "max_batch_size": max_batch_size,
+            "max_queue_size": max_queue_size,
+            "adapter_memory_budget_mb": adapter_memory_budget_mb,
+            "max_resident_adapters": max_resident_adapters,
+            "use_adapter_bank": use_adapter_bank,
+            "prefix_cache_bytes": prefix_cache_bytes,
+            "max_padding_ratio": max_padding_ratio,
+            "memory_budget_bytes": memory_budget_bytes // num_workers if memory_budget_bytes else None,
+            "repetition": repetition,
+        }
+        self.memory_budget_bytes = options["memory_budget_bytes"]
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size * num_workers
+        self.max_in_flight = max_batch_size + max_queue_size
+
+        context = multiprocessing.get_context("fork")
+        self._results = context.Queue()
+        self._inboxes = []
+        self._processes = []
+        for index in range(num_workers):
+            inbox = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, model, tokenizer, options, inbox, self._results),
+                name=f"inference-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+
+        self._lock = threading.Lock()
+        self._requests = {}  # pool id -> (worker index, GenerationRequest)
+        self._affinity = {}  # adapter name -> worker index
+        self._in_flight = [0] * num_workers
+        self._completed = [0] * num_workers
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._service_time = None
+        self._dead = set()
+
+        self._reader = threading.Thread(target=self._read_results, name="worker-pool-reader", daemon=True)
+        self._reader.start()
+
+    def _worker_for(self, adapter_name):
+        worker = self._affinity.get(adapter_name)
+        if worker is None or not self._processes[worker].is_alive():
+            alive = [i for i, p in enumerate(self._processes) if p.is_alive()]
+            if not alive:
+                raise RuntimeError("No inference worker is alive")
+            load = {i: 0 for i in alive}
+            for assigned in self._affinity.values():
+                if assigned in load:
+                    load[assigned] += 1
+            worker = min(alive, key=lambda i: (load[i], self._in_flight[i]))
+            self._affinity[adapter_name] = worker
+        return worker
+
+    def submit(self, request):
+        with self._lock:
+            worker = self._worker_for(request.adapter_name)
+            if self._in_flight[worker] >= self.max_in_flight:
+                self._counters["rejected"] += 1
+                raise QueueFullError(self._retry_after(worker))
+            self._in_flight[worker] += 1
+            self._requests[request.id] = (worker, request)
+            self._counters["submitted"] += 1
+
+        kwargs = {
+            "max_new_tokens": request.max_new_tokens,
+            "do_sample": request.do_sample,
+            "temperature": request.temperature,
+            "top_p": request.top_p,
+            "seed": request.seed,
+            "deadline": request.deadline,
+            "stop_on_repetition": request.stop_on_repetition,
+        }
+        self._inboxes[worker].put(("generate", request.id, request.adapter_name, request.input_ids, kwargs))
+        return request
+
+    def cancel(self, request):
+        """Stop a pooled request at its worker's next decoding step."""
+        request.cancel()
+        with self._lock:
+            entry = self._requests.get(request.id)
+        if entry is not None:
+            self._inboxes[entry[0]].put(("cancel", request.id))
+
+    def _read_results(self):
+        checked_at = time.time()
+        while True:
+            if time.time() - checked_at >= 1.0:
+                self._fail_dead_workers()
+                checked_at = time.time()
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            with self._lock:
+                entry = self._requests.get(message[1])
+            if entry is None:
+                continue
+            worker, request = entry
+            if message[0] == "token":
+                request._append(message[2])
+                continue
+
+            with self._lock:
+                del self._requests[message[1]]
+                self._in_flight[worker] -= 1
+                self._completed[worker] += 1
+                error = _rebuild_error(message[3])
+                self._counters["failed" if error is not None else "completed"] += 1
+                if error is None:
+                    elapsed = time.time() - request.submitted_at
+                    self._service_time = (
+                        elapsed if self._service_time is None else 0.9 * self._service_time + 0.1 * elapsed
+                    )
+            try:
+                request._finish(message[2], error)
+            except Exception as e:
+                logger.error(f"Finishing pooled request {request.id} failed: {e}")
+
+    def _fail_dead_workers(self):
+        """Fail the requests of workers that exited, instead of leaving them to time out."""
+        failed = []
+        with self._lock:
+            for worker, process in enumerate(self._processes):
+                if worker in self._dead or process.is_alive():
+                    continue
+                self._dead.add(worker)
+                logger.error(f"Inference worker {worker} (pid {process.pid}) exited with code {process.exitcode}")
+                for pool_id, (assigned, request) in list(self._requests.items()):
+                    if assigned == worker:
+                        del self._requests[pool_id]
+                        failed.append((worker, request))
+                        self._counters["failed"] += 1
+                self._in_flight[worker] = 0
+        for worker, request in failed:
+            try:
+                request._finish("error", RuntimeError(f"Inference worker {worker} exited"))
+            except Exception as e:
+                logger.error(f"Finishing pooled request {request.id} failed: {e}")
+
+    def _retry_after(self, worker):
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil(self._in_flight[worker] / max(self.max_batch_size, 1) * service_time))
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(self._in_flight)
+
+    def retry_after(self):
+        with self._lock:
+            return min(self._retry_after(i) for i in range(len(self._processes)))
+
+    def generate(self, adapter_name, input_ids, **kwargs):
+        return self.submit(GenerationRequest(adapter_name, input_ids, **kwargs)).result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "active": sum(self._in_flight),
+                "service_time_avg": self._service_time,
+                "memory_budget_bytes_per_worker": self.memory_budget_bytes,
+                "workers": [
+                    {
+                        "pid": process.pid,
+                        "alive": process.is_alive(),
+                        "in_flight": self._in_flight[i],
+                        "completed": self._completed[i],
+                        "personas": sorted(a for a, w in self._affinity.items() if w == i),
+                    }
+                    for i, process in enumerate(self._processes)
+                ],
+            }
+
+    def shutdown(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=5)